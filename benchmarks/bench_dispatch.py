@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Micro-benchmark of the per-request service handler dispatch overhead.
+
+Compares building a service handler for every request, as the front-ends
+used to, with looking it up in the ServiceHandlerCache.
+
+    python benchmarks/bench_dispatch.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.WMS import BaseWMSFactory
+from ogcserver.dispatch import ServiceHandlerCache
+
+tests_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+
+def setup():
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(tests_path, 'ogcserver.conf')))
+    mapfactory = BaseWMSFactory()
+    mapfactory.loadXML(os.path.join(tests_path, 'mapfile_encoding.xml'))
+    mapfactory.finalize()
+    return conf, mapfactory
+
+def per_request(conf, mapfactory):
+    ogcserver = __import__('ogcserver.WMS')
+    ServiceHandlerFactory = getattr(ogcserver, 'WMS').ServiceHandlerFactory
+    return ServiceHandlerFactory(conf, mapfactory, 'http://localhost/wms?', '1.3.0')
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    conf, mapfactory = setup()
+    servicehandlers = ServiceHandlerCache(conf, mapfactory)
+    cases = (
+        ('per request', lambda: per_request(conf, mapfactory)),
+        ('cached', lambda: servicehandlers('WMS', 'http://localhost/wms?', '1.3.0')),
+    )
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=iterations, repeat=3))
+        print '%-12s %8.2f usec/request' % (name, best / iterations * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Benchmark of map setup for LAYERS=__all__ on a mapfile with many layers.
+
+Times _buildMap with and without the map pool, and a full 256px GetMap,
+to show how much of a small tile request goes to setting up the map.
+
+    python benchmarks/bench_mappool.py [layers] [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.WMS import BaseWMSFactory
+from ogcserver.wms111 import ServiceHandler as ServiceHandler111
+from mapfiles import base_path, generate_mapfile
+
+def main():
+    layers = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(base_path, 'tests', 'ogcserver.conf')))
+    conf.set('service', 'allowedepsgcodes', '3857')
+    mapfactory = BaseWMSFactory()
+    mapfactory.loadXML(xmlstring=generate_mapfile(layers), basepath=base_path)
+    mapfactory.finalize()
+    servicehandler = ServiceHandler111(conf, mapfactory, 'http://localhost/wms?')
+
+    reqparams = {
+        'srs': 'EPSG:3857',
+        'bbox': '-20037508.34,-20037508.34,0,0',
+        'width': '256',
+        'height': '256',
+        'layers': '__all__',
+        'styles': '',
+        'format': 'image/png',
+    }
+    params = servicehandler.processParameters('GetMap', dict(reqparams))
+    params['crs'] = params['srs']
+    params['HTTP_USER_AGENT'] = 'benchmark'
+
+    def build_cold():
+        mapfactory.map_pool.clear()
+        mapfactory.map_pool.checkin(servicehandler._buildMap(params))
+
+    def build_pooled():
+        mapfactory.map_pool.checkin(servicehandler._buildMap(params))
+
+    def getmap():
+        servicehandler.GetMap(dict(params))
+
+    print '%d layers, 256x256 tile, best of 3 x %d' % (layers, iterations)
+    for name, func in (('build (cold)', build_cold), ('build (pooled)', build_pooled), ('GetMap (pooled)', getmap)):
+        best = min(timeit.repeat(func, number=iterations, repeat=3))
+        print '%-16s %8.2f msec/request' % (name, best / iterations * 1e3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Startup benchmark of BaseWMSFactory on very large mapfiles.
+
+Generates mapfiles with 1k, 5k and 20k layers and reports the time spent
+in loadXML and finalize, and the peak memory of the process.  Every size
+is loaded in a fresh interpreter so peak memory is not shared.
+
+    python benchmarks/bench_startup.py [layers ...]
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mapfiles import generate_mapfile
+
+def child(layers):
+    from ogcserver.WMS import BaseWMSFactory
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    try:
+        os.write(fd, generate_mapfile(layers))
+        os.close(fd)
+        mapfactory = BaseWMSFactory()
+        start = time.time()
+        mapfactory.loadXML(path)
+        loaded = time.time()
+        mapfactory.finalize()
+        finalized = time.time()
+    finally:
+        os.unlink(path)
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print '%6d layers  loadXML %8.2f s  finalize %6.2f s  peak %8.1f MB' % (layers, loaded - start, finalized - loaded, peak)
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        child(int(sys.argv[2]))
+        return
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 5000, 20000]
+    for layers in sizes:
+        sys.stdout.flush()
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--child', str(layers)])
+
+if __name__ == '__main__':
+    main()
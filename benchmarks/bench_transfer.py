@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Benchmark of handing encoded images back from render processes.
+
+Times a round trip through the render pool for results the size of an
+encoded 256px tile and of a 4096px print map, pickled over the socket and
+passed through shared memory.  The payloads are built before the workers
+are forked, so only the transfer is timed.
+
+    python benchmarks/bench_transfer.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ogcserver.renderpool import RenderPool
+
+# typical sizes of an encoded tile and of an encoded print map
+PAYLOADS = {
+    'tile': os.urandom(48 * 1024),
+    'print': os.urandom(24 * 1024 * 1024),
+}
+
+class FakeFactory:
+    conf = None
+
+class PayloadHandler:
+
+    def __init__(self, conf, mapfactory, opsonlineresource):
+        self.opsonlineresource = opsonlineresource
+
+    def payload(self, name):
+        return PAYLOADS[name]
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    handler = PayloadHandler(None, None, 'http://localhost/wms?')
+    pools = (('socket', RenderPool(FakeFactory(), 1)),
+             ('shared memory', RenderPool(FakeFactory(), 1, shmbytes=32 * 1024 * 1024)))
+
+    print 'best of 3 x %d' % iterations
+    for name, size in (('tile', '256px'), ('print', '4096px')):
+        for transfer, pool in pools:
+            pool.call(handler, 'payload', name)
+            best = min(timeit.repeat(lambda: pool.call(handler, 'payload', name), number=iterations, repeat=3))
+            print '%-6s %-7s %8d KB  %-14s %8.3f msec/render' % (name, size, len(PAYLOADS[name]) / 1024, transfer, best / iterations * 1e3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Generated mapfiles with many layers for the benchmarks."""
+
+import os
+
+base_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+LAYER = """
+    <Layer name="world_%(index)d" srs="+init=epsg:3857">
+        <StyleName>style_%(index)d</StyleName>
+        <Datasource>
+            <Parameter name="file">%(shapefile)s</Parameter>
+            <Parameter name="type">shape</Parameter>
+        </Datasource>
+    </Layer>
+"""
+
+STYLE = """
+    <Style name="style_%(index)d">
+        <Rule>
+            <LineSymbolizer stroke="grey" stroke-width=".2" />
+        </Rule>
+    </Style>
+"""
+
+def generate_mapfile(layers):
+    """ Returns a mapfile with as many layers, each with its own style,
+        over the demo world shapefile.
+    """
+    shapefile = os.path.join(base_path, 'demo', 'world_merc.shp')
+    parts = ['<?xml version="1.0" encoding="utf-8"?>\n<Map srs="+init=epsg:3857">']
+    for index in range(layers):
+        parts.append(STYLE % locals())
+        parts.append(LAYER % locals())
+    parts.append('</Map>')
+    return ''.join(parts)
@@ -1,15 +1,26 @@
 """Interface for registering map styles and layers for availability in WMS Requests."""
 
+import os
 import re
 import sys
+import json
+import hashlib
+import logging
+import threading
 import ConfigParser
-from mapnik import Style, Map, load_map, load_map_from_string, Envelope, Coord
+from mapnik import Style, Map, load_map, load_map_from_string, save_map_to_string, Envelope, Coord
 
 from ogcserver import common
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.settings import ServerSettings, load_settings
+from ogcserver.cache import SingleFlight, cache_from_config, single_flight_from_config
+from ogcserver.renderpool import render_pool_from_config
 from ogcserver.wms111 import ServiceHandler as ServiceHandler111
 from ogcserver.wms130 import ServiceHandler as ServiceHandler130
 from ogcserver.exceptions import OGCException, ServerConfigurationError
 
+log = logging.getLogger('ogcserver.WMS')
+
 def ServiceHandlerFactory(conf, mapfactory, onlineresource, version):
 
     if not version:
@@ -40,27 +51,137 @@ def extract_named_rules(s_obj):
     if len(s.rules):
         return s
 
+class ExtentCache:
+
+    def __init__(self, path):
+        """ An on-disk store of layer envelopes, so that datasources do not
+            have to be scanned for their extent every time the server starts.
+
+            Entries are keyed by the datasource parameters, the layer srs and
+            the modification time of a file based datasource.  Entries of
+            database backed layers are never invalidated, remove the file or
+            configure the layer extent to refresh them.
+
+            @param path: Path of the JSON file the envelopes are kept in.
+            @type path: String.
+        """
+        self.path = path
+        self.extents = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                self.extents = json.load(open(path))
+            except ValueError:
+                sys.stderr.write('Warning: ignoring unreadable layer extent cache "%s".\n' % path)
+
+    def key(self, layer):
+        params = layer.datasource.params()
+        if hasattr(params, 'as_dict'):
+            params = params.as_dict()
+        else:
+            params = dict(params)
+        mtime = None
+        if params.get('file'):
+            filename = os.path.join(params.get('base', ''), params['file'])
+            # shapefiles are usually given without their extension
+            for candidate in (filename, filename + '.shp'):
+                if os.path.exists(candidate):
+                    mtime = os.path.getmtime(candidate)
+                    break
+        return hashlib.sha1(repr((sorted(params.items()), layer.srs, mtime))).hexdigest()
+
+    def get(self, layer):
+        extent = self.extents.get(self.key(layer))
+        if extent is not None:
+            return Envelope(*extent)
+        return None
+
+    def set(self, layer, env):
+        key = self.key(layer)
+        with self.lock:
+            self.extents[key] = [env.minx, env.miny, env.maxx, env.maxy]
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            # write then rename so that concurrent readers never see half a
+            # file
+            tmppath = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmppath, 'w') as f:
+                json.dump(self.extents, f)
+            os.rename(tmppath, self.path)
+            self.dirty = False
+
 class BaseWMSFactory:
     def __init__(self, configpath=None):
         self.layers = {}
         self.ordered_layers = []
         self.styles = {}
         self.aggregatestyles = {}
+        # every registered style and aggregate style name, the two share
+        # one namespace
+        self.stylenames = set()
         self.map_attributes = {}
         self.map_scale = 1
         self.meta_styles = {}
         self.meta_layers = {}
         self.configpath = configpath
+        # the configuration is only read once, configpath may also be an
+        # already parsed configuration or ServerSettings instance
+        if isinstance(configpath, ServerSettings):
+            self.conf = configpath.conf
+        elif isinstance(configpath, basestring):
+            self.conf = SafeConfigParser()
+            self.conf.readfp(open(configpath))
+        else:
+            self.conf = configpath
         self.latlonbb = None
+        # layer name -> envelope in the layer srs, from the [layer_<name>]
+        # extent option or computed on first use
+        self.layer_extents = {}
+        self.extent_cache = None
+        if self.conf is not None and self.conf.has_option('server', 'extentcache') and self.conf.get('server', 'extentcache'):
+            self.extent_cache = ExtentCache(self.conf.get('server', 'extentcache'))
+        # the digest of the mapfiles and configuration loaded so far, which
+        # finalize() folds the registered layers and styles into to make
+        # the update sequence
+        self.loadsequence = '0'
+        self.updatesequence = '0'
+        # serialized GetCapabilities documents keyed by
+        # (version, onlineresource, updatesequence), flushed once it holds
+        # capabilities_cache_size of them as the online resource may come
+        # from the Host header of the request
+        self.capabilities_cache = {}
+        self.capabilities_cache_size = 32
+        # assembled Map objects reused by GetMap and GetFeatureInfo
+        self.map_pool = common.MapPool()
+        # rendered GetMap responses, keyed on the normalized request and
+        # the update sequence so that a reload never serves stale maps
+        self.response_cache = cache_from_config(self.conf)
+        # coalesces concurrent renders of the same map
+        self.single_flight = single_flight_from_config(self.conf, self.response_cache)
+        # and of single layer images, within the process only as they are
+        # rendered while the lock of a whole map may be held
+        self.layer_flight = SingleFlight()
+        # worker processes rendering maps under a timeout, if configured
+        self.render_pool = render_pool_from_config(self.conf, self)
+        # (layer name, requested style) -> [(style name, Style), ...] or the
+        # exception to raise for it, compiled by finalize()
+        self.layer_styles = {}
+        # names of the layers opted out of the layer cache with the
+        # [layer_<name>] layercache option
+        self.uncached_layers = set()
 
     def loadXML(self, xmlfile=None, strict=False, xmlstring='', basepath=''):
-        config = ConfigParser.SafeConfigParser()
+        config = self.conf
         map_wms_srs = None
-        if self.configpath:
-            config.readfp(open(self.configpath))
-
-            if config.has_option('map', 'wms_srs'):
-                map_wms_srs = config.get('map', 'wms_srs')
+        if config is None:
+            config = ConfigParser.SafeConfigParser()
+        elif config.has_option('map', 'wms_srs'):
+            map_wms_srs = config.get('map', 'wms_srs')
 
         tmp_map = Map(0,0)
         if xmlfile:
@@ -70,6 +191,18 @@ class BaseWMSFactory:
         else:
             raise ServerConfigurationError("Mapnik configuration XML is not specified - 'xmlfile' and 'xmlstring' variables are empty.\
 Please set one of this variables to load mapnik map object.")
+        # the update sequence advertised in GetCapabilities follows the content
+        # of the loaded mapfiles and configuration, chained across loads
+        digest = hashlib.sha1(self.loadsequence)
+        for section in sorted(config.sections()):
+            digest.update('[%s]\n' % section)
+            for item in sorted(config.items(section, raw=True)):
+                digest.update('%s=%s\n' % item)
+        if xmlfile:
+            digest.update(open(xmlfile, 'rb').read())
+        else:
+            digest.update(xmlstring)
+        self.loadsequence = self.updatesequence = digest.hexdigest()
         # get the map scale
         if tmp_map.parameters:
             if tmp_map.parameters['scale']:
@@ -97,6 +230,20 @@ Please set one of this variables to load mapnik map object.")
             else:
                 lyr.abstract = ''
 
+            if config.has_option(layer_section, 'extent') and config.get(layer_section, 'extent'):
+                try:
+                    extent = map(float, config.get(layer_section, 'extent').split(','))
+                    self.layer_extents[lyr.name] = Envelope(*extent)
+                except:
+                    raise ServerConfigurationError('Configuration parameter [%s]->extent has an invalid value, must be minx,miny,maxx,maxy.' % layer_section)
+
+            if config.has_option(layer_section, 'layercache') and config.get(layer_section, 'layercache'):
+                try:
+                    if not config.getboolean(layer_section, 'layercache'):
+                        self.uncached_layers.add(lyr.name)
+                except ValueError:
+                    raise ServerConfigurationError('Configuration parameter [%s]->layercache has an invalid value, must be true or false.' % layer_section)
+
             style_count = len(lyr.styles)
             if style_count == 0:
                 raise ServerConfigurationError("Cannot register Layer '%s' without a style" % lyr.name)
@@ -122,9 +269,11 @@ Please set one of this variables to load mapnik map object.")
                     meta_lyr.wms_srs = layer_wms_srs
                     self.ordered_layers.append(meta_lyr)
                     self.meta_layers[meta_layer_name] = meta_lyr
-                    print meta_layer_name
+                    if lyr.name in self.uncached_layers:
+                        self.uncached_layers.add(meta_layer_name)
+                    log.debug('Registered meta layer %s', meta_layer_name)
 
-                if style_name not in self.aggregatestyles.keys() and style_name not in self.styles.keys():
+                if style_name not in self.stylenames:
                     self.register_style(style_name, style_obj)
 
                 # must copy layer here otherwise we'll segfault
@@ -148,15 +297,17 @@ Please set one of this variables to load mapnik map object.")
                         self.meta_styles[meta_layer_name] = meta_s
                         meta_lyr = common.copy_layer(lyr)
                         meta_lyr.meta_style = meta_layer_name
-                        print meta_layer_name
+                        log.debug('Registered meta layer %s', meta_layer_name)
                         meta_lyr.name = meta_layer_name
                         meta_lyr.wmsextrastyles = ()
                         meta_lyr.defaultstyle = meta_layer_name
                         meta_lyr.wms_srs = layer_wms_srs
                         self.ordered_layers.append(meta_lyr)
                         self.meta_layers[meta_layer_name] = meta_lyr
+                        if lyr.name in self.uncached_layers:
+                            self.uncached_layers.add(meta_layer_name)
 
-                    if style_name not in self.aggregatestyles.keys() and style_name not in self.styles.keys():
+                    if style_name not in self.stylenames:
                         self.register_style(style_name, style_obj)
                 aggregates = tuple([sty for sty in lyr.styles])
                 aggregates_name = '%s_aggregates' % lyr.name
@@ -175,56 +326,164 @@ This style will effectively be hidden by the 'all styles' default style for mult
             raise ServerConfigurationError('Attempted to register an unnamed layer.')
         if not layer.wms_srs and not re.match('^\+init=epsg:\d+$', layer.srs) and not re.match('^\+proj=.*$', layer.srs):
             raise ServerConfigurationError('Attempted to register a layer without an epsg projection defined.')
-        if defaultstyle not in self.styles.keys() + self.aggregatestyles.keys():
+        if defaultstyle not in self.stylenames:
             raise ServerConfigurationError('Attempted to register a layer with an non-existent default style.')
         layer.wmsdefaultstyle = defaultstyle
         if isinstance(extrastyles, tuple):
             for stylename in extrastyles:
                 if type(stylename) == type(''):
-                    if stylename not in self.styles.keys() + self.aggregatestyles.keys():
+                    if stylename not in self.stylenames:
                         raise ServerConfigurationError('Attempted to register a layer with an non-existent extra style.')
                 else:
                     ServerConfigurationError('Attempted to register a layer with an invalid extra style name.')
             layer.wmsextrastyles = extrastyles
         else:
             raise ServerConfigurationError('Layer "%s" was passed an invalid list of extra styles.  List must be a tuple of strings.' % layername)
-        layerproj = common.Projection(layer.srs)
-        env = layer.envelope()
-        llp = layerproj.inverse(Coord(env.minx, env.miny))
-        urp = layerproj.inverse(Coord(env.maxx, env.maxy))
-        if self.latlonbb is None:
-            self.latlonbb = Envelope(llp, urp)
-        else:
-            self.latlonbb.expand_to_include(Envelope(llp, urp))
+        # validates the srs, the envelope itself is only computed on demand
+        self.projection(layer.srs)
+        self.latlonbb = None
         self.ordered_layers.append(layer)
         self.layers[layername] = layer
 
+    def projection(self, srs):
+        return common.thread_projection(srs)
+
+    def envelope(self, layer, save=True):
+        """ Returns the envelope of a layer in its own srs, taken from the
+            configuration, the extent cache or, failing both, computed from
+            the datasource and remembered.
+        """
+        env = self.layer_extents.get(layer.name)
+        if env is None:
+            if self.extent_cache is not None:
+                env = self.extent_cache.get(layer)
+            if env is None:
+                env = layer.envelope()
+                if self.extent_cache is not None:
+                    self.extent_cache.set(layer, env)
+                    if save:
+                        self.extent_cache.save()
+            self.layer_extents[layer.name] = env
+        return env
+
+    def get_latlonbb(self):
+        """ Returns the geographic envelope of all registered layers. """
+        if self.latlonbb is None:
+            latlonbb = None
+            for layer in self.ordered_layers:
+                layerproj = self.projection(layer.srs)
+                env = self.envelope(layer, save=False)
+                llp = layerproj.inverse(Coord(env.minx, env.miny))
+                urp = layerproj.inverse(Coord(env.maxx, env.maxy))
+                if latlonbb is None:
+                    latlonbb = Envelope(llp, urp)
+                else:
+                    latlonbb.expand_to_include(Envelope(llp, urp))
+            if self.extent_cache is not None:
+                self.extent_cache.save()
+            self.latlonbb = latlonbb
+        return self.latlonbb
+
     def register_style(self, name, style):
         if not name:
             raise ServerConfigurationError('Attempted to register a style without providing a name.')
-        if name in self.aggregatestyles.keys() or name in self.styles.keys():
+        if name in self.stylenames:
             raise ServerConfigurationError("Attempted to register a style with a name already in use: '%s'" % name)
         if not isinstance(style, Style):
             raise ServerConfigurationError('Bad style object passed to register_style() for style "%s".' % name)
         self.styles[name] = style
+        self.stylenames.add(name)
 
     def register_aggregate_style(self, name, stylenames):
         if not name:
             raise ServerConfigurationError('Attempted to register an aggregate style without providing a name.')
-        if name in self.aggregatestyles.keys() or name in self.styles.keys():
+        if name in self.stylenames:
             raise ServerConfigurationError('Attempted to register an aggregate style with a name already in use.')
-        self.aggregatestyles[name] = []
         for stylename in stylenames:
-            if stylename not in self.styles.keys():
+            if stylename not in self.styles:
                 raise ServerConfigurationError('Attempted to register an aggregate style containing a style that does not exist.')
-            self.aggregatestyles[name].append(stylename)
+        self.aggregatestyles[name] = list(stylenames)
+        self.stylenames.add(name)
 
     def finalize(self):
+        # finalize marks the end of a (re)load, drop anything built
+        # from the previous set of layers and styles
+        self.capabilities_cache.clear()
+        self.map_pool.clear()
+        self.latlonbb = None
         if len(self.layers) == 0:
             raise ServerConfigurationError('No layers defined!')
         if len(self.styles) == 0:
             raise ServerConfigurationError('No styles defined!')
         for layer in self.layers.values():
             for style in list(layer.styles) + list(layer.wmsextrastyles):
-                if style not in self.styles.keys() + self.aggregatestyles.keys():
+                if style not in self.stylenames:
                     raise ServerConfigurationError('Layer "%s" refers to undefined style "%s".' % (layer.name, style))
+        self.compile_layer_styles()
+        self.updatesequence = self._mapSequence()
+        if self.conf is not None and self.conf.has_option_with_value('server', 'prebuildcapabilities'):
+            settings = load_settings(self.conf)
+            if settings.prebuildcapabilities:
+                self.prebuild_capabilities(settings)
+
+    def _mapSequence(self):
+        """ Returns the update sequence of the registered layers and styles,
+            which factories assembling them in Python rather than with
+            loadXML change as well, so that persistent response caches
+            never serve maps of an older set.
+        """
+        digest = hashlib.sha1(self.loadsequence)
+        m = Map(0, 0)
+        styles = dict(self.styles)
+        styles.update(self.meta_styles)
+        for name in sorted(styles):
+            m.append_style(name, styles[name])
+        for layer in self.ordered_layers:
+            m.layers.append(layer)
+            # meta layers have no styles of their own to request
+            digest.update(repr((layer.name, getattr(layer, 'wmsdefaultstyle', None), list(getattr(layer, 'wmsextrastyles', ())))))
+        digest.update(save_map_to_string(m))
+        digest.update(repr(sorted(self.aggregatestyles.items())))
+        digest.update(repr(sorted([(name, str(value)) for name, value in self.map_attributes.items()])))
+        return digest.hexdigest()
+
+    def compile_layer_styles(self):
+        """ Resolves, for every layer and every style that may be requested
+            for it, the ordered list of styles to render the layer with.
+            An empty requested style stands for the layer's default style.
+        """
+        layer_styles = {}
+        for layer in self.layers.values():
+            reqstyles = [''] + list(layer.wmsextrastyles)
+            if len(layer.wmsextrastyles) > 1:
+                # the 'all styles' default of multi-style layers
+                reqstyles.append('default')
+            for reqstyle in reqstyles:
+                if len(layer.wmsextrastyles) > 1 and reqstyle == 'default':
+                    stylename = layer.wmsdefaultstyle
+                else:
+                    stylename = reqstyle or layer.wmsdefaultstyle
+                if stylename in self.aggregatestyles:
+                    stylenames = self.aggregatestyles[stylename]
+                else:
+                    stylenames = [stylename]
+                styles = []
+                for stylename in stylenames:
+                    if stylename in self.styles:
+                        styles.append((stylename, self.styles[stylename]))
+                    else:
+                        styles = ServerConfigurationError('Layer "%s" refers to non-existent style "%s".' % (layer.name, stylename))
+                        break
+                layer_styles[(layer.name, reqstyle)] = styles
+        self.layer_styles = layer_styles
+
+    def prebuild_capabilities(self, settings):
+        """ Eagerly build, serialize and compress the GetCapabilities
+            documents of every supported WMS version for the configured
+            baseurl, so that no client pays the cost of building them.
+        """
+        if not settings.baseurl:
+            raise ServerConfigurationError('Prebuilding the capabilities documents requires the baseurl to be configured.')
+        for version in ('1.1.1', '1.3.0'):
+            servicehandler = ServiceHandlerFactory(settings, self, settings.baseurl, version)
+            servicehandler.GetCapabilities({})
@@ -0,0 +1,660 @@
+"""Response caches for rendered maps, feature info and capabilities."""
+
+import os
+import sys
+import time
+import zlib
+import atexit
+import socket
+import sqlite3
+import hashlib
+import threading
+import tempfile
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ogcserver.exceptions import ServerConfigurationError
+
+def cache_key(key):
+    """ Returns the hexadecimal digest used to store the (hashable, repr-able)
+        key in a cache.
+    """
+    return hashlib.sha1(repr(key)).hexdigest()
+
+class BaseCache:
+    """ The interface shared by all cache backends.
+
+        Keys are tuples (anything hashable with a stable repr), values are
+        byte strings.  A backend may drop any entry at any time, a get of a
+        missing entry returns None.  Backends override get, set and delete;
+        as they are here the cache stores nothing.
+    """
+
+    # whether other processes see the entries, and so may render them
+    shared = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the value stored for key, or None. """
+        return self._count(None)
+
+    def set(self, key, value):
+        """ Stores value for key, unless the backend decides not to. """
+        pass
+
+    def delete(self, key):
+        """ Removes the entry of key, if there is one. """
+        pass
+
+    def flush(self):
+        """ Writes out buffered entries, so that other processes see them. """
+        pass
+
+    def _count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class DiskCache(BaseCache):
+
+    shared = True
+
+    def __init__(self, path, maxbytes, scaninterval=60):
+        """ A cache of rendered responses in a local directory.
+
+            Entries are evicted least recently used first once their total
+            size exceeds maxbytes.  The modification time of an entry is
+            bumped whenever it is read, so the order survives a restart.
+
+            Several processes may share the directory.  Entries written by
+            the others are picked up when read, and the index of entries is
+            rebuilt from the directory every scaninterval seconds, so that
+            maxbytes bounds the directory rather than each process.
+
+            @param path: Directory the entries are stored in, created if it
+                         does not exist.
+            @type path: String.
+
+            @param maxbytes: Byte budget for all entries.
+            @type maxbytes: Integer.
+
+            @param scaninterval: Seconds between rescans of the directory.
+            @type scaninterval: Number.
+        """
+        BaseCache.__init__(self)
+        self.path = path
+        self.maxbytes = maxbytes
+        self.scaninterval = scaninterval
+        self.lock = threading.Lock()
+        # digest -> entry size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with self.lock:
+            self._scan()
+
+    def _scan(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    # evicted by another process meanwhile
+                    continue
+                found.append((st.st_mtime, filename, st.st_size))
+        found.sort()
+        self.entries = OrderedDict()
+        self.size = 0
+        for mtime, digest, size in found:
+            self.entries[digest] = size
+            self.size += size
+        self.lastscan = time.time()
+        self._evict()
+
+    def _filename(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, key):
+        digest = cache_key(key)
+        with self.lock:
+            if digest in self.entries:
+                self.entries[digest] = self.entries.pop(digest)
+        filename = self._filename(digest)
+        try:
+            content = open(filename, 'rb').read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            # missing, or removed underneath us by another process sharing
+            # the directory
+            with self.lock:
+                self.size -= self.entries.pop(digest, 0)
+            return self._count(None)
+        with self.lock:
+            if digest not in self.entries:
+                # written by another process sharing the directory
+                self.entries[digest] = len(content)
+                self.size += len(content)
+                self._evict()
+        return self._count(content)
+
+    def set(self, key, content):
+        if len(content) > self.maxbytes:
+            return
+        digest = cache_key(key)
+        filename = self._filename(digest)
+        if not os.path.isdir(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                pass
+        # write then rename so that readers never see half an entry
+        tmpname = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+        f = open(tmpname, 'wb')
+        f.write(content)
+        f.close()
+        os.rename(tmpname, filename)
+        with self.lock:
+            if time.time() - self.lastscan >= self.scaninterval:
+                # take in the entries written and evicted by other processes
+                self._scan()
+            self.size -= self.entries.pop(digest, 0)
+            self.entries[digest] = len(content)
+            self.size += len(content)
+            self._evict()
+
+    def delete(self, key):
+        digest = cache_key(key)
+        with self.lock:
+            self.size -= self.entries.pop(digest, 0)
+        try:
+            os.remove(self._filename(digest))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.size > self.maxbytes and self.entries:
+            digest, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._filename(digest))
+            except OSError:
+                pass
+
+    def stats(self):
+        stats = BaseCache.stats(self)
+        stats.update({'entries': len(self.entries), 'size': self.size})
+        return stats
+
+class MemoryCache(BaseCache):
+
+    def __init__(self, maxbytes):
+        """ A bounded in-process cache of ready to send responses.
+
+            Values are kept as they are, so a hit returns the very object
+            that was stored, and need not be byte strings if their size is
+            given.  Entries are evicted least recently used first once their
+            total size exceeds maxbytes.
+
+            @param maxbytes: Byte budget for all entries.
+            @type maxbytes: Integer.
+        """
+        BaseCache.__init__(self)
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        # key -> (value, size), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.maxbytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.maxbytes:
+                oldkey, (oldvalue, oldsize) = self.entries.popitem(last=False)
+                self.size -= oldsize
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def stats(self):
+        with self.lock:
+            stats = BaseCache.stats(self)
+            stats.update({'entries': len(self.entries), 'size': self.size})
+            return stats
+
+class SQLiteCache(BaseCache):
+
+    shared = True
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS map (request_id TEXT PRIMARY KEY, tile_id TEXT);
+        CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+        CREATE VIEW IF NOT EXISTS tiles AS
+            SELECT map.request_id AS request_id, images.tile_data AS tile_data
+            FROM map JOIN images ON images.tile_id = map.tile_id;
+        INSERT OR IGNORE INTO metadata VALUES ('name', 'ogcserver');
+    """
+
+    def __init__(self, path, batchsize=32, flushinterval=1.0, maxbytes=0, cleanupinterval=60):
+        """ A cache of rendered responses in a single SQLite file.
+
+            The layout follows the deduplicated MBTiles schema: the map
+            table points request digests at images keyed by the digest of
+            their content, so identical renderings (empty or sea tiles) are
+            stored once.  The database runs in WAL mode so readers do not
+            block each other or the writer.
+
+            Writes are buffered and committed in one transaction every
+            batchsize entries or flushinterval seconds, whichever is first.
+
+            Every cleanupinterval seconds a flush also drops the images no
+            longer referenced, and evicts the oldest written entries while
+            the images take more than maxbytes.  The pages freed are reused
+            by later writes, the file itself does not shrink.
+
+            @param path: Path of the database file, created if it does not
+                         exist.
+            @type path: String.
+
+            @param batchsize: Number of entries written per transaction.
+            @type batchsize: Integer.
+
+            @param flushinterval: Maximum age in seconds of a buffered write.
+            @type flushinterval: Float.
+
+            @param maxbytes: Byte budget for all images, 0 for none.
+            @type maxbytes: Integer.
+
+            @param cleanupinterval: Seconds between cleanups.
+            @type cleanupinterval: Number.
+        """
+        BaseCache.__init__(self)
+        self.path = path
+        self.batchsize = batchsize
+        self.flushinterval = flushinterval
+        self.maxbytes = maxbytes
+        self.cleanupinterval = cleanupinterval
+        self.lastcleanup = time.time()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # digest -> content, written at the next flush
+        self.pending = {}
+        self.lastflush = time.time()
+        self._connection().executescript(self.schema)
+        atexit.register(self.flush)
+
+    def _connection(self):
+        # sqlite connections may neither be shared between threads nor
+        # survive a fork, so each thread of each process opens its own
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        digest = cache_key(key)
+        with self.lock:
+            content = self.pending.get(digest)
+        if content is not None:
+            return self._count(content)
+        row = self._connection().execute('SELECT tile_data FROM tiles WHERE request_id = ?', (digest,)).fetchone()
+        if row is None:
+            return self._count(None)
+        return self._count(str(row[0]))
+
+    def set(self, key, content):
+        with self.lock:
+            self.pending[cache_key(key)] = content
+            due = len(self.pending) >= self.batchsize or time.time() - self.lastflush >= self.flushinterval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.lastflush = time.time()
+            cleanup = time.time() - self.lastcleanup >= self.cleanupinterval
+            if cleanup:
+                self.lastcleanup = time.time()
+        if pending:
+            conn = self._connection()
+            images = {}
+            mapping = []
+            for digest, content in pending.iteritems():
+                tile_id = hashlib.sha1(content).hexdigest()
+                images[tile_id] = content
+                mapping.append((digest, tile_id))
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                                 [(tile_id, sqlite3.Binary(content)) for tile_id, content in images.iteritems()])
+                conn.executemany('INSERT OR REPLACE INTO map (request_id, tile_id) VALUES (?, ?)', mapping)
+        if cleanup:
+            self.cleanup()
+
+    def cleanup(self):
+        """ Drops unreferenced images, then the oldest written entries while
+            the images take more than maxbytes.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+            if not self.maxbytes:
+                return
+            size = conn.execute('SELECT coalesce(sum(length(tile_data)), 0) FROM images').fetchone()[0]
+            if size <= self.maxbytes:
+                return
+            # a replaced entry gets a new rowid, so they grow in write order;
+            # shared images make the count of bytes freed an estimate
+            freed = 0
+            last = None
+            rows = conn.execute('SELECT map.rowid, length(images.tile_data) FROM map JOIN images ON images.tile_id = map.tile_id ORDER BY map.rowid')
+            for rowid, length in rows:
+                freed += length
+                last = rowid
+                self.evictions += 1
+                if size - freed <= self.maxbytes:
+                    break
+            rows.close()
+            if last is not None:
+                conn.execute('DELETE FROM map WHERE rowid <= ?', (last,))
+                conn.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+
+    def delete(self, key):
+        digest = cache_key(key)
+        with self.lock:
+            self.pending.pop(digest, None)
+        conn = self._connection()
+        with conn:
+            # the image may be shared with other requests, it is dropped by
+            # the next cleanup if not
+            conn.execute('DELETE FROM map WHERE request_id = ?', (digest,))
+
+class MemcachedCache(BaseCache):
+
+    shared = True
+
+    def __init__(self, servers, prefix='ogcserver:', exptime=0, timeout=1.0):
+        """ A cache shared between processes and hosts through one or more
+            memcached servers, spoken to in the memcached text protocol.
+
+            Keys are spread over the servers by their digest.  A server that
+            cannot be reached is treated as a miss, so a cache outage slows
+            the server down but never breaks a request.
+
+            @param servers: List of (host, port) tuples.
+            @type servers: A python list.
+
+            @param prefix: Prepended to every key, to share a memcached
+                           instance between several servers.
+            @type prefix: String.
+
+            @param exptime: Expiration time of entries in seconds, 0 for
+                            none.
+            @type exptime: Integer.
+        """
+        BaseCache.__init__(self)
+        self.servers = list(servers)
+        self.prefix = prefix
+        self.exptime = exptime
+        self.timeout = timeout
+        # one connection per server for each thread of each process
+        self.local = threading.local()
+
+    def _key(self, key):
+        digest = cache_key(key)
+        server = self.servers[zlib.crc32(digest) % len(self.servers)]
+        return server, self.prefix + digest
+
+    def _connection(self, server):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None or self.local.pid != os.getpid():
+            connections = self.local.connections = {}
+            self.local.pid = os.getpid()
+        conn = connections.get(server)
+        if conn is None:
+            sock = socket.create_connection(server, self.timeout)
+            conn = connections[server] = (sock, sock.makefile('rb'))
+        return conn
+
+    def _command(self, server, command, readvalue=False):
+        try:
+            sock, f = self._connection(server)
+            sock.sendall(command)
+            line = f.readline()
+            if not readvalue:
+                return line.rstrip('\r\n')
+            value = None
+            if line.startswith('VALUE '):
+                size = int(line.split()[3])
+                value = f.read(size + 2)[:-2]
+                line = f.readline()
+            if line.rstrip('\r\n') != 'END':
+                raise socket.error('unexpected memcached response: %r' % line)
+            return value
+        except (socket.error, ValueError, IndexError):
+            conn = self.local.connections.pop(server, None)
+            if conn is not None:
+                conn[0].close()
+            return None
+
+    def get(self, key):
+        server, key = self._key(key)
+        return self._count(self._command(server, 'get %s\r\n' % key, readvalue=True))
+
+    def set(self, key, value):
+        server, key = self._key(key)
+        self._command(server, 'set %s 0 %d %d\r\n%s\r\n' % (key, self.exptime, len(value), value))
+
+    def delete(self, key):
+        server, key = self._key(key)
+        self._command(server, 'delete %s\r\n' % key)
+
+class _Call:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+
+    def __init__(self, lockdir=None, locks=1024, cache=None):
+        """ Coalesces concurrent calls for the same key into one, whose
+            result every caller receives.
+
+            Within a process the first caller runs the call while the others
+            wait for it.  With a lock directory the first callers of each
+            process also take an exclusive lock on a lock file, so a call
+            whose result is shared through a cache runs in one process at a
+            time and the others find it cached once they get the lock.
+
+            @param lockdir: Directory of the lock files, or None to only
+                            coalesce calls within the process.
+            @type lockdir: String.
+
+            @param locks: Number of lock files keys are spread over.
+            @type locks: Integer.
+
+            @param cache: The cache calls store their result in, flushed
+                          before the lock is released so that the other
+                          processes find the result.
+            @type cache: L{BaseCache}.
+        """
+        self.lockdir = lockdir
+        self.locks = locks
+        self.cache = cache
+        self.lock = threading.Lock()
+        # key -> _Call in flight
+        self.calls = {}
+        if lockdir is not None and not os.path.isdir(lockdir):
+            try:
+                os.makedirs(lockdir)
+            except OSError:
+                if not os.path.isdir(lockdir):
+                    raise
+
+    def do(self, key, fn, recheck=None):
+        """ Returns fn(), or the result of a concurrent call for the same
+            key.  recheck, if given, is called once the cross-process lock
+            is held and its result, if not None, is used instead of fn().
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+        self._lead(key, call, fn, recheck)
+        if call.error is not None:
+            raise call.error[0], call.error[1], call.error[2]
+        return call.result
+
+    def start(self, key, fn, recheck=None):
+        """ Runs fn() in a background thread unless a call for the same key
+            is already in flight, in which case nothing is started.  Callers
+            of do() for the key meanwhile wait for the background call.
+
+            @return: Whether a call was started.
+        """
+        with self.lock:
+            if key in self.calls:
+                return False
+            call = self.calls[key] = _Call()
+        thread = threading.Thread(target=self._lead, args=(key, call, fn, recheck))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _lead(self, key, call, fn, recheck):
+        try:
+            call.result = self._run(key, fn, recheck)
+        except:
+            call.error = sys.exc_info()
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+    def _run(self, key, fn, recheck):
+        if self.lockdir is None or fcntl is None:
+            return fn()
+        lockpath = os.path.join(self.lockdir, 'lock-%04d' % (zlib.crc32(cache_key(key)) % self.locks))
+        lockfile = open(lockpath, 'a')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if recheck is not None:
+                result = recheck()
+                if result is not None:
+                    return result
+            result = fn()
+            if self.cache is not None:
+                self.cache.flush()
+            return result
+        finally:
+            lockfile.close()
+
+def _option(conf, option, cast=str, default=None):
+    if not conf.has_option('cache', option) or not conf.get('cache', option):
+        return default
+    try:
+        return cast(conf.get('cache', option))
+    except ValueError:
+        raise ServerConfigurationError('Configuration parameter [cache]->%s has an invalid value: %s.' % (option, conf.get('cache', option)))
+
+def _servers(value):
+    servers = []
+    for server in value.split(','):
+        host, port = server.strip().rsplit(':', 1)
+        servers.append((host, int(port)))
+    return servers
+
+def cache_from_config(conf):
+    """ Returns the response cache backend configured in the [cache] section
+        of conf, or None if caching is disabled.
+    """
+    if conf is None:
+        return None
+    cachetype = _option(conf, 'type', default='disk')
+    if cachetype == 'none':
+        return None
+    elif cachetype in ('disk', 'sqlite'):
+        path = _option(conf, 'path')
+        if not path:
+            return None
+        if cachetype == 'sqlite':
+            return SQLiteCache(path, _option(conf, 'batchsize', int, 32), maxbytes=_option(conf, 'maxbytes', int, 0))
+        maxbytes = _option(conf, 'maxbytes', int)
+        if maxbytes is None:
+            raise ServerConfigurationError('Configuration parameter [cache]->maxbytes must be set to the cache size in bytes.')
+        return DiskCache(path, maxbytes)
+    elif cachetype == 'memory':
+        maxbytes = _option(conf, 'maxbytes', int)
+        if maxbytes is None:
+            raise ServerConfigurationError('Configuration parameter [cache]->maxbytes must be set to the cache size in bytes.')
+        return MemoryCache(maxbytes)
+    elif cachetype == 'memcached':
+        servers = _option(conf, 'servers', _servers)
+        if not servers:
+            raise ServerConfigurationError('Configuration parameter [cache]->servers must list the memcached servers as host:port.')
+        return MemcachedCache(servers, _option(conf, 'prefix', default='ogcserver:'), _option(conf, 'exptime', int, 0))
+    raise ServerConfigurationError('Unknown cache type "%s", must be one of none, disk, sqlite, memory or memcached.' % cachetype)
+
+def single_flight_from_config(conf, cache):
+    """ Returns the L{SingleFlight} for renders into cache, locking across
+        processes if the cache is shared between them.
+    """
+    lockdir = None
+    if cache is not None and cache.shared:
+        lockdir = os.path.join(tempfile.gettempdir(), 'ogcserver-locks')
+        if conf is not None:
+            lockdir = _option(conf, 'lockdir', default=lockdir)
+    return SingleFlight(lockdir, cache=cache)
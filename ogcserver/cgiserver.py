@@ -12,7 +12,8 @@ import sys
 from jon import cgi
 
 from ogcserver.common import Version
-from ogcserver.configparser import SafeConfigParser
+from ogcserver.settings import load_settings
+from ogcserver.dispatch import ServiceHandlerCache
 from ogcserver.wms111 import ExceptionHandler as ExceptionHandler111
 from ogcserver.wms130 import ExceptionHandler as ExceptionHandler130
 from ogcserver.exceptions import OGCException, ServerConfigurationError
@@ -20,25 +21,23 @@ from ogcserver.exceptions import OGCException, ServerConfigurationError
 class Handler(cgi.DebugHandler):
 
     def __init__(self, home_html=None):
-        conf = SafeConfigParser()
-        conf.readfp(open(self.configpath))
+        settings = load_settings(self.configpath)
         # TODO - be able to supply in config as well
         self.home_html = home_html
-        self.conf = conf
-        if not conf.has_option_with_value('server', 'module'):
+        self.conf = settings.conf
+        if not settings.module:
             raise ServerConfigurationError('The factory module is not defined in the configuration file.')
         try:
-            mapfactorymodule = __import__(conf.get('server', 'module'))
+            mapfactorymodule = __import__(settings.module)
         except ImportError:
             raise ServerConfigurationError('The factory module could not be loaded.')
         if hasattr(mapfactorymodule, 'WMSFactory'):
             self.mapfactory = getattr(mapfactorymodule, 'WMSFactory')()
         else:
             raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
-        if conf.has_option('server', 'debug'):
-            self.debug = int(conf.get('server', 'debug'))
-        else:
-            self.debug = 0
+        self.settings = settings
+        self.debug = settings.debug
+        self.servicehandlers = ServiceHandlerCache(settings, self.mapfactory)
 
     def process(self, req):
         base = False
@@ -47,8 +46,8 @@ class Handler(cgi.DebugHandler):
 
         reqparams = lowerparams(req.params)
 
-        if self.conf.has_option_with_value('service', 'baseurl'): 
-            onlineresource = '%s' % self.conf.get('service', 'baseurl') 
+        if self.settings.baseurl:
+            onlineresource = self.settings.baseurl
         else:
             # if there is no baseurl in the config file try to guess a valid one
             onlineresource = 'http://%s%s?' % (req.environ['HTTP_HOST'], req.environ['SCRIPT_NAME'])
@@ -66,12 +65,7 @@ class Handler(cgi.DebugHandler):
                 service = reqparams['service']
             if reqparams.has_key('service'):
                 del reqparams['service']
-            try:
-                ogcserver = __import__('ogcserver.' + service)
-            except:
-                raise OGCException('Unsupported service "%s".' % service)
-            ServiceHandlerFactory = getattr(ogcserver, service).ServiceHandlerFactory
-            servicehandler = ServiceHandlerFactory(self.conf, self.mapfactory, onlineresource, reqparams.get('version', None))
+            servicehandler = self.servicehandlers(service, onlineresource, reqparams.get('version', None))
             if reqparams.has_key('version'):
                 del reqparams['version']
             if request not in servicehandler.SERVICE_PARAMS.keys():
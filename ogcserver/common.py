@@ -3,6 +3,11 @@
 import re
 import sys
 import copy
+import time
+import zlib
+import threading
+from gzip import GzipFile
+from collections import OrderedDict
 from sys import exc_info
 from StringIO import StringIO
 from xml.etree import ElementTree
@@ -18,7 +23,8 @@ except ImportError:
     sys.stderr.write('Warning: PIL.Image not found: image based error messages will not be supported\n')
     HAS_PIL = False
 
-from ogcserver.exceptions import OGCException, ServerConfigurationError
+from ogcserver.exceptions import OGCException, RenderDeferred, RenderTimeout, ServerConfigurationError
+from ogcserver.tiles import GRIDS
 
 
 
@@ -180,10 +186,24 @@ class BaseServiceHandler:
 
 class Response:
 
-    def __init__(self, content_type, content, status_code=200):
+    def __init__(self, content_type, content, status_code=200, encodings=None):
         self.content_type = content_type
         self.content = content
         self.status_code = status_code
+        # optional pre-encoded variants of content keyed by content-coding
+        self.encodings = encodings or {}
+        # set when the content is a stale or expired copy from the response cache
+        self.stale = False
+
+def compress(content):
+    """ Returns the gzip and deflate encoded variants of content, suitable
+        for the encodings argument of L{Response}.
+    """
+    fh = StringIO()
+    gz = GzipFile(fileobj=fh, mode='wb', compresslevel=9)
+    gz.write(content)
+    gz.close()
+    return {'gzip': fh.getvalue(), 'deflate': zlib.compress(content, 9)}
 
 
 class Version:
@@ -244,7 +264,6 @@ class CRS:
     def __init__(self, namespace, code):
         self.namespace = namespace.lower()
         self.code = int(code)
-        self.proj = None
 
     def __repr__(self):
         return '%s:%s' % (self.namespace, self.code)
@@ -255,14 +274,10 @@ class CRS:
         return False
 
     def inverse(self, x, y):
-        if not self.proj:
-            self.proj = Projection('+init=%s:%s' % (self.namespace, self.code))
-        return self.proj.inverse(Coord(x, y))
+        return thread_projection('+init=%s:%s' % (self.namespace, self.code)).inverse(Coord(x, y))
 
     def forward(self, x, y):
-        if not self.proj:
-            self.proj = Projection('+init=%s:%s' % (self.namespace, self.code))        
-        return self.proj.forward(Coord(x, y))
+        return thread_projection('+init=%s:%s' % (self.namespace, self.code)).forward(Coord(x, y))
 
 class CRSFactory:
 
@@ -312,22 +327,423 @@ def copy_layer(obj):
     if hasattr(lyr, 'wms_srs'):
         lyr.wms_srs = obj.wms_srs
     return lyr
-      
+
+class MapPool:
+
+    def __init__(self, maxkeys=64, maxidle=4):
+        """ A pool of assembled L{Map} objects waiting to be reused.
+
+            Maps are checked out by key for exclusive use and checked back
+            in once rendered.  Keys are evicted least recently used first.
+            Every thread has a pool of its own, a Map is never handed from
+            one thread to another.
+
+            @param maxkeys: Number of distinct keys kept in the pool of each
+                            thread.
+            @type maxkeys: Integer.
+
+            @param maxidle: Number of idle maps kept per key.
+            @type maxidle: Integer.
+        """
+        self.maxkeys = maxkeys
+        self.maxidle = maxidle
+        self.local = threading.local()
+        # bumped by clear(), pools of an older generation are dropped
+        self.generation = 0
+
+    def _idle(self):
+        local = self.local
+        if getattr(local, 'generation', None) != self.generation:
+            local.idle = OrderedDict()
+            local.generation = self.generation
+        return local.idle
+
+    def checkout(self, key):
+        maps = self._idle().get(key)
+        if maps:
+            return maps.pop()
+        return None
+
+    def checkin(self, m):
+        key = getattr(m, 'poolkey', None)
+        if key is None:
+            return
+        idle = self._idle()
+        maps = idle.pop(key, None)
+        if maps is None:
+            maps = []
+            if len(idle) >= self.maxkeys:
+                idle.popitem(last=False)
+        if len(maps) < self.maxidle:
+            maps.append(m)
+        idle[key] = maps
+
+    def clear(self):
+        """ Empties the pools of all threads. """
+        self.generation += 1
+
 class WMSBaseServiceHandler(BaseServiceHandler):
 
+    def GetCapabilities(self, params):
+        self._checkUpdateSequence(params.get('updatesequence'))
+        # handlers are cheap and short lived, so the serialized document is
+        # kept in the factory wide store and shared between requests
+        cachekey = (self.version, self.opsonlineresource, self.mapfactory.updatesequence)
+        response = self.mapfactory.capabilities_cache.get(cachekey)
+        if response is None:
+            # the serialized document may also have been built by another
+            # process sharing the response cache
+            cache = self.mapfactory.response_cache
+            capabilities = None
+            if cache is not None:
+                check_lookup(cache)
+                capabilities = cache.get(('GetCapabilities',) + cachekey)
+            if capabilities is None:
+                check_render()
+            response = self.buildCapabilitiesResponse(capabilities)
+            if cache is not None and capabilities is None:
+                cache.set(('GetCapabilities',) + cachekey, response.content)
+            if len(self.mapfactory.capabilities_cache) >= self.mapfactory.capabilities_cache_size:
+                self.mapfactory.capabilities_cache.clear()
+            self.mapfactory.capabilities_cache[cachekey] = response
+        return response
+
+    def _checkUpdateSequence(self, updatesequence):
+        if not updatesequence:
+            return
+        current = self.mapfactory.updatesequence
+        if updatesequence == current:
+            raise OGCException('Update sequence "%s" is current, capabilities have not changed.' % updatesequence, 'CurrentUpdateSequence')
+        if updatesequence.isdigit() and current.isdigit():
+            invalid = int(updatesequence) > int(current)
+        else:
+            # digests carry no ordering, so only a value that this server
+            # could never have issued is treated as being ahead of it
+            invalid = not re.match('^[0-9a-f]{40}$', updatesequence)
+        if invalid:
+            raise OGCException('Update sequence "%s" is ahead of or unknown to this server.' % updatesequence, 'InvalidUpdateSequence')
+
+    def buildCapabilitiesResponse(self, capabilities=None):
+        if capabilities is None:
+            capabilities = self._buildCapabilities()
+        return Response(self.capabilitiesmimetype, capabilities, encodings=compress(capabilities))
+
     def GetMap(self, params):
+        metatile = self.settings.metatile > 1 and self.mapfactory.response_cache is not None
+        tile = None
+        # WMS-C clients promise requests aligned to the tile grid
+        if metatile or params.get('tiled', '').lower() == 'true':
+            tile = self._findTile(params)
+        if not metatile:
+            # the snapped tile is rendered on its own
+            tile = None
+        cachekey = self._responseCacheKey(params)
+        response, age = self._cachedResponse(cachekey)
+        softttl = self.settings.cachesoftttl
+        hardttl = self.settings.cachehardttl
+        if response is not None and not (hardttl and age >= hardttl):
+            if softttl and age >= softttl:
+                # serve the stale map now and refresh it in the background,
+                # unless a render of it is already in flight
+                response.stale = True
+                render, recheck = self._renderCall(dict(params), cachekey, tile)
+                def refresh():
+                    try:
+                        return render()
+                    except:
+                        sys.stderr.write('Warning: refreshing a stale map failed: %s' % ''.join(format_exception_only(*exc_info()[:2])))
+                        raise
+                self.mapfactory.single_flight.start(self._flightKey(cachekey, tile), refresh, recheck)
+            return response
+        check_render()
+        try:
+            return self._render(params, cachekey, tile)
+        except Exception, e:
+            if response is None or (isinstance(e, OGCException) and not isinstance(e, RenderTimeout)):
+                raise
+            # the last good rendering beats an exception image
+            sys.stderr.write('Warning: serving an expired map after a failed render: %s' % ''.join(format_exception_only(*exc_info()[:2])))
+            response.stale = True
+            return response
+
+    def _flightKey(self, cachekey, tile):
+        """ Returns the key under which concurrent renders of the map are
+            coalesced, that of its metatile for a metatiled request.
+        """
+        if tile is None:
+            return cachekey
+        grid, z, x, y = tile
+        metax, metay, columns, rows = grid.metatile(z, x, y, self.settings.metatile)
+        return cachekey[:2] + (grid.name, z, metax, metay) + cachekey[3:]
+
+    def _freshResponse(self, cachekey):
+        """ Returns the cached response unless it is missing or older than
+            the soft TTL.
+        """
+        response, age = self._cachedResponse(cachekey)
+        softttl = self.settings.cachesoftttl
+        if response is None or (softttl and age >= softttl):
+            return None
+        return response
+
+    def _renderCall(self, params, cachekey, tile):
+        """ Returns the (fn, recheck) pair rendering the map for
+            L{ogcserver.cache.SingleFlight}.  recheck finds the map if
+            another process rendered it meanwhile.
+        """
+        if tile is None:
+            return (lambda: self._renderMap(params, cachekey)), (lambda: self._freshResponse(cachekey))
+        # every tile of a metatile comes out of the same render
+        grid, z, x, y = tile
+        def recheck():
+            response = self._freshResponse(cachekey)
+            if response is not None:
+                return {(x, y): response}
+            return None
+        return (lambda: self._renderMetatile(params, *tile)), recheck
+
+    def _render(self, params, cachekey, tile):
+        render, recheck = self._renderCall(params, cachekey, tile)
+        result = self.mapfactory.single_flight.do(self._flightKey(cachekey, tile), render, recheck)
+        if tile is None:
+            return result
+        grid, z, x, y = tile
+        response = result.get((x, y))
+        if response is None:
+            # the metatile was rendered by another process
+            response = self._freshResponse(cachekey) or self._renderMetatile(params, *tile)[(x, y)]
+        return response
+
+    def _renderMap(self, params, cachekey):
+        response = Response(params['format'].replace('8',''), self._offload('_encodeMap', params))
+        self._cacheResponse(cachekey, response)
+        return response
+
+    def _offload(self, methodname, *args):
+        """ Returns getattr(self, methodname)(*args), run by the render pool
+            of the factory if there is one.
+        """
+        pool = self.mapfactory.render_pool
+        if pool is None:
+            return getattr(self, methodname)(*args)
+        return pool.call(self, methodname, *args)
+
+    def _encodeMap(self, params):
+        return self._renderImage(params).tostring(self._imageFormat(params))
+
+    def _drawMap(self, params):
+        """ Builds the map of params and renders it into a new Image. """
         m = self._buildMap(params)
         im = Image(params['width'], params['height'])
         map_scale = self.mapfactory.map_scale if self.mapfactory is not None else 1
         render(m, im, map_scale)
+        self.mapfactory.map_pool.checkin(m)
+        return im
+
+    def _renderImage(self, params):
+        """ Renders the map of params, composited from separately cached
+            layer images when the layer cache is enabled.
+        """
+        layers = self._layerRequests(params)
+        if layers is None:
+            return self._drawMap(params)
+        im = Image(params['width'], params['height'])
+        background = self._background(params)
+        if background is not None:
+            if not isinstance(background, Color):
+                background = Color(str(background))
+            if hasattr(im, 'fill'):
+                im.fill(background)
+            else:
+                im.background = background
+        composite = hasattr(im, 'composite')
+        if composite:
+            # compositing works on premultiplied colors, encoders expect
+            # them demultiplied
+            im.premultiply()
+        for layerparams in layers:
+            layerim = self._layerImage(layerparams)
+            if composite:
+                layerim.premultiply()
+                im.composite(layerim)
+            else:
+                # before Mapnik 2.1
+                im.blend(0, 0, layerim, 1.0)
+        if composite:
+            im.demultiply()
+        return im
+
+    def _layerRequests(self, params):
+        """ Returns the parameters of the transparent single layer maps the
+            map of params is composited from, in drawing order, or None if
+            it has to be rendered as a whole.  That is the case when the
+            layer cache is disabled or any of the layers opted out of it,
+            as labels only avoid each other within one render.
+        """
+        if not self.settings.layercache or self.mapfactory.response_cache is None:
+            return None
+        if params['layers'] and params['layers'][0] == '__all__':
+            requests = [(layer.name, '') for layer in self.mapfactory.ordered_layers if not hasattr(layer, 'meta_style')]
+        else:
+            styles = list(params.get('styles') or ())
+            styles += [''] * (len(params['layers']) - len(styles))
+            requests = zip(params['layers'], styles)
+        layers = []
+        for layername, style in requests:
+            if layername in self.mapfactory.uncached_layers:
+                return None
+            layerparams = dict(params)
+            layerparams['layers'] = [layername]
+            layerparams['styles'] = [style]
+            layerparams['transparent'] = 'true'
+            # stored losslessly whatever format the map is requested in
+            layerparams['format'] = 'image/png'
+            layerparams.pop('bgcolor', None)
+            layers.append(layerparams)
+        return layers
+
+    def _layerImage(self, layerparams):
+        """ Returns the Image of a single layer map, from the response cache
+            or rendered and stored in it.
+        """
+        layerkey = ('Layer',) + self._responseCacheKey(layerparams)
+        def renderlayer():
+            im = self._drawMap(layerparams)
+            response = Response('image/png', im.tostring(self._imageFormat(layerparams)))
+            self._cacheResponse(layerkey, response)
+            return response
+        response = self._freshResponse(layerkey)
+        if response is None:
+            response = self.mapfactory.layer_flight.do(layerkey, renderlayer)
+        return Image.fromstring(response.content)
+
+    def _imageFormat(self, params):
         format = PIL_TYPE_MAPPING[params['format']]
         if mapnik_version() >= 200300:
             # Mapnik 2.3 uses png8 as default, use png32 for backwards compatibility
             if format == 'png':
                 format = 'png32'
-        return Response(params['format'].replace('8',''), im.tostring(format))
+        return format
+
+    def _reverseAxes(self, params):
+        """ Returns whether the bbox of the request is in y, x order. """
+        return False
+
+    def _swapAxes(self, params, bbox):
+        """ Converts bbox between the axis order of the request and the
+            x, y order of the map.  Both are the same unless a version of
+            the protocol says otherwise.
+        """
+        return list(bbox)
+
+    def _findTile(self, params):
+        """ Returns (grid, z, x, y) if the request is for a single tile of
+            the grid of its CRS, or None.  The bbox of a matching request is
+            snapped to the grid so that the tile has a single cache key.
+        """
+        grid = GRIDS.get(str(params['crs']))
+        if grid is None:
+            return None
+        tile = grid.find_tile(self._swapAxes(params, params['bbox']), params['width'], params['height'])
+        if tile is None:
+            return None
+        params['bbox'] = self._swapAxes(params, grid.tile_bbox(*tile))
+        return (grid,) + tile
+
+    def _renderMetatile(self, params, grid, z, x, y):
+        """ Renders the block of tiles around tile (z, x, y) as one map,
+            stores every tile of it in the response cache and returns the
+            responses of all of them, keyed by (x, y).
+        """
+        metax, metay, columns, rows = grid.metatile(z, x, y, self.settings.metatile)
+        metaparams = dict(params)
+        metaparams['bbox'] = self._swapAxes(params, grid.metatile_bbox(z, metax, metay, columns, rows))
+        metaparams['width'] = columns * grid.tilesize
+        metaparams['height'] = rows * grid.tilesize
+        tiles = self._offload('_encodeMetatile', metaparams, columns, rows, grid.tilesize)
+        content_type = params['format'].replace('8','')
+        responses = {}
+        for row in range(rows):
+            for column in range(columns):
+                tileresponse = Response(content_type, tiles[(column, row)])
+                tileparams = dict(params)
+                tileparams['bbox'] = self._swapAxes(params, grid.tile_bbox(z, metax + column, metay + row))
+                self._cacheResponse(self._responseCacheKey(tileparams), tileresponse)
+                responses[(metax + column, metay + row)] = tileresponse
+        return responses
+
+    def _encodeMetatile(self, metaparams, columns, rows, tilesize):
+        """ Renders the map of metaparams and returns the encoded tiles it is
+            cut into, keyed by (column, row).
+        """
+        im = self._renderImage(metaparams)
+        format = self._imageFormat(metaparams)
+        tiles = {}
+        for row in range(rows):
+            for column in range(columns):
+                tileim = im.view(column * tilesize, row * tilesize, tilesize, tilesize)
+                tiles[(column, row)] = tileim.tostring(format)
+        return tiles
+
+    def _cachedResponse(self, cachekey):
+        """ Returns the cached response and its age in seconds, or
+            (None, None).
+        """
+        cache = self.mapfactory.response_cache
+        if cache is None:
+            return None, None
+        check_lookup(cache)
+        cached = cache.get(cachekey)
+        if cached is None:
+            return None, None
+        created, content = cached.split('\n', 1)
+        try:
+            created = float(created)
+        except ValueError:
+            # written before entries carried their creation time, treat it
+            # as expired
+            content = cached
+            created = 0
+        content_type, content = content.split('\n', 1)
+        return Response(content_type, content), max(0, time.time() - created)
+
+    def _cacheResponse(self, cachekey, response):
+        cache = self.mapfactory.response_cache
+        if cache is not None:
+            cache.set(cachekey, '%r\n%s\n%s' % (time.time(), response.content_type, response.content))
+
+    def _responseCacheKey(self, params):
+        """ Returns the key of the rendered map in the response cache, made
+            of everything that influences the image and the update sequence
+            of the loaded mapfile.
+        """
+        return (self.version,
+                str(params['crs']),
+                tuple(params['bbox']),
+                params['width'],
+                params['height'],
+                tuple(params['layers']),
+                tuple(params.get('styles') or ()),
+                params.get('format'),
+                params.get('transparent', '').lower(),
+                str(params.get('bgcolor', '')),
+                params.get('buffer_size'),
+                # the same bbox is read in another axis order for some clients
+                self._reverseAxes(params),
+                self.mapfactory.map_scale,
+                self.mapfactory.updatesequence)
 
     def GetFeatureInfo(self, params, querymethodname='query_point'):
+        cachekey = ('GetFeatureInfo',
+                    querymethodname,
+                    params['info_format'],
+                    params['i'],
+                    params['j'],
+                    tuple(params['query_layers'])) + self._responseCacheKey(params)
+        response, age = self._cachedResponse(cachekey)
+        if response is not None and not (self.settings.cachehardttl and age >= self.settings.cachehardttl):
+            return response
+        check_render()
         m = self._buildMap(params)
         if params['info_format'] == 'text/plain':
             writer = TextFeatureInfo()
@@ -370,23 +786,15 @@ class WMSBaseServiceHandler(BaseServiceHandler):
                         raise OGCException('Requested query layer "%s" is not marked queryable.' % layername, 'LayerNotQueryable')
                 else:
                     raise OGCException('Requested query layer "%s" not in the LAYERS parameter.' % layername)
-        return Response(params['info_format'], str(writer))
-
-    def _buildMap(self, params):
-        if str(params['crs']) not in self.allowedepsgcodes:
-            raise OGCException('Unsupported CRS "%s" requested.' % str(params['crs']).upper(), 'InvalidCRS')
-        if params['bbox'][0] >= params['bbox'][2]:
-            raise OGCException("BBOX values don't make sense.  minx is greater than maxx.")
-        if params['bbox'][1] >= params['bbox'][3]:
-            raise OGCException("BBOX values don't make sense.  miny is greater than maxy.")
-
-        # relax this for now to allow for a set of specific layers (meta layers even)
-        # to be used without known their styles or putting the right # of commas...
-
-        #if params.has_key('styles') and len(params['styles']) != len(params['layers']):
-        #    raise OGCException('STYLES length does not match LAYERS length.')
-        m = Map(params['width'], params['height'], '+init=%s' % params['crs'])
-
+        self.mapfactory.map_pool.checkin(m)
+        response = Response(params['info_format'], str(writer))
+        self._cacheResponse(cachekey, response)
+        return response
+
+    def _background(self, params):
+        """ Returns the background color of the map of params, or None if
+            it is transparent.
+        """
         transparent = params.get('transparent', '').lower() == 'true'
 
         # disable transparent on incompatible formats 
@@ -395,10 +803,10 @@ class WMSBaseServiceHandler(BaseServiceHandler):
 
         if transparent:
             # transparent has highest priority
-            pass
+            return None
         elif params.has_key('bgcolor'):
             # if not transparent use bgcolor in url            
-            m.background = params['bgcolor']
+            return params['bgcolor']
         else:
             # if not bgcolor in url use map background
             if mapnik_version() >= 200000:
@@ -407,90 +815,107 @@ class WMSBaseServiceHandler(BaseServiceHandler):
                 bgcolor = self.mapfactory.map_attributes.get('background-color', None)
 
             if bgcolor:
-                m.background = bgcolor
+                return bgcolor
             else:
                 # if not map background defined use white color
-                m.background = Color(255, 255, 255, 255)
+                return Color(255, 255, 255, 255)
+
+    def _buildMap(self, params):
+        if str(params['crs']) not in self.allowedepsgcodes:
+            raise OGCException('Unsupported CRS "%s" requested.' % str(params['crs']).upper(), 'InvalidCRS')
+        if params['bbox'][0] >= params['bbox'][2]:
+            raise OGCException("BBOX values don't make sense.  minx is greater than maxx.")
+        if params['bbox'][1] >= params['bbox'][3]:
+            raise OGCException("BBOX values don't make sense.  miny is greater than maxy.")
 
+        # relax this for now to allow for a set of specific layers (meta layers even)
+        # to be used without known their styles or putting the right # of commas...
+
+        #if params.has_key('styles') and len(params['styles']) != len(params['layers']):
+        #    raise OGCException('STYLES length does not match LAYERS length.')
+
+        background = self._background(params)
 
         if params.has_key('buffer_size'):
-            if params['buffer_size']:
-                m.buffer_size = params['buffer_size']
+            buffer_size = params['buffer_size']
+        else:
+            buffer_size = self.mapfactory.map_attributes.get('buffer_size')
+
+        resolved = self._resolveLayers(params)
+
+        # maps only differ by size and extent once the projection, layers,
+        # styles and background are set, so assembled ones are reused
+        poolkey = (str(params['crs']),
+                   tuple([(layer.name, tuple([stylename for stylename, style in styles])) for layer, styles in resolved]),
+                   background is not None and str(background) or None,
+                   buffer_size)
+        m = self.mapfactory.map_pool.checkout(poolkey)
+        if m is None:
+            m = Map(params['width'], params['height'], '+init=%s' % params['crs'])
+            if background is not None:
+                m.background = background
+            if buffer_size:
+                m.buffer_size = buffer_size
+            for layer_obj, styles in resolved:
+                # if we don't copy the layer here we get
+                # duplicate layers added to the map because the
+                # layer is kept around and the styles "pile up"...
+                layer = copy_layer(layer_obj)
+                for stylename, style in styles:
+                    layer.styles.append(stylename)
+                    m.append_style(stylename, style)
+                m.layers.append(layer)
+            m.poolkey = poolkey
         else:
-            buffer_ = self.mapfactory.map_attributes.get('buffer_size')
-            if buffer_:
-                m.buffer_size = self.mapfactory.map_attributes['buffer_size']
+            m.resize(params['width'], params['height'])
+        m.zoom_to_box(Envelope(params['bbox'][0], params['bbox'][1], params['bbox'][2], params['bbox'][3]))
+        return m
 
+    def _resolveLayers(self, params):
+        """ Resolves the LAYERS and STYLES parameters into the ordered list
+            of (layer, [(stylename, style), ...]) making up the map.
+        """
+        resolved = []
         # haiti spec tmp hack! show meta layers without having
         # to request huge string to avoid some client truncating it!
         if params['layers'] and params['layers'][0] in ('osm_haiti_overlay','osm_haiti_overlay_900913'):
             for layer_obj in self.mapfactory.ordered_layers:
-                layer = copy_layer(layer_obj)
-                if not hasattr(layer,'meta_style'):
-                    pass
-                else:
-                    layer.styles.append(layer.meta_style)
-                    m.append_style(layer.meta_style, self.mapfactory.meta_styles[layer.meta_style])
-                    m.layers.append(layer)        
+                if hasattr(layer_obj,'meta_style'):
+                    resolved.append((layer_obj, [(layer_obj.meta_style, self.mapfactory.meta_styles[layer_obj.meta_style])]))
         # a non WMS spec way of requesting all layers
         # uses orderedlayers that preserves original ordering in XML mapfile
         elif params['layers'] and params['layers'][0] == '__all__':
             for layer_obj in self.mapfactory.ordered_layers:
-                # if we don't copy the layer here we get
-                # duplicate layers added to the map because the
-                # layer is kept around and the styles "pile up"...
-                layer = copy_layer(layer_obj)
-                if hasattr(layer,'meta_style'):
+                if hasattr(layer_obj,'meta_style'):
                     continue
-                reqstyle = layer.wmsdefaultstyle
-                if reqstyle in self.mapfactory.aggregatestyles.keys():
-                    for stylename in self.mapfactory.aggregatestyles[reqstyle]:
-                        layer.styles.append(stylename)
-                else:
-                    layer.styles.append(reqstyle)
-                for stylename in layer.styles:
-                    if stylename in self.mapfactory.styles.keys():
-                        m.append_style(stylename, self.mapfactory.styles[stylename])
-                m.layers.append(layer)
+                styles = self.mapfactory.layer_styles[(layer_obj.name, '')]
+                if isinstance(styles, Exception):
+                    raise styles
+                resolved.append((layer_obj, styles))
         else:
+            layer_styles = self.mapfactory.layer_styles
             for layerindex, layername in enumerate(params['layers']):
                 if layername in self.mapfactory.meta_layers:
-                    layer = copy_layer(self.mapfactory.meta_layers[layername])
-                    layer.styles.append(layername)
-                    m.append_style(layername, self.mapfactory.meta_styles[layername])
-                else:
-                    try:
-                        # uses unordered dict of layers
-                        # order based on params['layers'] request which
-                        # should be originally informed by order of GetCaps response
-                        layer = copy_layer(self.mapfactory.layers[layername])
-                    except KeyError:
+                    resolved.append((self.mapfactory.meta_layers[layername], [(layername, self.mapfactory.meta_styles[layername])]))
+                    continue
+                try:
+                    reqstyle = params['styles'][layerindex]
+                except IndexError:
+                    reqstyle = ''
+                # the style resolution is compiled when the factory is
+                # finalized, a miss is either an unknown layer or style
+                styles = layer_styles.get((layername, reqstyle))
+                if styles is None:
+                    if layername not in self.mapfactory.layers:
                         raise OGCException('Layer "%s" not defined.' % layername, 'LayerNotDefined')
-                    try:
-                        reqstyle = params['styles'][layerindex]
-                    except IndexError:
-                        reqstyle = ''
-                    if len(layer.wmsextrastyles) > 1 and reqstyle == 'default':
-                        reqstyle = ''
-                    if reqstyle and reqstyle not in layer.wmsextrastyles:
-                        raise OGCException('Invalid style "%s" requested for layer "%s".' % (reqstyle, layername), 'StyleNotDefined')
-                    if not reqstyle:
-                        reqstyle = layer.wmsdefaultstyle
-                    if reqstyle in self.mapfactory.aggregatestyles.keys():
-                        for stylename in self.mapfactory.aggregatestyles[reqstyle]:
-                            layer.styles.append(stylename)
-                    else:
-                        layer.styles.append(reqstyle)
-
-                    for stylename in layer.styles:
-                        if stylename in self.mapfactory.styles.keys():
-                            m.append_style(stylename, self.mapfactory.styles[stylename])
-                        else:
-                            raise ServerConfigurationError('Layer "%s" refers to non-existent style "%s".' % (layername, stylename))
-                
-                m.layers.append(layer)
-        m.zoom_to_box(Envelope(params['bbox'][0], params['bbox'][1], params['bbox'][2], params['bbox'][3]))
-        return m
+                    raise OGCException('Invalid style "%s" requested for layer "%s".' % (reqstyle, layername), 'StyleNotDefined')
+                if isinstance(styles, Exception):
+                    raise styles
+                # uses unordered dict of layers
+                # order based on params['layers'] request which
+                # should be originally informed by order of GetCaps response
+                resolved.append((self.mapfactory.layers[layername], styles))
+        return resolved
 
 class BaseExceptionHandler:
 
@@ -574,6 +999,48 @@ class Projection(MapnikProjection):
     def epsgstring(self):
         return self.params().split('=')[1].upper()
 
+_local = threading.local()
+
+def cache_only(enabled):
+    """ Makes the service handlers raise L{RenderDeferred} on this thread,
+        rather than render a map or build a capabilities document, so that
+        a front-end can answer from the caches and hand the rest over to
+        render threads.
+    """
+    _local.cacheonly = enabled
+
+def check_render():
+    if getattr(_local, 'cacheonly', False):
+        raise RenderDeferred()
+
+def check_lookup(cache):
+    """ Raises L{RenderDeferred} under L{cache_only} when a lookup in cache
+        may block, so that a front-end only answers from the caches in its
+        own memory.  Caches shared between processes live outside of it, in
+        files or on other hosts.
+    """
+    if cache.shared:
+        check_render()
+
+def ignores_axis_order(useragent):
+    """ Returns whether the client sending the User-Agent header useragent
+        is known to send WMS 1.3.0 bboxes in x, y order whatever the CRS.
+    """
+    # MapInfo Pro 10 does not "know" this is the way and gets messed up
+    return 'mapinfo' in useragent.lower()
+
+def thread_projection(params):
+    """ Returns the L{Projection} for the proj4 params, built once per
+        thread as proj4 projections must not be shared between threads.
+    """
+    projections = getattr(_local, 'projections', None)
+    if projections is None:
+        projections = _local.projections = {}
+    proj = projections.get(params)
+    if proj is None:
+        proj = projections[params] = Projection(params)
+    return proj
+
 class TextFeatureInfo:
 
     def __init__(self):
@@ -0,0 +1,51 @@
+"""Service handler dispatch shared by the WSGI, CGI and mod_python front-ends."""
+
+from ogcserver import WMS, wmts
+from ogcserver.exceptions import OGCException
+
+# service name -> handler factory, resolved once at import time so that no
+# request goes through the import machinery
+SERVICE_FACTORIES = {
+    'WMS': WMS.ServiceHandlerFactory,
+    'WMTS': wmts.ServiceHandlerFactory,
+}
+
+class ServiceHandlerCache:
+
+    def __init__(self, conf, mapfactory, maxsize=32, factories=None):
+        """ A small keyed cache of ready to use service handlers.
+
+            Handlers only hold settings derived from the configuration and
+            the map factory, so one instance per (service, onlineresource,
+            version) can serve any number of requests.
+
+            @param maxsize: Number of handlers kept before the cache is
+                            flushed.  The online resource may be guessed
+                            from the Host header, so the key space is not
+                            under the server's control.
+            @type maxsize: Integer.
+
+            @param factories: Service name to handler factory mapping,
+                              defaults to L{SERVICE_FACTORIES}.
+            @type factories: A python dict.
+        """
+        if factories is None:
+            factories = SERVICE_FACTORIES
+        self.factories = dict(factories)
+        self.conf = conf
+        self.mapfactory = mapfactory
+        self.maxsize = maxsize
+        self.handlers = {}
+
+    def __call__(self, service, onlineresource, version):
+        key = (service, onlineresource, version)
+        servicehandler = self.handlers.get(key)
+        if servicehandler is None:
+            ServiceHandlerFactory = self.factories.get(service)
+            if ServiceHandlerFactory is None:
+                raise OGCException('Unsupported service "%s".' % service)
+            servicehandler = ServiceHandlerFactory(self.conf, self.mapfactory, onlineresource, version)
+            if len(self.handlers) >= self.maxsize:
+                self.handlers.clear()
+            self.handlers[key] = servicehandler
+        return servicehandler
@@ -0,0 +1,376 @@
+"""Event loop HTTP front-end answering cheap requests apart from renders."""
+
+import os
+import sys
+import errno
+import fcntl
+import Queue
+import select
+import urllib
+import time
+import socket
+import threading
+import traceback
+from collections import deque
+from cStringIO import StringIO
+
+from ogcserver.common import cache_only
+from ogcserver.exceptions import RenderDeferred
+
+# largest request head accepted, WMS requests are GETs without a body
+MAX_REQUEST_HEAD = 64 * 1024
+
+class _Connection:
+
+    def __init__(self, sock, address, deadline):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.inbuf = ''
+        self.outbuf = None
+        # set once the request was read, while it is answered
+        self.busy = False
+        # time by which the request must be read or the response sent
+        self.deadline = deadline
+        # the events the connection is registered for, 0 if it is not
+        self.events = 0
+
+class _Poller:
+    """ Waits for readiness of any number of file descriptors, with epoll
+        where available and poll otherwise.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.IN, self.OUT = select.EPOLLIN, select.EPOLLOUT
+            # seconds
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.IN, self.OUT = select.POLLIN, select.POLLOUT
+            # milliseconds
+            self.scale = 1000
+
+    def register(self, fd, events):
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            if self.scale == 1:
+                return self.poller.poll(timeout)
+            return self.poller.poll(int(timeout * self.scale))
+        except (IOError, OSError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self.poller, 'close'):
+            self.poller.close()
+
+class EventLoopServer:
+
+    def __init__(self, application, host, port, threads=4, queuesize=64, timeout=30, maxconnections=1000, multiprocess=False):
+        """ A single threaded HTTP server that calls the WSGI application on
+            its event loop with L{ogcserver.common.cache_only} set.  Requests
+            answered from the caches, capabilities documents and errors are
+            sent right away, those that need a render are queued for a pool
+            of render threads, so that they never hold up the cheap ones.
+
+            Connections are closed after every response.
+
+            @param threads: Number of render threads.
+            @type threads: Integer.
+
+            @param queuesize: Number of requests waiting for a render thread
+                              past which further ones are answered with 503
+                              Service Unavailable.
+            @type queuesize: Integer.
+
+            @param timeout: Seconds a client has to send its request, and to
+                            read the response, before it is disconnected.
+            @type timeout: Number.
+
+            @param maxconnections: Number of open connections past which
+                                   new ones are closed at once.
+            @type maxconnections: Integer.
+
+            @param multiprocess: Whether other processes serve the same
+                                 application, for the WSGI environ.
+            @type multiprocess: Boolean.
+        """
+        self.application = application
+        self.threads = threads
+        self.queuesize = queuesize
+        self.timeout = timeout
+        self.maxconnections = maxconnections
+        self.multiprocess = multiprocess
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(128)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.connections = {}
+        self.stopping = False
+
+    def serve_forever(self):
+        # the loop and its threads belong to the process serving, which is
+        # not the one that bound the socket in prefork mode
+        self.requests = Queue.Queue(self.queuesize)
+        # responses of the render threads, for the loop to send
+        self.done = deque()
+        self.wakeup, self.wakeupwrite = os.pipe()
+        for fd in (self.wakeup, self.wakeupwrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller = _Poller()
+        self.poller.register(self.socket.fileno(), self.poller.IN)
+        self.poller.register(self.wakeup, self.poller.IN)
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._render_thread)
+            thread.daemon = True
+            thread.start()
+        try:
+            lastsweep = time.time()
+            while not self.stopping:
+                self._step(0.5)
+                if time.time() - lastsweep >= 1:
+                    self._sweep()
+                    lastsweep = time.time()
+        finally:
+            for i in range(self.threads):
+                self.requests.put(None)
+            for conn in self.connections.values():
+                conn.sock.close()
+            self.connections.clear()
+            self.poller.close()
+            os.close(self.wakeup)
+            os.close(self.wakeupwrite)
+
+    def shutdown(self):
+        self.stopping = True
+
+    def server_close(self):
+        self.socket.close()
+
+    def _step(self, timeout):
+        for fd, events in self.poller.poll(timeout):
+            if fd == self.socket.fileno():
+                self._accept()
+            elif fd == self.wakeup:
+                self._collect()
+            else:
+                conn = self.connections.get(fd)
+                if conn is None:
+                    continue
+                if conn.outbuf:
+                    self._write(conn)
+                else:
+                    self._read(conn)
+
+    def _sweep(self):
+        """ Closes the connections of clients too slow to send their request
+            or read the response.
+        """
+        now = time.time()
+        for conn in self.connections.values():
+            if not conn.busy and conn.deadline < now:
+                self._close(conn)
+
+    def _update(self, conn):
+        """ Registers conn for the events it waits for: reading its request,
+            sending its response or none while it is answered.
+        """
+        if conn.outbuf:
+            events = self.poller.OUT
+        elif conn.busy:
+            events = 0
+        else:
+            events = self.poller.IN
+        if events == conn.events:
+            return
+        if not events:
+            self.poller.unregister(conn.fd)
+        elif not conn.events:
+            self.poller.register(conn.fd, events)
+        else:
+            self.poller.modify(conn.fd, events)
+        conn.events = events
+
+    def _respondWith(self, conn, data):
+        conn.outbuf = data
+        conn.busy = False
+        conn.deadline = time.time() + self.timeout
+        self._update(conn)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                    return
+                raise
+            if len(self.connections) >= self.maxconnections:
+                sock.close()
+                continue
+            sock.setblocking(0)
+            conn = _Connection(sock, address, time.time() + self.timeout)
+            self.connections[conn.fd] = conn
+            self._update(conn)
+
+    def _close(self, conn):
+        if conn.events:
+            self.poller.unregister(conn.fd)
+            conn.events = 0
+        self.connections.pop(conn.fd, None)
+        conn.sock.close()
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(8192)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._close(conn)
+            return
+        conn.inbuf += data
+        end = conn.inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(conn.inbuf) > MAX_REQUEST_HEAD:
+                self._respondWith(conn, _error('431 Request Header Fields Too Large'))
+            return
+        environ = self._environ(conn, conn.inbuf[:end])
+        conn.inbuf = ''
+        if environ is None:
+            self._respondWith(conn, _error('400 Bad Request'))
+            return
+        conn.busy = True
+        cache_only(True)
+        try:
+            self._respondWith(conn, self._respond(environ))
+        except RenderDeferred:
+            try:
+                self.requests.put_nowait((conn, environ))
+                self._update(conn)
+            except Queue.Full:
+                self._respondWith(conn, _error('503 Service Unavailable', [('Retry-After', '1')]))
+        finally:
+            cache_only(False)
+
+    def _write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._close(conn)
+            return
+        conn.outbuf = conn.outbuf[sent:]
+        if not conn.outbuf:
+            self._close(conn)
+
+    def _collect(self):
+        try:
+            while os.read(self.wakeup, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while self.done:
+            conn, data = self.done.popleft()
+            # the descriptor of a connection closed meanwhile may be reused
+            if self.connections.get(conn.fd) is conn:
+                self._respondWith(conn, data)
+
+    def _render_thread(self):
+        while True:
+            job = self.requests.get()
+            if job is None:
+                return
+            conn, environ = job
+            try:
+                data = self._respond(environ)
+            except:
+                traceback.print_exc()
+                data = _error('500 Internal Server Error')
+            self.done.append((conn, data))
+            try:
+                os.write(self.wakeupwrite, 'x')
+            except OSError:
+                # the loop has been woken already, or is gone
+                pass
+
+    def _environ(self, conn, head):
+        lines = head.split('\r\n')
+        try:
+            method, uri, protocol = lines[0].split()
+        except ValueError:
+            return None
+        if '?' in uri:
+            path, query = uri.split('?', 1)
+        else:
+            path, query = uri, ''
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': str(self.server_address[1]),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': conn.address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(''),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.multiprocess,
+            'wsgi.run_once': False,
+        }
+        for line in lines[1:]:
+            if ':' not in line:
+                continue
+            name, value = line.split(':', 1)
+            name = name.strip().upper().replace('-', '_')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value.strip()
+            else:
+                environ['HTTP_' + name] = value.strip()
+        if 'HTTP_HOST' not in environ:
+            environ['HTTP_HOST'] = '%s:%s' % (self.server_name, self.server_address[1])
+        return environ
+
+    def _respond(self, environ):
+        """ Returns the HTTP response of the application to environ. """
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+        result = self.application(environ, start_response)
+        try:
+            body = ''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers = started
+        head = ['HTTP/1.0 %s' % status]
+        for name, value in headers:
+            head.append('%s: %s' % (name, value))
+        head.append('Connection: close')
+        return '\r\n'.join(head) + '\r\n\r\n' + body
+
+def _error(status, headers=()):
+    head = ['HTTP/1.0 %s' % status, 'Content-Type: text/plain', 'Content-Length: %d' % len(status), 'Connection: close']
+    for name, value in headers:
+        head.append('%s: %s' % (name, value))
+    return '\r\n'.join(head) + '\r\n\r\n' + status
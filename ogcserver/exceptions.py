@@ -3,5 +3,11 @@
 class OGCException(Exception):
     pass
 
+class RenderTimeout(OGCException):
+    pass
+
+class RenderDeferred(Exception):
+    pass
+
 class ServerConfigurationError(Exception):
     pass
\ No newline at end of file
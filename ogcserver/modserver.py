@@ -4,7 +4,8 @@ import sys
 from mod_python import apache, util
 
 from ogcserver.common import Version
-from ogcserver.configparser import SafeConfigParser
+from ogcserver.settings import load_settings
+from ogcserver.dispatch import ServiceHandlerCache
 from ogcserver.wms111 import ExceptionHandler as ExceptionHandler111
 from ogcserver.wms130 import ExceptionHandler as ExceptionHandler130
 from ogcserver.exceptions import OGCException, ServerConfigurationError
@@ -12,25 +13,23 @@ from ogcserver.exceptions import OGCException, ServerConfigurationError
 
 class ModHandler(object):
     def __init__(self, configpath):
-        conf = SafeConfigParser()
-        conf.readfp(open(configpath))
-        self.conf = conf
-        if not conf.has_option_with_value('server', 'module'):
+        settings = load_settings(configpath)
+        self.conf = settings.conf
+        if not settings.module:
             raise ServerConfigurationError('The factory module is not defined in the configuration file.')
         try:
-            mapfactorymodule = __import__(conf.get('server', 'module'))
+            mapfactorymodule = __import__(settings.module)
         except ImportError:
             raise ServerConfigurationError('The factory module could not be loaded.')
         if hasattr(mapfactorymodule, 'WMSFactory'):
             self.mapfactory = getattr(mapfactorymodule, 'WMSFactory')()
         else:
             raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
-        if conf.has_option('server', 'debug'):
-            self.debug = int(conf.get('server', 'debug'))
-        else:
-            self.debug = 0
-        if self.conf.has_option_with_value('server', 'maxage'):
-            self.max_age = 'max-age=%d' % self.conf.get('server', 'maxage')
+        self.settings = settings
+        self.debug = settings.debug
+        self.servicehandlers = ServiceHandlerCache(settings, self.mapfactory)
+        if settings.maxage is not None:
+            self.max_age = 'max-age=%d' % settings.maxage
         else:
             self.max_age = None
 
@@ -57,12 +56,7 @@ class ModHandler(object):
                     service = reqparams['service']
                 if reqparams.has_key('service'):
                     del reqparams['service']
-                try:
-                    ogcserver = __import__('ogcserver.' + service)
-                except:
-                    raise OGCException('Unsupported service "%s".' % service)
-                ServiceHandlerFactory = getattr(ogcserver, service).ServiceHandlerFactory
-                servicehandler = ServiceHandlerFactory(self.conf, self.mapfactory, onlineresource, reqparams.get('version', None))
+                servicehandler = self.servicehandlers(service, onlineresource, reqparams.get('version', None))
                 if reqparams.has_key('version'):
                     del reqparams['version']
                 if request not in servicehandler.SERVICE_PARAMS.keys():
@@ -82,7 +76,7 @@ class ModHandler(object):
             return self.traceback(apacheReq,E)
 
         if self.max_age:
-            apacheReq.headers_out.add('Cache-Control', max_age)
+            apacheReq.headers_out.add('Cache-Control', self.max_age)
         apacheReq.headers_out.add('Content-Length', str(len(response.content)))
         apacheReq.send_http_header()
         apacheReq.write(response.content)
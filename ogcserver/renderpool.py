@@ -0,0 +1,374 @@
+"""Pool of forked processes that render maps under a wall-clock timeout."""
+
+import os
+import sys
+import mmap
+import time
+import errno
+import Queue
+import atexit
+import select
+import signal
+import shutil
+import socket
+import struct
+import tempfile
+import cPickle as pickle
+import threading
+import resource
+from traceback import format_exception_only
+
+from ogcserver.exceptions import OGCException, RenderTimeout, ServerConfigurationError
+
+class RenderPool:
+
+    def __init__(self, mapfactory, processes, timeout=0, maxrenders=0, maxrss=0, shmbytes=0):
+        """ Runs renders in worker processes forked from this one, so that
+            a render that does not finish in time can be killed.
+
+            Workers are forked by L{start} in each process calling the
+            pool, with the loaded map factory shared copy-on-write.  A worker
+            is replaced when it is killed or dies, and after a number of
+            renders or once it grew past a memory limit, to contain leaks in
+            datasource plugins.
+
+            Workers are not forked from the calling process itself, whose
+            request threads may hold locks at that moment that would never
+            be released in the copy.  start() forks a single threaded
+            process that forks every worker, replacements included.
+
+            @param processes: Number of worker processes.
+            @type processes: Integer.
+
+            @param timeout: Seconds a render may take before its worker is
+                            killed, 0 for no limit.
+            @type timeout: Number.
+
+            @param maxrenders: Renders after which a worker is replaced, 0
+                               for no limit.
+            @type maxrenders: Integer.
+
+            @param maxrss: Resident size in bytes past which a worker is
+                           replaced after its current render, 0 for no
+                           limit.
+            @type maxrss: Integer.
+
+            @param shmbytes: Size in bytes of the slot of shared memory each
+                             worker writes its encoded images to, rather
+                             than pickling them over the socket.  Larger
+                             results are still pickled, 0 pickles all.
+            @type shmbytes: Integer.
+        """
+        self.mapfactory = mapfactory
+        self.processes = processes
+        self.timeout = timeout
+        self.maxrenders = maxrenders
+        self.maxrss = maxrss
+        self.shmbytes = shmbytes
+        self.lock = threading.Lock()
+        # the process owning the workers, a forked child starts its own
+        self.pid = None
+        self.idle = None
+        self.forker = None
+        # one slot of shmbytes per worker, mapped before the workers are
+        # forked so that they share it with this process
+        self.shm = None
+
+    def start(self):
+        """ Forks the workers for the calling process.  To be called by
+            every process serving requests before it starts any threads;
+            otherwise the first call does it, provided the process still
+            runs a single thread.
+        """
+        idle = self._idle(True)
+        slots = [idle.get() for i in range(self.processes)]
+        try:
+            for index, (slot, worker) in enumerate(slots):
+                if worker is None:
+                    slots[index] = (slot, _Worker(self, slot))
+        finally:
+            for slot in slots:
+                idle.put(slot)
+
+    def call(self, handler, methodname, *args):
+        """ Returns getattr(handler, methodname)(*args) as run by a worker
+            on an alike handler.  args are pickled, and so is the result
+            unless it is passed through shared memory.
+
+            @raise RenderTimeout: If the worker took longer than the timeout.
+        """
+        idle = self._idle()
+        # blocks while every worker is busy
+        slot, worker = idle.get()
+        try:
+            if worker is None:
+                worker = _Worker(self, slot)
+            try:
+                _send(worker.sock, (handler.__class__, handler.opsonlineresource, methodname, args))
+                status, result, exiting = _recv(worker.sock, self.timeout)
+            except _Timeout:
+                worker.kill()
+                worker = None
+                raise RenderTimeout('Rendering the map took longer than %s seconds.' % self.timeout)
+            except (EOFError, socket.error):
+                worker.reap()
+                worker = None
+                raise RuntimeError('The render process died.')
+            if status == 'ok':
+                # copied out before the worker may write to the slot again
+                result = self._unshare(result, slot)
+            if exiting:
+                worker.reap()
+                worker = None
+        finally:
+            idle.put((slot, worker))
+        if status == 'error':
+            raise result
+        return result
+
+    def _idle(self, starting=False):
+        with self.lock:
+            if self.pid != os.getpid():
+                if not starting and threading.active_count() > 1:
+                    # a fork would copy the locks other threads hold, which
+                    # the forker and its workers could then wait on forever
+                    raise ServerConfigurationError('The render processes must be started with ogcserver.server.start_render_pool before the process serving requests starts threads.')
+                # workers inherited from a parent are not ours to use
+                self.pid = os.getpid()
+                self.idle = Queue.Queue()
+                for slot in range(self.processes):
+                    # forked on first use
+                    self.idle.put((slot, None))
+                if self.shmbytes:
+                    self.shm = mmap.mmap(-1, self.processes * self.shmbytes)
+                # after the shared memory was mapped, for the workers to
+                # inherit it
+                self.forker = _Forker(self)
+            return self.idle
+
+    def _share(self, result, slot):
+        """ Returns result with the string, or the strings of a dict, it
+            is made of written to the shared memory slot and replaced by
+            L{_Shared} references, if they fit.
+        """
+        if self.shm is None:
+            return result
+        if isinstance(result, str):
+            items = [(None, result)]
+        elif isinstance(result, dict) and all([isinstance(value, str) for value in result.itervalues()]):
+            items = result.items()
+        else:
+            return result
+        if sum([len(value) for key, value in items]) > self.shmbytes:
+            return result
+        shared = {}
+        offset = slot * self.shmbytes
+        for key, value in items:
+            self.shm[offset:offset + len(value)] = value
+            shared[key] = _Shared(offset, len(value))
+            offset += len(value)
+        if isinstance(result, str):
+            return shared[None]
+        return shared
+
+    def _unshare(self, result, slot):
+        # slicing copies, Python 2 cannot wrap an mmap in a memoryview
+        if isinstance(result, _Shared):
+            return self.shm[result.offset:result.offset + result.length]
+        if isinstance(result, dict):
+            for key, value in result.items():
+                if isinstance(value, _Shared):
+                    result[key] = self.shm[value.offset:value.offset + value.length]
+        return result
+
+    def _serve(self, sock, slot):
+        """ The loop of a worker, answering jobs until the pool goes away
+            or the worker is to be recycled.
+        """
+        handlers = {}
+        renders = 0
+        while True:
+            try:
+                handlerclass, onlineresource, methodname, args = _recv(sock)
+            except (EOFError, socket.error):
+                return
+            handler = handlers.get((handlerclass, onlineresource))
+            if handler is None:
+                handler = handlers[(handlerclass, onlineresource)] = handlerclass(self.mapfactory.conf, self.mapfactory, onlineresource)
+            try:
+                result = getattr(handler, methodname)(*args)
+                # buffered cache writes would be lost if the worker is
+                # killed later on
+                cache = getattr(self.mapfactory, 'response_cache', None)
+                if cache is not None:
+                    cache.flush()
+                reply = ('ok', self._share(result, slot))
+            except OGCException, e:
+                reply = ('error', e)
+            except:
+                reply = ('error', RuntimeError(''.join(format_exception_only(*sys.exc_info()[:2])).strip()))
+            renders += 1
+            exiting = bool((self.maxrenders and renders >= self.maxrenders) or (self.maxrss and _rss() > self.maxrss))
+            _send(sock, reply + (exiting,))
+            if exiting:
+                return
+
+class _Shared:
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+class _Forker:
+
+    def __init__(self, pool):
+        """ The single threaded process forking the workers of pool.  They
+            connect back to the calling process over a unix socket, as
+            Python 2 cannot pass a socket between processes.
+        """
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.tmpdir = tempfile.mkdtemp(prefix='ogcserver-render-')
+        path = os.path.join(self.tmpdir, 'socket')
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(pool.processes)
+        parentsock, childsock = socket.socketpair()
+        forkerpid = os.fork()
+        if forkerpid == 0:
+            parentsock.close()
+            self.listener.close()
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                # exited workers are reaped by the system
+                signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+                self._serve(pool, childsock, path)
+            finally:
+                os._exit(0)
+        childsock.close()
+        self.sock = parentsock
+        atexit.register(self.close)
+
+    def _serve(self, pool, sock, path):
+        while True:
+            try:
+                slot = _recv(sock)
+            except (EOFError, socket.error):
+                # the process owning the pool is gone
+                return
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                try:
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    workersock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    workersock.connect(path)
+                    pool._serve(workersock, slot)
+                finally:
+                    # flush buffered cache writes, and never return into the
+                    # code of the process that forked us
+                    try:
+                        atexit._run_exitfuncs()
+                    finally:
+                        os._exit(0)
+            _send(sock, pid)
+
+    def spawn(self, slot):
+        """ Returns the pid of a new worker for slot and the socket to it. """
+        with self.lock:
+            _send(self.sock, slot)
+            pid = _recv(self.sock)
+            workersock, address = self.listener.accept()
+        return pid, workersock
+
+    def close(self):
+        if os.getpid() != self.pid:
+            return
+        self.sock.close()
+        self.listener.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+class _Worker:
+
+    def __init__(self, pool, slot):
+        self.pid, self.sock = pool.forker.spawn(slot)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.reap()
+
+    def reap(self):
+        # the worker is a child of the forker, which reaps it
+        self.sock.close()
+
+class _Timeout(Exception):
+    pass
+
+def _send(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+def _recv(sock, timeout=0):
+    deadline = timeout and time.time() + timeout
+    length = struct.unpack('!I', _read(sock, 4, deadline))[0]
+    return pickle.loads(_read(sock, length, deadline))
+
+def _read(sock, size, deadline):
+    chunks = []
+    while size:
+        if deadline:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise _Timeout()
+            try:
+                readable = select.select([sock], [], [], remaining)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                raise _Timeout()
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def _rss():
+    """ Returns the resident size of this process in bytes. """
+    try:
+        return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # the peak size, in kilobytes on Linux and bytes on OS X
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return maxrss
+        return maxrss * 1024
+
+def _option(conf, option, cast):
+    if not conf.has_option('server', option) or not conf.get('server', option):
+        return 0
+    try:
+        return cast(conf.get('server', option))
+    except ValueError:
+        raise ServerConfigurationError('Configuration parameter [server]->%s has an invalid value: %s.' % (option, conf.get('server', option)))
+
+def render_pool_from_config(conf, mapfactory):
+    """ Returns the L{RenderPool} configured in the [server] section of conf,
+        or None if maps are rendered by the process serving the request.
+    """
+    if conf is None:
+        return None
+    processes = _option(conf, 'renderprocesses', int)
+    if not processes:
+        return None
+    return RenderPool(mapfactory, processes,
+                      timeout=_option(conf, 'rendertimeout', float),
+                      maxrenders=_option(conf, 'renderrecycle', int),
+                      maxrss=_option(conf, 'rendermaxrss', int) * 1024 * 1024,
+                      shmbytes=_option(conf, 'rendershm', int) * 1024 * 1024)
@@ -0,0 +1,238 @@
+"""Pre-renders tile pyramids into the configured response cache."""
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+
+from mapnik import Coord
+
+from ogcserver.common import Projection, Version
+from ogcserver.WMS import BaseWMSFactory
+from ogcserver.dispatch import SERVICE_FACTORIES
+from ogcserver.settings import load_settings
+from ogcserver.tiles import GRIDS, intersects
+from ogcserver.exceptions import ServerConfigurationError
+
+# the mercator grid stops short of the poles
+MAX_MERCATOR_LATITUDE = 85.0511287798
+
+class Seeder:
+
+    def __init__(self, mapfile, configfile, service='WMS', version='1.1.1', layers=None, format='image/png'):
+        """ Renders single tiles into the response cache through the same
+            service handlers, and so under the same cache keys, as the
+            requests of a client of the given service and version.
+
+            @param layers: Names of the layers to seed, all layers if None.
+                           For WMS they are requested together as one map,
+                           for WMTS each layer is a tile of its own.
+            @type layers: A python list.
+        """
+        self.settings = load_settings(configfile)
+        self.mapfactory = BaseWMSFactory(self.settings)
+        self.mapfactory.loadXML(mapfile)
+        self.mapfactory.finalize()
+        if self.mapfactory.response_cache is None:
+            raise ServerConfigurationError('Seeding requires a cache to be configured in the [cache] section.')
+        if not self.mapfactory.response_cache.shared:
+            # the tiles would be rendered into caches that go away with the
+            # seeding processes
+            raise ServerConfigurationError('Seeding requires a cache shared between processes, [cache]->type must not be memory.')
+        if service not in SERVICE_FACTORIES:
+            raise ServerConfigurationError('Unsupported service "%s".' % service)
+        self.service = service
+        self.version = version
+        self.servicehandler = SERVICE_FACTORIES[service](self.settings, self.mapfactory, self.settings.baseurl or 'http://localhost/?', version)
+        if layers:
+            for layername in layers:
+                if layername not in self.mapfactory.layers:
+                    raise ServerConfigurationError('Layer "%s" is not defined.' % layername)
+            self.layers = list(layers)
+        else:
+            self.layers = [layer.name for layer in self.mapfactory.ordered_layers if not hasattr(layer, 'meta_style')]
+        self.format = format
+
+    def to_grid(self, grid, proj, bbox):
+        """ Returns bbox, given in the projection proj, in the CRS of grid. """
+        ll = proj.inverse(Coord(bbox[0], bbox[1]))
+        ur = proj.inverse(Coord(bbox[2], bbox[3]))
+        if grid.crs == 'epsg:3857':
+            ll.y = max(ll.y, -MAX_MERCATOR_LATITUDE)
+            ur.y = min(ur.y, MAX_MERCATOR_LATITUDE)
+        gridproj = Projection('+init=%s' % grid.crs)
+        ll = gridproj.forward(ll)
+        ur = gridproj.forward(ur)
+        return [ll.x, ll.y, ur.x, ur.y]
+
+    def envelopes(self, grid):
+        """ Returns the envelopes of the seeded layers in the CRS of grid. """
+        envelopes = []
+        for layername in self.layers:
+            layer = self.mapfactory.layers[layername]
+            env = self.mapfactory.envelope(layer)
+            envelopes.append(self.to_grid(grid, self.mapfactory.projection(layer.srs), [env.minx, env.miny, env.maxx, env.maxy]))
+        return envelopes
+
+    def units(self, grid, bbox, zooms):
+        """ Returns the list of (z, x, y) tiles to render, one per metatile,
+            and the number of tiles they cover.  Tiles that miss every
+            layer envelope are skipped.
+        """
+        envelopes = self.envelopes(grid)
+        size = max(1, self.settings.metatile)
+        units = []
+        count = 0
+        for z in zooms:
+            tilerange = grid.tile_range(bbox, z)
+            if tilerange is None:
+                continue
+            minx, miny, maxx, maxy = tilerange
+            for metay in range(miny - miny % size, maxy + 1, size):
+                for metax in range(minx - minx % size, maxx + 1, size):
+                    tiles = []
+                    for y in range(max(metay, miny), min(metay + size, maxy + 1)):
+                        for x in range(max(metax, minx), min(metax + size, maxx + 1)):
+                            tilebbox = grid.tile_bbox(z, x, y)
+                            for env in envelopes:
+                                if intersects(tilebbox, env):
+                                    tiles.append((z, x, y))
+                                    break
+                    if tiles:
+                        units.append(tiles[0])
+                        count += len(tiles)
+        return units, count
+
+    def seed(self, grid, z, x, y):
+        """ Renders tile (z, x, y) of grid, and with it the rest of its
+            metatile, unless it is already cached.
+        """
+        if self.service == 'WMTS':
+            for layername in self.layers:
+                params = self.servicehandler.processParameters('GetTile', {
+                    'layer': layername, 'style': 'default', 'tilematrixset': grid.name,
+                    'tilematrix': str(z), 'tilecol': str(x), 'tilerow': str(y), 'format': self.format})
+                self.servicehandler.GetTile(params)
+        else:
+            if Version(self.version) >= '1.3.0':
+                crsparam = 'crs'
+            else:
+                crsparam = 'srs'
+            params = self.servicehandler.processParameters('GetMap', {
+                crsparam: grid.crs.upper(),
+                'bbox': ','.join([repr(value) for value in grid.tile_bbox(z, x, y)]),
+                'width': str(grid.tilesize), 'height': str(grid.tilesize),
+                'layers': ','.join(self.layers), 'styles': '', 'format': self.format})
+            params['HTTP_USER_AGENT'] = ''
+            params['bbox'] = self.servicehandler._swapAxes(params, params['bbox'])
+            self.servicehandler.GetMap(params)
+        cache = self.mapfactory.response_cache
+        if hasattr(cache, 'flush'):
+            # pool workers exit without running atexit handlers
+            cache.flush()
+
+_seeder = None
+
+def _init_worker(args):
+    global _seeder
+    _seeder = Seeder(*args)
+
+def _seed_unit(unit):
+    gridcrs, z, x, y = unit
+    _seeder.seed(GRIDS[gridcrs], z, x, y)
+    return unit
+
+def _read_progress(path, parameters):
+    """ Returns the units the progress file at path records as rendered,
+        and whether it records the parameters of its run yet.
+
+        @raise ServerConfigurationError: If the file records a run with
+                                         other parameters, whose units
+                                         need not be those of this one.
+    """
+    done = set()
+    recorded = None
+    if path and os.path.exists(path):
+        for line in open(path):
+            if line.startswith('#'):
+                recorded = line[1:].strip()
+            elif line.strip():
+                z, x, y = map(int, line.split('/'))
+                done.add((z, x, y))
+    if (done or recorded is not None) and recorded != parameters:
+        raise ServerConfigurationError('The progress file "%s" records a run with other parameters, remove it to seed from scratch.' % path)
+    return done, recorded is not None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-renders tiles into the cache configured for the ogcserver')
+    parser.add_argument('mapfile', help='A XML mapnik stylesheet')
+    parser.add_argument('-c', '--config', dest='configfile', required=True, help='Path to the config file, with a [cache] section.')
+    parser.add_argument('-l', '--layers', help='Comma separated names of the layers to seed, all by default.')
+    parser.add_argument('-b', '--bbox', help='Area to seed as minlon,minlat,maxlon,maxlat, the extent of the layers by default.')
+    parser.add_argument('-z', '--zoom', default='0-5', help='Zoom level or inclusive range of levels, for example 0-8.')
+    parser.add_argument('-g', '--grid', default='epsg:3857', choices=sorted(GRIDS), help='Tile grid to seed.')
+    parser.add_argument('-f', '--format', default='image/png', help='Image format of the tiles.')
+    parser.add_argument('-s', '--service', default='WMS', choices=('WMS', 'WMTS'), help='Service whose requests are seeded.')
+    parser.add_argument('-v', '--version', default='1.1.1', help='WMS version whose requests are seeded.')
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count(), help='Number of rendering processes.')
+    parser.add_argument('-p', '--progress', help='File recording the rendered tiles, an interrupted run resumes from it when given the same arguments.')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Only print the number of tiles to render.')
+    args = parser.parse_args(argv)
+
+    layers = None
+    if args.layers:
+        layers = [layername.strip() for layername in args.layers.split(',')]
+    zooms = [int(z) for z in args.zoom.split('-')]
+    zooms = range(zooms[0], zooms[-1] + 1)
+    grid = GRIDS[args.grid]
+
+    seederargs = (args.mapfile, args.configfile, args.service, args.version, layers, args.format)
+    seeder = Seeder(*seederargs)
+    if args.bbox:
+        bbox = seeder.to_grid(grid, Projection('+init=epsg:4326'), [float(value) for value in args.bbox.split(',')])
+    else:
+        bbox = grid.extent
+    units, count = seeder.units(grid, bbox, zooms)
+    # the update sequence follows the mapfile and the configuration, the
+    # metatile size among them
+    parameters = json.dumps({
+        'service': args.service,
+        'version': args.version,
+        'grid': args.grid,
+        'layers': seeder.layers,
+        'format': args.format,
+        'zooms': zooms,
+        'bbox': bbox,
+        'updatesequence': seeder.mapfactory.updatesequence,
+    }, sort_keys=True)
+    done, recorded = _read_progress(args.progress, parameters)
+    todo = [(args.grid,) + unit for unit in units if unit not in done]
+    print '%d tiles in %d renders, %d renders left' % (count, len(units), len(todo))
+    if args.dry_run or not todo:
+        return 0
+
+    if args.progress:
+        progress = open(args.progress, 'a')
+        if not recorded:
+            progress.write('# %s\n' % parameters)
+            progress.flush()
+    else:
+        progress = None
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes, _init_worker, (seederargs,))
+        results = pool.imap_unordered(_seed_unit, todo)
+    else:
+        global _seeder
+        _seeder = seeder
+        results = (_seed_unit(unit) for unit in todo)
+    for index, (gridcrs, z, x, y) in enumerate(results):
+        if progress is not None:
+            progress.write('%d/%d/%d\n' % (z, x, y))
+            progress.flush()
+        sys.stderr.write('\r%d/%d' % (index + 1, len(todo)))
+    sys.stderr.write('\n')
+    if args.processes > 1:
+        pool.close()
+        pool.join()
+    return 0
@@ -0,0 +1,208 @@
+"""Standalone HTTP serving of the WSGI application for bin/ogcserver."""
+
+import gc
+import os
+import sys
+import time
+import errno
+import signal
+import atexit
+import Queue
+import threading
+import traceback
+from wsgiref.simple_server import make_server, WSGIServer
+
+# a worker that dies sooner than this after being forked is replaced only
+# after a pause, so that a broken setup does not fork in a tight loop
+MIN_WORKER_LIFETIME = 1.0
+
+# without gc.freeze the oldest generation of a worker holds everything it
+# inherited, only collected once per this many collections of the middle one
+WORKER_GC_THRESHOLD2 = 1000
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """ A WSGIServer handling requests from a fixed number of threads.
+
+        The application is called concurrently, which L{ogcserver.wsgi.WSGIApp}
+        supports: maps are assembled, rendered and pooled within one thread
+        and mapnik releases the interpreter lock while rendering.
+    """
+
+    threads = 4
+
+    def serve_forever(self, *args):
+        # the threads are started by the process serving, which is not the
+        # one that bound the socket in prefork mode
+        self.requests = Queue.Queue(self.threads)
+        for i in range(self.threads):
+            thread = threading.Thread(target=self.process_requests)
+            thread.daemon = True
+            thread.start()
+        WSGIServer.serve_forever(self, *args)
+
+    def process_request(self, request, client_address):
+        # blocks while every thread is busy, leaving further connections
+        # in the listen backlog
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+def make_threaded_server(host, port, application, threads=1):
+    """ Returns a wsgiref server for application answering from the given
+        number of threads.
+    """
+    if threads <= 1:
+        return make_server(host, port, application)
+    class server_class(ThreadPoolWSGIServer):
+        pass
+    server_class.threads = threads
+    return make_server(host, port, application, server_class=server_class)
+
+def make_http_server(host, port, application, threads=1, eventloop=False, multiprocess=False):
+    """ Returns the server answering for application in one process, an
+        L{EventLoopServer} rendering from threads if eventloop is set, or a
+        wsgiref server.
+    """
+    if eventloop:
+        from ogcserver.eventloop import EventLoopServer
+        return EventLoopServer(application, host, port, threads=threads, multiprocess=multiprocess)
+    return make_threaded_server(host, port, application, threads)
+
+class PreforkServer:
+
+    def __init__(self, application, host, port, workers, threads=1, eventloop=False):
+        """ Serves application from several worker processes forked from
+            this one, all accepting connections on the same listening socket.
+
+            Everything built before forking, the loaded mapfile and the
+            factory state of the application, is shared copy-on-write with
+            the workers rather than built once per worker.
+
+            @param workers: Number of worker processes kept running.
+            @type workers: Integer.
+
+            @param threads: Number of threads serving requests in each
+                            worker, or rendering them with eventloop.
+            @type threads: Integer.
+
+            @param eventloop: Whether workers answer on an L{EventLoopServer}.
+            @type eventloop: Boolean.
+        """
+        self.application = application
+        self.workers = workers
+        self.httpd = make_http_server(host, port, application, threads, eventloop, multiprocess=True)
+        self.server_address = self.httpd.server_address
+        # worker pid -> time it was forked
+        self.children = {}
+        self.stopping = False
+
+    def serve_forever(self):
+        """ Forks the workers and replaces those that die until shutdown()
+            is called.
+        """
+        # objects surviving a collection are moved out of the collector's
+        # reach, or its bookkeeping writes would unshare their pages
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        for i in range(self.workers):
+            self._spawn()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            sys.stderr.write('Worker %d exited with status %d, starting a new one\n' % (pid, status))
+            if time.time() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            if not self.stopping:
+                self._spawn()
+        self.httpd.server_close()
+
+    def shutdown(self):
+        """ Stops the workers, serve_forever() returns once they exited. """
+        self.stopping = True
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+        # the worker
+        status = 0
+        try:
+            try:
+                signal.signal(signal.SIGTERM, self._terminate)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                if not hasattr(gc, 'freeze'):
+                    # full collections walk, and so unshare, every
+                    # inherited object; keep them rare
+                    threshold0, threshold1, threshold2 = gc.get_threshold()
+                    gc.set_threshold(threshold0, threshold1, max(threshold2, WORKER_GC_THRESHOLD2))
+                start_render_pool(self.application)
+                self.httpd.serve_forever()
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            # flush buffered cache writes, the interpreter of the master
+            # must not be torn down from here
+            try:
+                atexit._run_exitfuncs()
+            finally:
+                os._exit(status)
+
+    def _terminate(self, signum, frame):
+        # an exception raised here could be swallowed by the error handling
+        # of a request, and shutdown() waits for serve_forever() to return
+        thread = threading.Thread(target=self.httpd.shutdown)
+        thread.daemon = True
+        thread.start()
+
+def start_render_pool(application):
+    """ Forks the render processes of application, if it renders through a
+        L{ogcserver.renderpool.RenderPool}, before the calling process starts
+        threads serving requests.
+    """
+    pool = getattr(getattr(application, 'mapfactory', None), 'render_pool', None)
+    if pool is not None:
+        pool.start()
+
+def serve(application, host, port, workers=1, threads=1, eventloop=False):
+    """ Serves application on host:port until interrupted, from a single
+        process or from a number of forked worker processes, each answering
+        from the given number of threads, or from an event loop handing
+        renders to them if eventloop is set.
+    """
+    if workers > 1:
+        server = PreforkServer(application, host, port, workers, threads, eventloop)
+        def stop(signum, frame):
+            server.shutdown()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        print "Listening at %s:%s with %d workers...." % (host, server.server_address[1], workers)
+        server.serve_forever()
+    else:
+        httpd = make_http_server(host, port, application, threads, eventloop)
+        start_render_pool(application)
+        print "Listening at %s:%s...." % (host, httpd.server_address[1])
+        httpd.serve_forever()
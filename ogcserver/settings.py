@@ -0,0 +1,91 @@
+"""Immutable server settings, validated once when the server starts."""
+
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.exceptions import ServerConfigurationError
+
+class ServerSettings(object):
+
+    __slots__ = ('conf', 'module', 'debug', 'maxage', 'prebuildcapabilities',
+                 'baseurl', 'allowedepsgcodes', 'maxwidth', 'maxheight',
+                 'layerlimit', 'memorycachebytes', 'metatile', 'cachesoftttl',
+                 'cachehardttl', 'layercache')
+
+    def __init__(self, conf):
+        """ Typed, read only view of the settings used on the request path.
+
+            Every value is parsed and checked here, so that a bad
+            configuration is reported at startup rather than on the first
+            request that happens to need it.
+
+            @param conf: The parsed configuration file.  It is kept as
+                         'conf' for the service metadata that is only read
+                         when building capabilities documents.
+            @type conf: L{ogcserver.configparser.SafeConfigParser}
+
+            @return: A L{ServerSettings} instance.
+        """
+        setfield = lambda name, value: object.__setattr__(self, name, value)
+        setfield('conf', conf)
+        setfield('module', _get(conf, 'server', 'module'))
+        setfield('debug', _get(conf, 'server', 'debug', int, 0))
+        # maxage has historically been read from [server] although the
+        # default configuration documents it in [service]
+        maxage = _get(conf, 'server', 'maxage', int)
+        if maxage is None:
+            maxage = _get(conf, 'service', 'maxage', int)
+        setfield('maxage', maxage)
+        setfield('prebuildcapabilities', _get(conf, 'server', 'prebuildcapabilities', _boolean, False))
+        setfield('baseurl', _get(conf, 'service', 'baseurl'))
+        epsgcodes = _get(conf, 'service', 'allowedepsgcodes')
+        if not epsgcodes:
+            raise ServerConfigurationError('Allowed EPSG codes not properly configured.')
+        try:
+            setfield('allowedepsgcodes', tuple(['epsg:%d' % int(code) for code in epsgcodes.split(',')]))
+        except ValueError:
+            raise ServerConfigurationError('Allowed EPSG codes not properly configured.')
+        setfield('maxwidth', _get(conf, 'service', 'maxwidth', int))
+        setfield('maxheight', _get(conf, 'service', 'maxheight', int))
+        setfield('layerlimit', _get(conf, 'service', 'layerlimit', int))
+        setfield('memorycachebytes', _get(conf, 'cache', 'memorybytes', int, 0))
+        setfield('metatile', _get(conf, 'cache', 'metatile', int, 0))
+        setfield('cachesoftttl', _get(conf, 'cache', 'softttl', int, 0))
+        setfield('cachehardttl', _get(conf, 'cache', 'hardttl', int, 0))
+        setfield('layercache', _get(conf, 'cache', 'layers', _boolean, False))
+        if self.cachesoftttl and self.cachehardttl and self.cachesoftttl > self.cachehardttl:
+            raise ServerConfigurationError('Configuration parameter [cache]->softttl is larger than [cache]->hardttl.')
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ServerSettings are read only.')
+
+    def __delattr__(self, name):
+        raise AttributeError('ServerSettings are read only.')
+
+def load_settings(conf):
+    """ Returns the L{ServerSettings} for conf, which may be the path to a
+        configuration file, a parsed configuration or already a
+        L{ServerSettings} instance.
+    """
+    if isinstance(conf, ServerSettings):
+        return conf
+    if isinstance(conf, basestring):
+        configpath = conf
+        conf = SafeConfigParser()
+        conf.readfp(open(configpath))
+    return ServerSettings(conf)
+
+def _boolean(value):
+    value = value.lower()
+    if value in ('1', 'yes', 'true', 'on'):
+        return True
+    if value in ('0', 'no', 'false', 'off'):
+        return False
+    raise ValueError(value)
+
+def _get(conf, section, option, cast=str, default=None):
+    if not conf.has_option_with_value(section, option):
+        return default
+    value = conf.get(section, option).strip()
+    try:
+        return cast(value)
+    except ValueError:
+        raise ServerConfigurationError('Configuration parameter [%s]->%s has an invalid value: %s.' % (section, option, value))
@@ -0,0 +1,113 @@
+"""Fixed tile grids used to recognise, render and seed tile-aligned requests."""
+
+import math
+
+class TileGrid:
+
+    def __init__(self, name, crs, extent, matrixwidth, matrixheight, tilesize=256, levels=21):
+        """ A pyramid of square tiles covering extent, numbered from the top
+            left corner, with the tile matrix doubling in both directions at
+            every level.
+
+            @param name: Identifier of the grid (WMTS TileMatrixSet).
+            @type name: String.
+
+            @param crs: The CRS of the grid, in the 'epsg:<code>' form used
+                        by allowedepsgcodes.
+            @type crs: String.
+
+            @param extent: (minx, miny, maxx, maxy) of the grid.
+            @type extent: A python tuple.
+
+            @param matrixwidth: Number of tile columns at level 0.
+            @type matrixwidth: Integer.
+
+            @param matrixheight: Number of tile rows at level 0.
+            @type matrixheight: Integer.
+        """
+        self.name = name
+        self.crs = crs
+        self.extent = extent
+        self.matrixwidth = matrixwidth
+        self.matrixheight = matrixheight
+        self.tilesize = tilesize
+        self.levels = levels
+
+    def span(self, z):
+        """ Returns the width (and height) of a tile at level z, in CRS units. """
+        return (self.extent[2] - self.extent[0]) / (self.matrixwidth * 2 ** z)
+
+    def matrixsize(self, z):
+        return self.matrixwidth * 2 ** z, self.matrixheight * 2 ** z
+
+    def tile_bbox(self, z, x, y):
+        span = self.span(z)
+        minx = self.extent[0] + x * span
+        maxy = self.extent[3] - y * span
+        return [minx, maxy - span, minx + span, maxy]
+
+    def find_tile(self, bbox, width, height):
+        """ Returns (z, x, y) of the tile matching a request for bbox at the
+            given size, or None if the request is not aligned to this grid.
+        """
+        if width != self.tilesize or height != self.tilesize:
+            return None
+        span = bbox[2] - bbox[0]
+        if span <= 0:
+            return None
+        z = int(round(math.log(self.span(0) / span, 2)))
+        if z < 0 or z >= self.levels:
+            return None
+        span = self.span(z)
+        x = int(round((bbox[0] - self.extent[0]) / span))
+        y = int(round((self.extent[3] - bbox[3]) / span))
+        matrixwidth, matrixheight = self.matrixsize(z)
+        if x < 0 or y < 0 or x >= matrixwidth or y >= matrixheight:
+            return None
+        # clients print coordinates with limited precision, allow for a
+        # thousandth of a tile
+        tolerance = span / 1000.0
+        for requested, aligned in zip(bbox, self.tile_bbox(z, x, y)):
+            if abs(requested - aligned) > tolerance:
+                return None
+        return z, x, y
+
+    def tile_range(self, bbox, z):
+        """ Returns (minx, miny, maxx, maxy), inclusive, of the tiles at
+            level z that intersect bbox, or None if bbox is off the grid.
+        """
+        span = self.span(z)
+        matrixwidth, matrixheight = self.matrixsize(z)
+        minx = max(0, int(math.floor((bbox[0] - self.extent[0]) / span)))
+        maxx = min(matrixwidth - 1, int(math.ceil((bbox[2] - self.extent[0]) / span)) - 1)
+        miny = max(0, int(math.floor((self.extent[3] - bbox[3]) / span)))
+        maxy = min(matrixheight - 1, int(math.ceil((self.extent[3] - bbox[1]) / span)) - 1)
+        if minx > maxx or miny > maxy:
+            return None
+        return minx, miny, maxx, maxy
+
+    def metatile(self, z, x, y, size):
+        """ Returns (x, y, columns, rows) of the block of at most size x size
+            tiles that contains tile (z, x, y), clipped to the grid.
+        """
+        matrixwidth, matrixheight = self.matrixsize(z)
+        metax = x - x % size
+        metay = y - y % size
+        return metax, metay, min(size, matrixwidth - metax), min(size, matrixheight - metay)
+
+    def metatile_bbox(self, z, x, y, columns, rows):
+        minx, miny, maxx, maxy = self.tile_bbox(z, x, y)
+        span = self.span(z)
+        return [minx, maxy - rows * span, minx + columns * span, maxy]
+
+_MERCATOR = 20037508.342789244
+
+# the GoogleMapsCompatible and WorldCRS84Quad grids of the WMTS spec
+GRIDS = {
+    'epsg:3857': TileGrid('GoogleMapsCompatible', 'epsg:3857', (-_MERCATOR, -_MERCATOR, _MERCATOR, _MERCATOR), 1, 1),
+    'epsg:4326': TileGrid('WorldCRS84Quad', 'epsg:4326', (-180.0, -90.0, 180.0, 90.0), 2, 1),
+}
+
+def intersects(a, b):
+    """ Returns whether the (minx, miny, maxx, maxy) boxes a and b overlap. """
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
@@ -9,6 +9,7 @@ ElementTree.register_namespace('xlink', "http://www.w3.org/1999/xlink")
 from ogcserver.common import ParameterDefinition, Response, Version, ListFactory, \
                    ColorFactory, CRSFactory, WMSBaseServiceHandler, CRS, \
                    BaseExceptionHandler, Projection, to_unicode
+from ogcserver.settings import load_settings
 from ogcserver.exceptions import OGCException, ServerConfigurationError
 
 
@@ -27,6 +28,7 @@ class ServiceHandler(WMSBaseServiceHandler):
             'height': ParameterDefinition(True, int),
             'format': ParameterDefinition(True, str, allowedvalues=('image/png','image/png8', 'image/jpeg')),
             'transparent': ParameterDefinition(False, str, 'FALSE', ('TRUE', 'FALSE','true','True','false','False')),
+            'tiled': ParameterDefinition(False, str, 'FALSE', ('TRUE', 'FALSE','true','True','false','False')),
             'bgcolor': ParameterDefinition(False, ColorFactory, None),
             'exceptions': ParameterDefinition(False, str, 'application/vnd.ogc.se_xml', ('application/vnd.ogc.se_xml', 'application/vnd.ogc.se_inimage', 'application/vnd.ogc.se_blank','text/html'),True)
         },
@@ -49,6 +51,10 @@ class ServiceHandler(WMSBaseServiceHandler):
         }
     }
 
+    version = '1.1.1'
+
+    capabilitiesmimetype = 'application/vnd.ogc.wms_xml'
+
     CONF_SERVICE = [
         ['title', 'Title', str],
         ['abstract', 'Abstract', str],
@@ -112,136 +118,131 @@ class ServiceHandler(WMSBaseServiceHandler):
     """
 
     def __init__(self, conf, mapfactory, opsonlineresource):
-        self.conf = conf
+        self.settings = load_settings(conf)
+        self.conf = self.settings.conf
         self.mapfactory = mapfactory
         self.opsonlineresource = opsonlineresource
-        if self.conf.has_option('service', 'allowedepsgcodes'):
-            self.allowedepsgcodes = map(lambda code: 'epsg:%s' % code, self.conf.get('service', 'allowedepsgcodes').split(','))
-        else:
-            raise ServerConfigurationError('Allowed EPSG codes not properly configured.')
-        self.capabilities = None
+        self.allowedepsgcodes = self.settings.allowedepsgcodes
 
-    def GetCapabilities(self, params):
-        if not self.capabilities:
-            capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
+    def _buildCapabilities(self):
+        capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
+        capetree.set('updateSequence', self.mapfactory.updatesequence)
 
-            elements = capetree.findall('Capability//OnlineResource')
-            for element in elements:
-                element.set('xlink:href', self.opsonlineresource)
+        elements = capetree.findall('Capability//OnlineResource')
+        for element in elements:
+            element.set('xlink:href', self.opsonlineresource)
 
-            self.processServiceCapabilities(capetree)
+        self.processServiceCapabilities(capetree)
 
-            rootlayerelem = capetree.find('Capability/Layer')
+        rootlayerelem = capetree.find('Capability/Layer')
 
-            rootlayername = ElementTree.Element('Name')
-            if self.conf.has_option('map', 'wms_name'):
-                rootlayername.text = to_unicode(self.conf.get('map', 'wms_name'))
-            else:
-                rootlayername.text = '__all__'
-            rootlayerelem.append(rootlayername)
+        rootlayername = ElementTree.Element('Name')
+        if self.conf.has_option('map', 'wms_name'):
+            rootlayername.text = to_unicode(self.conf.get('map', 'wms_name'))
+        else:
+            rootlayername.text = '__all__'
+        rootlayerelem.append(rootlayername)
 
-            rootlayertitle = ElementTree.Element('Title')
-            if self.conf.has_option('map', 'wms_title'):
-                rootlayertitle.text = to_unicode(self.conf.get('map', 'wms_title'))
-            else:
-                rootlayertitle.text = 'OGCServer WMS Server'
-            rootlayerelem.append(rootlayertitle)
+        rootlayertitle = ElementTree.Element('Title')
+        if self.conf.has_option('map', 'wms_title'):
+            rootlayertitle.text = to_unicode(self.conf.get('map', 'wms_title'))
+        else:
+            rootlayertitle.text = 'OGCServer WMS Server'
+        rootlayerelem.append(rootlayertitle)
 
-            rootlayerabstract = ElementTree.Element('Abstract')
-            if self.conf.has_option('map', 'wms_abstract'):
-                rootlayerabstract.text = to_unicode(self.conf.get('map', 'wms_abstract'))
-            else:
-                rootlayerabstract.text = 'OGCServer WMS Server'
-            rootlayerelem.append(rootlayerabstract)
+        rootlayerabstract = ElementTree.Element('Abstract')
+        if self.conf.has_option('map', 'wms_abstract'):
+            rootlayerabstract.text = to_unicode(self.conf.get('map', 'wms_abstract'))
+        else:
+            rootlayerabstract.text = 'OGCServer WMS Server'
+        rootlayerelem.append(rootlayerabstract)
 
-            latlonbb = ElementTree.Element('LatLonBoundingBox')
-            latlonbb.set('minx', str(self.mapfactory.latlonbb.minx))
-            latlonbb.set('miny', str(self.mapfactory.latlonbb.miny))
-            latlonbb.set('maxx', str(self.mapfactory.latlonbb.maxx))
-            latlonbb.set('maxy', str(self.mapfactory.latlonbb.maxy))
-            rootlayerelem.append(latlonbb)
+        bb = self.mapfactory.get_latlonbb()
+        latlonbb = ElementTree.Element('LatLonBoundingBox')
+        latlonbb.set('minx', str(bb.minx))
+        latlonbb.set('miny', str(bb.miny))
+        latlonbb.set('maxx', str(bb.maxx))
+        latlonbb.set('maxy', str(bb.maxy))
+        rootlayerelem.append(latlonbb)
 
-            for epsgcode in self.allowedepsgcodes:
-                rootlayercrs = ElementTree.Element('SRS')
-                rootlayercrs.text = epsgcode.upper()
-                rootlayerelem.append(rootlayercrs)
+        for epsgcode in self.allowedepsgcodes:
+            rootlayercrs = ElementTree.Element('SRS')
+            rootlayercrs.text = epsgcode.upper()
+            rootlayerelem.append(rootlayercrs)
 
-            for epsgcode in self.allowedepsgcodes:
-                rootbbox = ElementTree.Element('BoundingBox')
-                rootbbox.set('SRS', epsgcode.upper())
-                proj = Projection('+init='+epsgcode)
-                bb = self.mapfactory.latlonbb
-                minCoord = Coord(bb.minx, bb.miny).forward(proj)
-                maxCoord = Coord(bb.maxx, bb.maxy).forward(proj)
-                rootbbox.set('minx', str(minCoord.x))
-                rootbbox.set('miny', str(minCoord.y))
-                rootbbox.set('maxx', str(maxCoord.x))
-                rootbbox.set('maxy', str(maxCoord.y))
-                rootlayerelem.append(rootbbox)
+        for epsgcode in self.allowedepsgcodes:
+            rootbbox = ElementTree.Element('BoundingBox')
+            rootbbox.set('SRS', epsgcode.upper())
+            proj = Projection('+init='+epsgcode)
+            minCoord = Coord(bb.minx, bb.miny).forward(proj)
+            maxCoord = Coord(bb.maxx, bb.maxy).forward(proj)
+            rootbbox.set('minx', str(minCoord.x))
+            rootbbox.set('miny', str(minCoord.y))
+            rootbbox.set('maxx', str(maxCoord.x))
+            rootbbox.set('maxy', str(maxCoord.y))
+            rootlayerelem.append(rootbbox)
 
-            for layer in self.mapfactory.ordered_layers:
-                layerproj = Projection(layer.srs)
-                layername = ElementTree.Element('Name')
-                layername.text = to_unicode(layer.name)
-                env = layer.envelope()
-                llp = layerproj.inverse(Coord(env.minx, env.miny))
-                urp = layerproj.inverse(Coord(env.maxx, env.maxy))
-                latlonbb = ElementTree.Element('LatLonBoundingBox')
-                latlonbb.set('minx', str(llp.x))
-                latlonbb.set('miny', str(llp.y))
-                latlonbb.set('maxx', str(urp.x))
-                latlonbb.set('maxy', str(urp.y))
-                layerbbox = ElementTree.Element('BoundingBox')
-                if layer.wms_srs:
-                    layerbbox.set('SRS', layer.wms_srs)
-                else:
-                    layerbbox.set('SRS', layerproj.epsgstring())
-                layerbbox.set('minx', str(env.minx))
-                layerbbox.set('miny', str(env.miny))
-                layerbbox.set('maxx', str(env.maxx))
-                layerbbox.set('maxy', str(env.maxy))
-                layere = ElementTree.Element('Layer')
-                layere.append(layername)
-                layertitle = ElementTree.Element('Title')
-                if hasattr(layer,'title'):
-                    layertitle.text = to_unicode(layer.title)
-                    if layertitle.text == '':
-                        layertitle.text = to_unicode(layer.name)
-                else:
+        for layer in self.mapfactory.ordered_layers:
+            layerproj = self.mapfactory.projection(layer.srs)
+            layername = ElementTree.Element('Name')
+            layername.text = to_unicode(layer.name)
+            env = self.mapfactory.envelope(layer)
+            llp = layerproj.inverse(Coord(env.minx, env.miny))
+            urp = layerproj.inverse(Coord(env.maxx, env.maxy))
+            latlonbb = ElementTree.Element('LatLonBoundingBox')
+            latlonbb.set('minx', str(llp.x))
+            latlonbb.set('miny', str(llp.y))
+            latlonbb.set('maxx', str(urp.x))
+            latlonbb.set('maxy', str(urp.y))
+            layerbbox = ElementTree.Element('BoundingBox')
+            if layer.wms_srs:
+                layerbbox.set('SRS', layer.wms_srs)
+            else:
+                layerbbox.set('SRS', layerproj.epsgstring())
+            layerbbox.set('minx', str(env.minx))
+            layerbbox.set('miny', str(env.miny))
+            layerbbox.set('maxx', str(env.maxx))
+            layerbbox.set('maxy', str(env.maxy))
+            layere = ElementTree.Element('Layer')
+            layere.append(layername)
+            layertitle = ElementTree.Element('Title')
+            if hasattr(layer,'title'):
+                layertitle.text = to_unicode(layer.title)
+                if layertitle.text == '':
                     layertitle.text = to_unicode(layer.name)
-                layere.append(layertitle)
-                layerabstract = ElementTree.Element('Abstract')
-                if hasattr(layer,'abstract'):
-                    layerabstract.text = to_unicode(layer.abstract)
-                else:
-                    layerabstract.text = 'no abstract'
-                layere.append(layerabstract)
-                if layer.queryable:
-                    layere.set('queryable', '1')
-                layere.append(latlonbb)
-                layere.append(layerbbox)
-                style_count = len(layer.wmsextrastyles)
-                if style_count > 0:
-                    extrastyles = layer.wmsextrastyles
-                    if style_count > 1:
-                        extrastyles = ['default'] + [x for x in extrastyles if x != 'default']
-                    for extrastyle in extrastyles:
-                        style = ElementTree.Element('Style')
-                        stylename = ElementTree.Element('Name')
-                        stylename.text = to_unicode(extrastyle)
-                        styletitle = ElementTree.Element('Title')
-                        styletitle.text = to_unicode(extrastyle)
-                        style.append(stylename)
-                        style.append(styletitle)
-                        if style_count > 1 and extrastyle == 'default':
-                            styleabstract = ElementTree.Element('Abstract')
-                            styleabstract.text = to_unicode('This layer\'s default style that combines all its other named styles.')
-                            style.append(styleabstract)
-                        layere.append(style)
-                rootlayerelem.append(layere)
-            self.capabilities = ElementTree.tostring(capetree,encoding='UTF-8')
-        response = Response('application/vnd.ogc.wms_xml', self.capabilities)
-        return response
+            else:
+                layertitle.text = to_unicode(layer.name)
+            layere.append(layertitle)
+            layerabstract = ElementTree.Element('Abstract')
+            if hasattr(layer,'abstract'):
+                layerabstract.text = to_unicode(layer.abstract)
+            else:
+                layerabstract.text = 'no abstract'
+            layere.append(layerabstract)
+            if layer.queryable:
+                layere.set('queryable', '1')
+            layere.append(latlonbb)
+            layere.append(layerbbox)
+            style_count = len(layer.wmsextrastyles)
+            if style_count > 0:
+                extrastyles = layer.wmsextrastyles
+                if style_count > 1:
+                    extrastyles = ['default'] + [x for x in extrastyles if x != 'default']
+                for extrastyle in extrastyles:
+                    style = ElementTree.Element('Style')
+                    stylename = ElementTree.Element('Name')
+                    stylename.text = to_unicode(extrastyle)
+                    styletitle = ElementTree.Element('Title')
+                    styletitle.text = to_unicode(extrastyle)
+                    style.append(stylename)
+                    style.append(styletitle)
+                    if style_count > 1 and extrastyle == 'default':
+                        styleabstract = ElementTree.Element('Abstract')
+                        styleabstract.text = to_unicode('This layer\'s default style that combines all its other named styles.')
+                        style.append(styleabstract)
+                    layere.append(style)
+            rootlayerelem.append(layere)
+        return ElementTree.tostring(capetree,encoding='UTF-8')
 
     def GetMap(self, params):
         params['crs'] = params['srs']
@@ -8,7 +8,9 @@ ElementTree.register_namespace('xlink', "http://www.w3.org/1999/xlink")
 
 from ogcserver.common import ParameterDefinition, Response, Version, ListFactory, \
                    ColorFactory, CRSFactory, CRS, WMSBaseServiceHandler, \
-                   BaseExceptionHandler, Projection, Envelope, to_unicode
+                   BaseExceptionHandler, Projection, Envelope, to_unicode, \
+                   ignores_axis_order
+from ogcserver.settings import load_settings
 from ogcserver.exceptions import OGCException, ServerConfigurationError
 
 class ServiceHandler(WMSBaseServiceHandler):
@@ -27,6 +29,7 @@ class ServiceHandler(WMSBaseServiceHandler):
             'height': ParameterDefinition(True, int),
             'format': ParameterDefinition(True, str, allowedvalues=('image/png','image/png8', 'image/jpeg')),
             'transparent': ParameterDefinition(False, str, 'FALSE', ('TRUE', 'FALSE','true','True','false','False')),
+            'tiled': ParameterDefinition(False, str, 'FALSE', ('TRUE', 'FALSE','true','True','false','False')),
             'bgcolor': ParameterDefinition(False, ColorFactory, None),
             'exceptions': ParameterDefinition(False, str, 'XML', ('XML', 'INIMAGE', 'BLANK','HTML'),True),
         },
@@ -51,6 +54,10 @@ class ServiceHandler(WMSBaseServiceHandler):
         }
     }
 
+    version = '1.3.0'
+
+    capabilitiesmimetype = 'text/xml'
+
     CONF_SERVICE = [
         ['title', 'Title', str],
         ['abstract', 'Abstract', str],
@@ -119,142 +126,140 @@ class ServiceHandler(WMSBaseServiceHandler):
     """
 
     def __init__(self, conf, mapfactory, opsonlineresource):
-        self.conf = conf
+        self.settings = load_settings(conf)
+        self.conf = self.settings.conf
         self.mapfactory = mapfactory
         self.opsonlineresource = opsonlineresource
-        if self.conf.has_option('service', 'allowedepsgcodes'):
-            self.allowedepsgcodes = map(lambda code: 'epsg:%s' % code, self.conf.get('service', 'allowedepsgcodes').split(','))
-        else:
-            raise ServerConfigurationError('Allowed EPSG codes not properly configured.')
-        self.capabilities = None
+        self.allowedepsgcodes = self.settings.allowedepsgcodes
 
-    def GetCapabilities(self, params):
-        if not self.capabilities:
-            capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
+    def _buildCapabilities(self):
+        capetree = ElementTree.fromstring(self.capabilitiesxmltemplate)
+        capetree.set('updateSequence', self.mapfactory.updatesequence)
 
-            elements = capetree.findall('{http://www.opengis.net/wms}Capability//{http://www.opengis.net/wms}OnlineResource')
-            for element in elements:
-                element.set('xlink:href', self.opsonlineresource)
+        elements = capetree.findall('{http://www.opengis.net/wms}Capability//{http://www.opengis.net/wms}OnlineResource')
+        for element in elements:
+            element.set('xlink:href', self.opsonlineresource)
 
-            self.processServiceCapabilities(capetree)
+        self.processServiceCapabilities(capetree)
 
-            rootlayerelem = capetree.find('{http://www.opengis.net/wms}Capability/{http://www.opengis.net/wms}Layer')
+        rootlayerelem = capetree.find('{http://www.opengis.net/wms}Capability/{http://www.opengis.net/wms}Layer')
 
-            rootlayername = ElementTree.Element('{http://www.opengis.net/wms}Name')
-            if self.conf.has_option('map', 'wms_name'):
-                rootlayername.text = to_unicode(self.conf.get('map', 'wms_name'))
-            else:
-                rootlayername.text = '__all__'
-            rootlayerelem.append(rootlayername)
+        rootlayername = ElementTree.Element('{http://www.opengis.net/wms}Name')
+        if self.conf.has_option('map', 'wms_name'):
+            rootlayername.text = to_unicode(self.conf.get('map', 'wms_name'))
+        else:
+            rootlayername.text = '__all__'
+        rootlayerelem.append(rootlayername)
 
-            rootlayertitle = ElementTree.Element('{http://www.opengis.net/wms}Title')
-            if self.conf.has_option('map', 'wms_title'):
-                rootlayertitle.text = to_unicode(self.conf.get('map', 'wms_title'))
-            else:
-                rootlayertitle.text = 'OGCServer WMS Server'
-            rootlayerelem.append(rootlayertitle)
+        rootlayertitle = ElementTree.Element('{http://www.opengis.net/wms}Title')
+        if self.conf.has_option('map', 'wms_title'):
+            rootlayertitle.text = to_unicode(self.conf.get('map', 'wms_title'))
+        else:
+            rootlayertitle.text = 'OGCServer WMS Server'
+        rootlayerelem.append(rootlayertitle)
 
-            rootlayerabstract = ElementTree.Element('{http://www.opengis.net/wms}Abstract')
-            if self.conf.has_option('map', 'wms_abstract'):
-                rootlayerabstract.text = to_unicode(self.conf.get('map', 'wms_abstract'))
-            else:
-                rootlayerabstract.text = 'OGCServer WMS Server'
-            rootlayerelem.append(rootlayerabstract)
+        rootlayerabstract = ElementTree.Element('{http://www.opengis.net/wms}Abstract')
+        if self.conf.has_option('map', 'wms_abstract'):
+            rootlayerabstract.text = to_unicode(self.conf.get('map', 'wms_abstract'))
+        else:
+            rootlayerabstract.text = 'OGCServer WMS Server'
+        rootlayerelem.append(rootlayerabstract)
+
+        bb = self.mapfactory.get_latlonbb()
+        layerexgbb = ElementTree.Element('{http://www.opengis.net/wms}EX_GeographicBoundingBox')
+        exgbb_wbl = ElementTree.Element('{http://www.opengis.net/wms}westBoundLongitude')
+        exgbb_wbl.text = str(bb.minx)
+        layerexgbb.append(exgbb_wbl)
+        exgbb_ebl = ElementTree.Element('{http://www.opengis.net/wms}eastBoundLongitude')
+        exgbb_ebl.text = str(bb.maxx)
+        layerexgbb.append(exgbb_ebl)
+        exgbb_sbl = ElementTree.Element('{http://www.opengis.net/wms}southBoundLatitude')
+        exgbb_sbl.text = str(bb.miny)
+        layerexgbb.append(exgbb_sbl)
+        exgbb_nbl = ElementTree.Element('{http://www.opengis.net/wms}northBoundLatitude')
+        exgbb_nbl.text = str(bb.maxy)
+        layerexgbb.append(exgbb_nbl)
+        rootlayerelem.append(layerexgbb)
 
+        for epsgcode in self.allowedepsgcodes:
+            rootlayercrs = ElementTree.Element('{http://www.opengis.net/wms}CRS')
+            rootlayercrs.text = epsgcode.upper()
+            rootlayerelem.append(rootlayercrs)
+
+        for layer in self.mapfactory.ordered_layers:
+            layerproj = self.mapfactory.projection(layer.srs)
+            layername = ElementTree.Element('{http://www.opengis.net/wms}Name')
+            layername.text = to_unicode(layer.name)
+            env = self.mapfactory.envelope(layer)
             layerexgbb = ElementTree.Element('{http://www.opengis.net/wms}EX_GeographicBoundingBox')
+            ll = layerproj.inverse(Coord(env.minx, env.miny))
+            ur = layerproj.inverse(Coord(env.maxx, env.maxy))
             exgbb_wbl = ElementTree.Element('{http://www.opengis.net/wms}westBoundLongitude')
-            exgbb_wbl.text = str(self.mapfactory.latlonbb.minx)
+            exgbb_wbl.text = str(ll.x)
             layerexgbb.append(exgbb_wbl)
             exgbb_ebl = ElementTree.Element('{http://www.opengis.net/wms}eastBoundLongitude')
-            exgbb_ebl.text = str(self.mapfactory.latlonbb.maxx)
+            exgbb_ebl.text = str(ur.x)
             layerexgbb.append(exgbb_ebl)
             exgbb_sbl = ElementTree.Element('{http://www.opengis.net/wms}southBoundLatitude')
-            exgbb_sbl.text = str(self.mapfactory.latlonbb.miny)
+            exgbb_sbl.text = str(ll.y)
             layerexgbb.append(exgbb_sbl)
             exgbb_nbl = ElementTree.Element('{http://www.opengis.net/wms}northBoundLatitude')
-            exgbb_nbl.text = str(self.mapfactory.latlonbb.maxy)
+            exgbb_nbl.text = str(ur.y)
             layerexgbb.append(exgbb_nbl)
-            rootlayerelem.append(layerexgbb)
-
-            for epsgcode in self.allowedepsgcodes:
-                rootlayercrs = ElementTree.Element('{http://www.opengis.net/wms}CRS')
-                rootlayercrs.text = epsgcode.upper()
-                rootlayerelem.append(rootlayercrs)
-
-            for layer in self.mapfactory.ordered_layers:
-                layerproj = Projection(layer.srs)
-                layername = ElementTree.Element('{http://www.opengis.net/wms}Name')
-                layername.text = to_unicode(layer.name)
-                env = layer.envelope()
-                layerexgbb = ElementTree.Element('{http://www.opengis.net/wms}EX_GeographicBoundingBox')
-                ll = layerproj.inverse(Coord(env.minx, env.miny))
-                ur = layerproj.inverse(Coord(env.maxx, env.maxy))
-                exgbb_wbl = ElementTree.Element('{http://www.opengis.net/wms}westBoundLongitude')
-                exgbb_wbl.text = str(ll.x)
-                layerexgbb.append(exgbb_wbl)
-                exgbb_ebl = ElementTree.Element('{http://www.opengis.net/wms}eastBoundLongitude')
-                exgbb_ebl.text = str(ur.x)
-                layerexgbb.append(exgbb_ebl)
-                exgbb_sbl = ElementTree.Element('{http://www.opengis.net/wms}southBoundLatitude')
-                exgbb_sbl.text = str(ll.y)
-                layerexgbb.append(exgbb_sbl)
-                exgbb_nbl = ElementTree.Element('{http://www.opengis.net/wms}northBoundLatitude')
-                exgbb_nbl.text = str(ur.y)
-                layerexgbb.append(exgbb_nbl)
-                layerbbox = ElementTree.Element('{http://www.opengis.net/wms}BoundingBox')
-                if layer.wms_srs:
-                    layerbbox.set('CRS', layer.wms_srs)
-                else:
-                    layerbbox.set('CRS', layerproj.epsgstring())
-                layerbbox.set('minx', str(env.minx))
-                layerbbox.set('miny', str(env.miny))
-                layerbbox.set('maxx', str(env.maxx))
-                layerbbox.set('maxy', str(env.maxy))
-                layere = ElementTree.Element('{http://www.opengis.net/wms}Layer')
-                layere.append(layername)
-                layertitle = ElementTree.Element('{http://www.opengis.net/wms}Title')
-                if hasattr(layer,'title'):
-                    layertitle.text = to_unicode(layer.title)
-                    if layertitle.text == '':
-                        layertitle.text = to_unicode(layer.name)
-                else:
+            layerbbox = ElementTree.Element('{http://www.opengis.net/wms}BoundingBox')
+            if layer.wms_srs:
+                layerbbox.set('CRS', layer.wms_srs)
+            else:
+                layerbbox.set('CRS', layerproj.epsgstring())
+            layerbbox.set('minx', str(env.minx))
+            layerbbox.set('miny', str(env.miny))
+            layerbbox.set('maxx', str(env.maxx))
+            layerbbox.set('maxy', str(env.maxy))
+            layere = ElementTree.Element('{http://www.opengis.net/wms}Layer')
+            layere.append(layername)
+            layertitle = ElementTree.Element('{http://www.opengis.net/wms}Title')
+            if hasattr(layer,'title'):
+                layertitle.text = to_unicode(layer.title)
+                if layertitle.text == '':
                     layertitle.text = to_unicode(layer.name)
-                layere.append(layertitle)
-                layerabstract = ElementTree.Element('{http://www.opengis.net/wms}Abstract')
-                if hasattr(layer,'abstract'):
-                    layerabstract.text = to_unicode(layer.abstract)
-                else:
-                    layerabstract.text = 'no abstract'
-                layere.append(layerabstract)
-                if layer.queryable:
-                    layere.set('queryable', '1')
-                layere.append(layerexgbb)
-                layere.append(layerbbox)
-                style_count = len(layer.wmsextrastyles)
-                if style_count > 0:
-                    extrastyles = layer.wmsextrastyles
-                    if style_count > 1:
-                        extrastyles = ['default'] + [x for x in extrastyles if x != 'default']
-                    for extrastyle in extrastyles:
-                        style = ElementTree.Element('{http://www.opengis.net/wms}Style')
-                        stylename = ElementTree.Element('{http://www.opengis.net/wms}Name')
-                        stylename.text = to_unicode(extrastyle)
-                        styletitle = ElementTree.Element('{http://www.opengis.net/wms}Title')
-                        styletitle.text = to_unicode(extrastyle)
-                        style.append(stylename)
-                        style.append(styletitle)
-                        if style_count > 1 and extrastyle == 'default':
-                            styleabstract = ElementTree.Element('{http://www.opengis.net/wms}Abstract')
-                            styleabstract.text = to_unicode('This layer\'s default style that combines all its other named styles.')
-                            style.append(styleabstract)
-                        layere.append(style)
-                rootlayerelem.append(layere)
-            self.capabilities = ElementTree.tostring(capetree,encoding='UTF-8')
-        response = Response('text/xml', self.capabilities)
-        return response
+            else:
+                layertitle.text = to_unicode(layer.name)
+            layere.append(layertitle)
+            layerabstract = ElementTree.Element('{http://www.opengis.net/wms}Abstract')
+            if hasattr(layer,'abstract'):
+                layerabstract.text = to_unicode(layer.abstract)
+            else:
+                layerabstract.text = 'no abstract'
+            layere.append(layerabstract)
+            if layer.queryable:
+                layere.set('queryable', '1')
+            layere.append(layerexgbb)
+            layere.append(layerbbox)
+            style_count = len(layer.wmsextrastyles)
+            if style_count > 0:
+                extrastyles = layer.wmsextrastyles
+                if style_count > 1:
+                    extrastyles = ['default'] + [x for x in extrastyles if x != 'default']
+                for extrastyle in extrastyles:
+                    style = ElementTree.Element('{http://www.opengis.net/wms}Style')
+                    stylename = ElementTree.Element('{http://www.opengis.net/wms}Name')
+                    stylename.text = to_unicode(extrastyle)
+                    styletitle = ElementTree.Element('{http://www.opengis.net/wms}Title')
+                    styletitle.text = to_unicode(extrastyle)
+                    style.append(stylename)
+                    style.append(styletitle)
+                    if style_count > 1 and extrastyle == 'default':
+                        styleabstract = ElementTree.Element('{http://www.opengis.net/wms}Abstract')
+                        styleabstract.text = to_unicode('This layer\'s default style that combines all its other named styles.')
+                        style.append(styleabstract)
+                    layere.append(style)
+            rootlayerelem.append(layere)
+        return ElementTree.tostring(capetree,encoding='UTF-8')
 
     def GetMap(self, params):
-        if params['width'] > int(self.conf.get('service', 'maxwidth')) or params['height'] > int(self.conf.get('service', 'maxheight')):
+        maxwidth = self.settings.maxwidth
+        maxheight = self.settings.maxheight
+        if (maxwidth is not None and params['width'] > maxwidth) or (maxheight is not None and params['height'] > maxheight):
             raise OGCException('Requested map size exceeds limits set by this server.')
         return WMSBaseServiceHandler.GetMap(self, params)
 
@@ -282,14 +287,23 @@ class ServiceHandler(WMSBaseServiceHandler):
         """
         # Call superclass method
         m = WMSBaseServiceHandler._buildMap(self, params)
-        # for range of epsg codes reverse axis as per 1.3.0 spec
-        if params['crs'].code >= 4000 and params['crs'].code < 5000:
+        if self._reverseAxes(params):
             bbox = params['bbox']
-            # MapInfo Pro 10 does not "know" this is the way and gets messed up
-            if not 'mapinfo' in params['HTTP_USER_AGENT'].lower():
-                m.zoom_to_box(Envelope(bbox[1], bbox[0], bbox[3], bbox[2]))
+            m.zoom_to_box(Envelope(bbox[1], bbox[0], bbox[3], bbox[2]))
         return m
 
+    def _reverseAxes(self, params):
+        # for range of epsg codes reverse axis as per 1.3.0 spec
+        if params['crs'].code >= 4000 and params['crs'].code < 5000:
+            if not ignores_axis_order(params.get('HTTP_USER_AGENT', '')):
+                return True
+        return False
+
+    def _swapAxes(self, params, bbox):
+        if self._reverseAxes(params):
+            return [bbox[1], bbox[0], bbox[3], bbox[2]]
+        return list(bbox)
+
 class ExceptionHandler(BaseExceptionHandler):
 
     xmlmimetype = "text/xml"
@@ -0,0 +1,169 @@
+"""WMTS 1.0.0 GetCapabilities and GetTile interface on the fixed tile grids."""
+
+from xml.etree import ElementTree
+ElementTree.register_namespace('wmts', "http://www.opengis.net/wmts/1.0")
+ElementTree.register_namespace('ows', "http://www.opengis.net/ows/1.1")
+ElementTree.register_namespace('xlink', "http://www.w3.org/1999/xlink")
+
+from ogcserver.common import ParameterDefinition, WMSBaseServiceHandler, CRS, \
+                   Coord, to_unicode
+from ogcserver.settings import load_settings
+from ogcserver.tiles import GRIDS
+from ogcserver.exceptions import OGCException
+
+WMTS = '{http://www.opengis.net/wmts/1.0}'
+OWS = '{http://www.opengis.net/ows/1.1}'
+XLINK = '{http://www.w3.org/1999/xlink}'
+
+# file extension of each tile format in RESTful requests
+TILE_FORMATS = {'image/png': 'png', 'image/png8': 'png', 'image/jpeg': 'jpg'}
+
+# metres per unit, for the scale denominators of the tile matrices
+METERS_PER_UNIT = {'epsg:3857': 1.0, 'epsg:4326': 6378137 * 2 * 3.141592653589793 / 360}
+
+class ServiceHandler(WMSBaseServiceHandler):
+
+    SERVICE_PARAMS = {
+        'GetCapabilities': {
+            'updatesequence': ParameterDefinition(False, str)
+        },
+        'GetTile': {
+            'layer': ParameterDefinition(True, str),
+            'style': ParameterDefinition(False, str, ''),
+            'tilematrixset': ParameterDefinition(True, str),
+            'tilematrix': ParameterDefinition(True, int),
+            'tilerow': ParameterDefinition(True, int),
+            'tilecol': ParameterDefinition(True, int),
+            'format': ParameterDefinition(True, str, allowedvalues=('image/png', 'image/png8', 'image/jpeg'))
+        }
+    }
+
+    version = '1.0.0'
+
+    capabilitiesmimetype = 'application/xml'
+
+    def __init__(self, conf, mapfactory, opsonlineresource):
+        self.settings = load_settings(conf)
+        self.conf = self.settings.conf
+        self.mapfactory = mapfactory
+        self.opsonlineresource = opsonlineresource
+        self.allowedepsgcodes = self.settings.allowedepsgcodes
+        # the tile grids of the supported CRSs, by TileMatrixSet identifier
+        self.tilematrixsets = {}
+        for epsgcode in self.allowedepsgcodes:
+            if epsgcode in GRIDS:
+                self.tilematrixsets[GRIDS[epsgcode].name] = GRIDS[epsgcode]
+
+    def _buildCapabilities(self):
+        capetree = ElementTree.Element(WMTS + 'Capabilities')
+        capetree.set('version', self.version)
+        capetree.set('updateSequence', self.mapfactory.updatesequence)
+
+        serviceelem = ElementTree.SubElement(capetree, OWS + 'ServiceIdentification')
+        for option, tag in (('title', 'Title'), ('abstract', 'Abstract')):
+            if self.conf.has_option_with_value('service', option):
+                ElementTree.SubElement(serviceelem, OWS + tag).text = to_unicode(self.conf.get('service', option))
+        ElementTree.SubElement(serviceelem, OWS + 'ServiceType').text = 'OGC WMTS'
+        ElementTree.SubElement(serviceelem, OWS + 'ServiceTypeVersion').text = self.version
+
+        operationselem = ElementTree.SubElement(capetree, OWS + 'OperationsMetadata')
+        for operation in ('GetCapabilities', 'GetTile'):
+            operationelem = ElementTree.SubElement(operationselem, OWS + 'Operation')
+            operationelem.set('name', operation)
+            getelem = ElementTree.SubElement(ElementTree.SubElement(ElementTree.SubElement(operationelem, OWS + 'DCP'), OWS + 'HTTP'), OWS + 'Get')
+            getelem.set(XLINK + 'href', self.opsonlineresource)
+            constraintelem = ElementTree.SubElement(getelem, OWS + 'Constraint')
+            constraintelem.set('name', 'GetEncoding')
+            ElementTree.SubElement(ElementTree.SubElement(constraintelem, OWS + 'AllowedValues'), OWS + 'Value').text = 'KVP'
+
+        contentselem = ElementTree.SubElement(capetree, WMTS + 'Contents')
+        resourceurl = self.opsonlineresource.rstrip('?').rstrip('/')
+        for layer in self.mapfactory.ordered_layers:
+            if hasattr(layer, 'meta_style'):
+                continue
+            layerelem = ElementTree.SubElement(contentselem, WMTS + 'Layer')
+            if getattr(layer, 'title', None):
+                ElementTree.SubElement(layerelem, OWS + 'Title').text = to_unicode(layer.title)
+            if getattr(layer, 'abstract', None):
+                ElementTree.SubElement(layerelem, OWS + 'Abstract').text = to_unicode(layer.abstract)
+            layerproj = self.mapfactory.projection(layer.srs)
+            env = self.mapfactory.envelope(layer)
+            ll = layerproj.inverse(Coord(env.minx, env.miny))
+            ur = layerproj.inverse(Coord(env.maxx, env.maxy))
+            bboxelem = ElementTree.SubElement(layerelem, OWS + 'WGS84BoundingBox')
+            ElementTree.SubElement(bboxelem, OWS + 'LowerCorner').text = '%s %s' % (ll.x, ll.y)
+            ElementTree.SubElement(bboxelem, OWS + 'UpperCorner').text = '%s %s' % (ur.x, ur.y)
+            ElementTree.SubElement(layerelem, OWS + 'Identifier').text = to_unicode(layer.name)
+            styleelem = ElementTree.SubElement(layerelem, WMTS + 'Style')
+            styleelem.set('isDefault', 'true')
+            ElementTree.SubElement(styleelem, OWS + 'Identifier').text = 'default'
+            for extrastyle in layer.wmsextrastyles:
+                if extrastyle != 'default':
+                    styleelem = ElementTree.SubElement(layerelem, WMTS + 'Style')
+                    ElementTree.SubElement(styleelem, OWS + 'Identifier').text = to_unicode(extrastyle)
+            for format in ('image/png', 'image/jpeg'):
+                ElementTree.SubElement(layerelem, WMTS + 'Format').text = format
+            for name in sorted(self.tilematrixsets):
+                linkelem = ElementTree.SubElement(layerelem, WMTS + 'TileMatrixSetLink')
+                ElementTree.SubElement(linkelem, WMTS + 'TileMatrixSet').text = name
+            for format in ('image/png', 'image/jpeg'):
+                urlelem = ElementTree.SubElement(layerelem, WMTS + 'ResourceURL')
+                urlelem.set('format', format)
+                urlelem.set('resourceType', 'tile')
+                urlelem.set('template', '%s/%s/{Style}/{TileMatrixSet}/{TileMatrix}/{TileCol}/{TileRow}.%s' % (resourceurl, layer.name, TILE_FORMATS[format]))
+
+        for name in sorted(self.tilematrixsets):
+            grid = self.tilematrixsets[name]
+            setelem = ElementTree.SubElement(contentselem, WMTS + 'TileMatrixSet')
+            ElementTree.SubElement(setelem, OWS + 'Identifier').text = name
+            code = grid.crs.split(':')[1]
+            ElementTree.SubElement(setelem, OWS + 'SupportedCRS').text = 'urn:ogc:def:crs:EPSG::%s' % code
+            for z in range(grid.levels):
+                matrixelem = ElementTree.SubElement(setelem, WMTS + 'TileMatrix')
+                ElementTree.SubElement(matrixelem, OWS + 'Identifier').text = str(z)
+                scale = grid.span(z) / grid.tilesize * METERS_PER_UNIT[grid.crs] / 0.00028
+                ElementTree.SubElement(matrixelem, WMTS + 'ScaleDenominator').text = repr(scale)
+                if grid.crs == 'epsg:4326':
+                    # latitude first, as the EPSG axis order says
+                    topleft = '%s %s' % (grid.extent[3], grid.extent[0])
+                else:
+                    topleft = '%s %s' % (grid.extent[0], grid.extent[3])
+                ElementTree.SubElement(matrixelem, WMTS + 'TopLeftCorner').text = topleft
+                ElementTree.SubElement(matrixelem, WMTS + 'TileWidth').text = str(grid.tilesize)
+                ElementTree.SubElement(matrixelem, WMTS + 'TileHeight').text = str(grid.tilesize)
+                matrixwidth, matrixheight = grid.matrixsize(z)
+                ElementTree.SubElement(matrixelem, WMTS + 'MatrixWidth').text = str(matrixwidth)
+                ElementTree.SubElement(matrixelem, WMTS + 'MatrixHeight').text = str(matrixheight)
+
+        return ElementTree.tostring(capetree, encoding='UTF-8')
+
+    def GetTile(self, params):
+        grid = self.tilematrixsets.get(params['tilematrixset'])
+        if grid is None:
+            raise OGCException('Unknown TileMatrixSet "%s".' % params['tilematrixset'], 'InvalidParameterValue')
+        z, x, y = params['tilematrix'], params['tilecol'], params['tilerow']
+        # checked before the matrix size, which grows as 2 ** z
+        if z < 0 or z >= grid.levels:
+            raise OGCException('TileMatrix %d is outside of TileMatrixSet "%s".' % (z, grid.name), 'TileOutOfRange')
+        matrixwidth, matrixheight = grid.matrixsize(z)
+        if x < 0 or y < 0 or x >= matrixwidth or y >= matrixheight:
+            raise OGCException('Tile %d/%d/%d is outside of TileMatrixSet "%s".' % (z, x, y, grid.name), 'TileOutOfRange')
+        style = params.get('style', '')
+        if style == 'default':
+            # the default style of the layer, WMS spells it as an empty style
+            style = ''
+        namespace, code = grid.crs.split(':')
+        mapparams = {
+            'crs': CRS(namespace, code),
+            'bbox': grid.tile_bbox(z, x, y),
+            'width': grid.tilesize,
+            'height': grid.tilesize,
+            'layers': [params['layer']],
+            'styles': [style],
+            'format': params['format'],
+            'HTTP_USER_AGENT': params.get('HTTP_USER_AGENT', ''),
+        }
+        return self.GetMap(mapparams)
+
+def ServiceHandlerFactory(conf, mapfactory, onlineresource, version):
+    return ServiceHandler(conf, mapfactory, onlineresource)
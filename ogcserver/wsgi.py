@@ -5,19 +5,28 @@ try:
 except ImportError:
     from cgi import parse_qs
 
+import re
+import sys
+import time
 import logging
-import imp
 
 from cStringIO import StringIO
 
 import mapnik
 
-from ogcserver.common import Version
+from ogcserver.common import Version, ignores_axis_order
 from ogcserver.WMS import BaseWMSFactory
-from ogcserver.configparser import SafeConfigParser
+from ogcserver.cache import MemoryCache
+from ogcserver.dispatch import ServiceHandlerCache
+from ogcserver.settings import load_settings
 from ogcserver.wms111 import ExceptionHandler as ExceptionHandler111
 from ogcserver.wms130 import ExceptionHandler as ExceptionHandler130
-from ogcserver.exceptions import OGCException, ServerConfigurationError
+from ogcserver.exceptions import OGCException, RenderDeferred, ServerConfigurationError
+
+# RESTful WMTS GetTile requests
+TILE_PATH = re.compile(r'^/(?P<layer>[^/]+)/(?P<style>[^/]+)/(?P<tilematrixset>[^/]+)/(?P<tilematrix>\d+)/(?P<tilecol>\d+)/(?P<tilerow>\d+)\.(?P<extension>png|jpg|jpeg)$')
+
+TILE_FORMATS = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg'}
 
 WSGI_STATUS = {
     200: '200 OK',
@@ -25,50 +34,87 @@ WSGI_STATUS = {
     500: '500 SERVER ERROR',
 }
 
+def select_encoding(accept_encoding, encodings):
+    """
+    Picks the preferred content-coding out of the pre-encoded variants
+    available for a response, honouring q=0 exclusions.
+    """
+    if not accept_encoding or not encodings:
+        return None
+    accepted = {}
+    for token in accept_encoding.split(','):
+        parts = token.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    for coding in ('gzip', 'deflate'):
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > 0 and coding in encodings:
+            return coding
+    return None
+
+def memory_cache(settings):
+    """
+    Returns the in-process response cache configured for the application,
+    or None if it is disabled.
+    """
+    if settings.memorycachebytes > 0:
+        return MemoryCache(settings.memorycachebytes)
+    return None
+
 def do_import(module):
     """
     Makes setuptools namespaces work
     """
-    moduleobj = None
-    exec 'import %s' % module 
-    exec 'moduleobj=%s' % module
-    return moduleobj
+    __import__(module)
+    return sys.modules[module]
  
 class WSGIApp:
+    """
+    WSGI application serving the services of one map factory.  It may be
+    called from several threads at once, see 'Threads and processes' in
+    docs/readme.txt.
+    """
 
     def __init__(self, configpath, mapfile=None,fonts=None,home_html=None):
-        conf = SafeConfigParser()
-        conf.readfp(open(configpath))
+        settings = load_settings(configpath)
         # TODO - be able to supply in config as well
         self.home_html = home_html
-        self.conf = conf
+        self.settings = settings
+        self.conf = settings.conf
         if fonts:
             mapnik.register_fonts(fonts)
         if mapfile:
-            wms_factory = BaseWMSFactory(configpath)
+            wms_factory = BaseWMSFactory(settings)
             # TODO - add support for Cascadenik MML
             wms_factory.loadXML(mapfile)
             wms_factory.finalize()
             self.mapfactory = wms_factory
         else:
-            if not conf.has_option_with_value('server', 'module'):
+            if not settings.module:
                 raise ServerConfigurationError('The factory module is not defined in the configuration file.')
             try:
-                mapfactorymodule = do_import(conf.get('server', 'module'))
+                mapfactorymodule = do_import(settings.module)
             except ImportError:
                 raise ServerConfigurationError('The factory module could not be loaded.')
             if hasattr(mapfactorymodule, 'WMSFactory'):
                 self.mapfactory = getattr(mapfactorymodule, 'WMSFactory')()
             else:
                 raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
-        if conf.has_option('server', 'debug'):
-            self.debug = int(conf.get('server', 'debug'))
-        else:
-            self.debug = 0
-        if self.conf.has_option_with_value('server', 'maxage'):
-            self.max_age = 'max-age=%d' % self.conf.get('server', 'maxage')
+        self.debug = settings.debug
+        if settings.maxage is not None:
+            self.max_age = 'max-age=%d' % settings.maxage
         else:
             self.max_age = None
+        self.servicehandlers = ServiceHandlerCache(settings, self.mapfactory)
+        self.responsecache = memory_cache(settings)
 
     def __call__(self, environ, start_response):
         reqparams = {}
@@ -77,11 +123,24 @@ class WSGIApp:
             reqparams[key.lower()] = value[0]
             base = False
 
-        if self.conf.has_option_with_value('service', 'baseurl'):
-            onlineresource = '%s' % self.conf.get('service', 'baseurl')
+        pathinfo = environ['PATH_INFO']
+        tilepath = None
+        if base:
+            tilepath = TILE_PATH.match(pathinfo)
+        if tilepath:
+            reqparams = tilepath.groupdict()
+            reqparams['format'] = TILE_FORMATS[reqparams.pop('extension')]
+            reqparams['service'] = 'WMTS'
+            reqparams['request'] = 'GetTile'
+            base = False
+            # tiles are addressed below the service root
+            pathinfo = '/'
+
+        if self.settings.baseurl:
+            onlineresource = self.settings.baseurl
         else:
             # if there is no baseurl in the config file try to guess a valid one
-            onlineresource = 'http://%s%s%s?' % (environ['HTTP_HOST'], environ['SCRIPT_NAME'], environ['PATH_INFO'])
+            onlineresource = 'http://%s%s%s?' % (environ['HTTP_HOST'], environ['SCRIPT_NAME'], pathinfo)
 
         try:
             if not reqparams.has_key('request'):
@@ -100,27 +159,39 @@ class WSGIApp:
                     request = 'GetCapabilities'
             if reqparams.has_key('service'):
                 del reqparams['service']
-            try:
-                ogcserver = do_import('ogcserver')
-            except:
-                raise OGCException('Unsupported service "%s".' % service)
-            ServiceHandlerFactory = getattr(ogcserver, service).ServiceHandlerFactory
-            servicehandler = ServiceHandlerFactory(self.conf, self.mapfactory, onlineresource, reqparams.get('version', None))
-            if reqparams.has_key('version'):
-                del reqparams['version']
-            if request not in servicehandler.SERVICE_PARAMS.keys():
-                raise OGCException('Operation "%s" not supported.' % request, 'OperationNotSupported')
-            ogcparams = servicehandler.processParameters(request, reqparams)
-            try:
-                requesthandler = getattr(servicehandler, request)
-            except:
-                raise OGCException('Operation "%s" not supported.' % request, 'OperationNotSupported')
+            response = None
+            cachekey = None
+            if self.responsecache is not None and request in ('GetMap', 'GetFeatureInfo', 'GetTile'):
+                # the axis order of 1.3.0 requests depends on the client
+                cachekey = (request, tuple(sorted(reqparams.items())), ignores_axis_order(environ.get('HTTP_USER_AGENT', '')), self.mapfactory.updatesequence)
+                cached = self.responsecache.get(cachekey)
+                # entries live no longer than the maps of the response cache
+                # stay fresh
+                ttl = self.settings.cachesoftttl or self.settings.cachehardttl
+                if cached is not None and not (ttl and time.time() - cached[0] >= ttl):
+                    response = cached[1]
+            if response is None:
+                servicehandler = self.servicehandlers(service, onlineresource, reqparams.get('version', None))
+                if reqparams.has_key('version'):
+                    del reqparams['version']
+                if request not in servicehandler.SERVICE_PARAMS.keys():
+                    raise OGCException('Operation "%s" not supported.' % request, 'OperationNotSupported')
+                ogcparams = servicehandler.processParameters(request, reqparams)
+                try:
+                    requesthandler = getattr(servicehandler, request)
+                except:
+                    raise OGCException('Operation "%s" not supported.' % request, 'OperationNotSupported')
 
-            # stick the user agent in the request params
-            # so that we can add ugly hacks for specific buggy clients
-            ogcparams['HTTP_USER_AGENT'] = environ.get('HTTP_USER_AGENT', '')
+                # stick the user agent in the request params
+                # so that we can add ugly hacks for specific buggy clients
+                ogcparams['HTTP_USER_AGENT'] = environ.get('HTTP_USER_AGENT', '')
 
-            response = requesthandler(ogcparams)
+                response = requesthandler(ogcparams)
+                if cachekey is not None and not getattr(response, 'stale', False):
+                    self.responsecache.set(cachekey, (time.time(), response), len(response.content))
+        except RenderDeferred:
+            # handed over to a render thread by the front-end
+            raise
         except:
             version = reqparams.get('version', None)
             if not version:
@@ -132,12 +203,20 @@ class WSGIApp:
             else:
                 eh = ExceptionHandler111(self.debug,base,self.home_html)
             response = eh.getresponse(reqparams)
-        response_headers = [('Content-Type', response.content_type),('Content-Length', str(len(response.content)))]
+        content = response.content
+        response_headers = [('Content-Type', response.content_type)]
+        if response.encodings:
+            coding = select_encoding(environ.get('HTTP_ACCEPT_ENCODING'), response.encodings)
+            if coding:
+                content = response.encodings[coding]
+                response_headers.append(('Content-Encoding', coding))
+            response_headers.append(('Vary', 'Accept-Encoding'))
+        response_headers.append(('Content-Length', str(len(content))))
         if self.max_age:
             response_headers.append(('Cache-Control', self.max_age))
         status = WSGI_STATUS.get(response.status_code, '500 SERVER ERROR')
         start_response(status, response_headers)
-        yield response.content
+        yield content
 
 
 #  PasteDeploy factories [kiorky kiorky@cryptelium.net]
@@ -149,11 +228,11 @@ class BasePasteWSGIApp(WSGIApp):
                  home_html=None,
                  **kwargs
                 ):
-        conf = SafeConfigParser()
-        conf.readfp(open(configpath))
+        settings = load_settings(configpath)
         # TODO - be able to supply in config as well
         self.home_html = home_html
-        self.conf = conf
+        self.settings = settings
+        self.conf = settings.conf
         if fonts:
             mapnik.register_fonts(fonts)
         if 'debug' in kwargs:
@@ -165,9 +244,10 @@ class BasePasteWSGIApp(WSGIApp):
         else:
             self.debug=0
         if 'maxage' in kwargs:
-            self.max_age = 'max-age=%d' % kwargs.get('maxage')
+            self.max_age = 'max-age=%d' % int(kwargs.get('maxage'))
         else:
             self.max_age = None
+        self.responsecache = memory_cache(settings)
 
 class MapFilePasteWSGIApp(BasePasteWSGIApp):
     def __init__(self,
@@ -180,10 +260,11 @@ class MapFilePasteWSGIApp(BasePasteWSGIApp):
         BasePasteWSGIApp.__init__(self, 
                                   configpath, 
                                   font=fonts, home_html=home_html, **kwargs)
-        wms_factory = BaseWMSFactory(configpath)
+        wms_factory = BaseWMSFactory(self.settings)
         wms_factory.loadXML(mapfile)
         wms_factory.finalize()
         self.mapfactory = wms_factory
+        self.servicehandlers = ServiceHandlerCache(self.settings, self.mapfactory)
 
 class WMSFactoryPasteWSGIApp(BasePasteWSGIApp):
     def __init__(self,
@@ -204,6 +285,7 @@ class WMSFactoryPasteWSGIApp(BasePasteWSGIApp):
             self.mapfactory = getattr(mapfactorymodule, 'WMSFactory')(configpath)
         else:
             raise ServerConfigurationError('The factory module does not have a WMSFactory class.')
+        self.servicehandlers = ServiceHandlerCache(self.settings, self.mapfactory)
 
 def ogcserver_base_factory(base, global_config, **local_config):
     """
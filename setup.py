@@ -19,7 +19,7 @@ options = dict(name='ogcserver',
     keywords='mapnik,wms,gis,geospatial',
     url='https://github.com/mapnik/OGCServer',
     packages=['ogcserver'],
-    scripts=['bin/ogcserver'],
+    scripts=['bin/ogcserver', 'bin/ogcserver-seed'],
     package_data={
         'ogcserver':['default.conf'],
     },
@@ -0,0 +1,307 @@
+import nose
+import os
+import shutil
+import tempfile
+import threading
+import SocketServer
+from StringIO import StringIO
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.cache import DiskCache, MemoryCache, SQLiteCache, MemcachedCache, SingleFlight, \
+                            cache_from_config, single_flight_from_config
+from ogcserver.exceptions import ServerConfigurationError
+
+def _conf(text):
+    conf = SafeConfigParser()
+    conf.readfp(StringIO(text))
+    return conf
+
+def test_disk_cache():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(tmpdir, 100)
+        assert cache.get(('a',)) is None
+        cache.set(('a',), 'x' * 40)
+        cache.set(('b',), 'y' * 40)
+        assert cache.get(('a',)) == 'x' * 40
+        # 'b' is now the least recently used entry
+        cache.set(('c',), 'z' * 40)
+        assert cache.get(('b',)) is None
+        assert cache.get(('a',)) == 'x' * 40
+        assert cache.size == 80
+        # entries larger than the whole budget are not stored
+        cache.set(('d',), 'w' * 101)
+        assert cache.get(('d',)) is None
+
+        cache = DiskCache(tmpdir, 100)
+        assert cache.size == 80
+        assert cache.get(('c',)) == 'z' * 40
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_cache_from_config():
+    assert cache_from_config(_conf('[server]\n')) is None
+    assert cache_from_config(_conf('[cache]\npath=\nmaxbytes=10\n')) is None
+    assert cache_from_config(_conf('[cache]\ntype=none\npath=/tmp/ogcserver\n')) is None
+    assert isinstance(cache_from_config(_conf('[cache]\ntype=memory\nmaxbytes=10\n')), MemoryCache)
+    nose.tools.assert_raises(ServerConfigurationError, cache_from_config, _conf('[cache]\ntype=memcached\nservers=localhost\n'))
+    nose.tools.assert_raises(ServerConfigurationError, cache_from_config, _conf('[cache]\ntype=redis\n'))
+    nose.tools.assert_raises(ServerConfigurationError, cache_from_config, _conf('[cache]\npath=/tmp/ogcserver\n'))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = cache_from_config(_conf('[cache]\npath=%s\nmaxbytes=1000\n' % os.path.join(tmpdir, 'maps')))
+        assert cache.maxbytes == 1000
+        assert os.path.isdir(os.path.join(tmpdir, 'maps'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_memory_cache():
+    cache = MemoryCache(100)
+    value = object()
+    assert cache.get('a') is None
+    cache.set('a', value, 40)
+    cache.set('b', object(), 40)
+    assert cache.get('a') is value
+    # 'b' is now the least recently used entry
+    cache.set('c', object(), 40)
+    assert cache.get('b') is None
+    cache.set('d', object(), 101)
+    assert cache.get('d') is None
+    stats = cache.stats()
+    assert stats == {'hits': 1, 'misses': 3, 'evictions': 1, 'entries': 2, 'size': 80}
+
+def test_sqlite_cache():
+    import sqlite3
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'maps.mbtiles')
+        cache = SQLiteCache(path, batchsize=2, flushinterval=60)
+        assert cache.get(('a',)) is None
+        cache.set(('a',), 'x' * 40)
+        # buffered writes are visible before they are flushed
+        assert cache.get(('a',)) == 'x' * 40
+        cache.set(('b',), 'x' * 40)
+        assert not cache.pending
+        cache.set(('c',), 'y' * 40)
+        cache.flush()
+
+        cache = SQLiteCache(path)
+        assert cache.get(('a',)) == 'x' * 40
+        assert cache.get(('b',)) == 'x' * 40
+        assert cache.get(('c',)) == 'y' * 40
+        conn = sqlite3.connect(path)
+        # identical renderings are stored once
+        assert conn.execute('SELECT count(*) FROM images').fetchone()[0] == 2
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    finally:
+        shutil.rmtree(tmpdir)
+
+class FakeMemcached(SocketServer.ThreadingTCPServer):
+    """ Just enough of a memcached server to speak get, set and delete. """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeMemcachedHandler)
+        self.data = {}
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+class FakeMemcachedHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        data = self.server.data
+        for line in iter(self.rfile.readline, ''):
+            command = line.split()
+            if command[0] == 'get':
+                if command[1] in data:
+                    self.wfile.write('VALUE %s 0 %d\r\n%s\r\n' % (command[1], len(data[command[1]]), data[command[1]]))
+                self.wfile.write('END\r\n')
+            elif command[0] == 'set':
+                data[command[1]] = self.rfile.read(int(command[4]) + 2)[:-2]
+                self.wfile.write('STORED\r\n')
+            elif command[0] == 'delete':
+                self.wfile.write(data.pop(command[1], None) is None and 'NOT_FOUND\r\n' or 'DELETED\r\n')
+
+def _check_backend(cache):
+    assert cache.get(('a',)) is None
+    cache.set(('a',), 'x\r\nEND\r\n' * 10)
+    assert cache.get(('a',)) == 'x\r\nEND\r\n' * 10
+    cache.delete(('a',))
+    assert cache.get(('a',)) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 2)
+
+def test_backends():
+    tmpdir = tempfile.mkdtemp()
+    server = FakeMemcached()
+    try:
+        _check_backend(MemoryCache(1000))
+        _check_backend(DiskCache(os.path.join(tmpdir, 'disk'), 1000))
+        _check_backend(SQLiteCache(os.path.join(tmpdir, 'maps.mbtiles')))
+        _check_backend(MemcachedCache([server.server_address]))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+def test_memcached_shared():
+    server = FakeMemcached()
+    try:
+        conf = _conf('[cache]\ntype=memcached\nservers=%s:%d\n' % server.server_address)
+        cache_from_config(conf).set(('a',), 'x')
+        # a second process configured alike sees the entry
+        assert cache_from_config(conf).get(('a',)) == 'x'
+    finally:
+        server.shutdown()
+    # an unreachable server is a miss rather than an error
+    assert cache_from_config(conf).get(('a',)) is None
+
+def test_single_flight():
+    import time
+    flight = SingleFlight()
+    calls = []
+    results = []
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        return object()
+    threads = [threading.Thread(target=lambda: results.append(flight.do(('a',), render))) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(results) == 5 and len(set(results)) == 1
+    # once finished the next call runs again
+    flight.do(('a',), render)
+    assert len(calls) == 2
+
+    def fail():
+        raise ValueError('render failed')
+    nose.tools.assert_raises(ValueError, flight.do, ('a',), fail)
+    assert not flight.calls
+
+def test_single_flight_lock():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(os.path.join(tmpdir, 'disk'), 1000)
+        flight = single_flight_from_config(_conf('[cache]\nlockdir=%s\n' % os.path.join(tmpdir, 'locks')), cache)
+        assert flight.lockdir == os.path.join(tmpdir, 'locks')
+        # rendered by another process while waiting for the lock
+        cache.set(('a',), 'x')
+        def render():
+            raise Exception('Cached entry was rendered again')
+        assert flight.do(('a',), render, lambda: cache.get(('a',))) == 'x'
+        assert single_flight_from_config(None, MemoryCache(1000)).lockdir is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_single_flight_start():
+    import time
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+    def render():
+        calls.append(1)
+        release.wait()
+        return 'x'
+    assert flight.start(('a',), render)
+    # a call already in flight is not started twice
+    assert not flight.start(('a',), render)
+    # and callers meanwhile get its result
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(flight.do(('a',), render)))
+    waiter.start()
+    time.sleep(0.1)
+    release.set()
+    waiter.join()
+    assert results == ['x']
+    assert len(calls) == 1
+    for i in range(100):
+        if not flight.calls:
+            break
+        time.sleep(0.01)
+    assert not flight.calls
+
+    def fail():
+        raise ValueError('render failed')
+    assert flight.start(('b',), fail)
+    for i in range(100):
+        if not flight.calls:
+            break
+        time.sleep(0.01)
+    assert not flight.calls
+
+def test_disk_cache_shared():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        first = DiskCache(tmpdir, 100)
+        second = DiskCache(tmpdir, 100)
+        first.set(('a',), 'x' * 60)
+        # written by another process after this one scanned the directory
+        assert second.get(('a',)) == 'x' * 60
+        # and counted against the same budget
+        second.set(('b',), 'y' * 60)
+        assert first.get(('a',)) is None
+        assert first.get(('b',)) == 'y' * 60
+
+        # a rescan takes in entries this process never read
+        third = DiskCache(tmpdir, 100, scaninterval=0)
+        first.set(('c',), 'z' * 30)
+        third.set(('d',), 'w' * 30)
+        assert third.size == 60
+        assert third.get(('b',)) is None
+        assert third.get(('c',)) == 'z' * 30
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_single_flight_flush():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'maps.mbtiles')
+        cache = SQLiteCache(path, batchsize=100, flushinterval=60)
+        flight = single_flight_from_config(_conf('[cache]\nlockdir=%s\n' % os.path.join(tmpdir, 'locks')), cache)
+        def render():
+            cache.set(('a',), 'x')
+            return 'x'
+        flight.do(('a',), render)
+        # another process opening the file finds the render once the lock
+        # is released
+        assert not cache.pending
+        assert SQLiteCache(path).get(('a',)) == 'x'
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_sqlite_cache_cleanup():
+    import sqlite3
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'maps.mbtiles')
+        cache = SQLiteCache(path, batchsize=1, maxbytes=100, cleanupinterval=60)
+        cache.set(('a',), 'x' * 40)
+        cache.set(('b',), 'y' * 40)
+        cache.delete(('b',))
+        cache.set(('c',), 'z' * 40)
+        cache.set(('d',), 'w' * 40)
+        cache.cleanup()
+        conn = sqlite3.connect(path)
+        # the image of the deleted entry is gone, and the oldest entry was
+        # evicted to fit the budget
+        assert conn.execute('SELECT sum(length(tile_data)) FROM images').fetchone()[0] == 80
+        assert cache.get(('a',)) is None
+        assert cache.get(('c',)) == 'z' * 40
+        assert cache.get(('d',)) == 'w' * 40
+        assert cache_from_config(_conf('[cache]\ntype=sqlite\npath=%s\nmaxbytes=1000\n' % path)).maxbytes == 1000
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_base_cache():
+    from ogcserver.cache import BaseCache
+    # stores nothing, rather than failing requests
+    cache = BaseCache()
+    cache.set(('a',), 'x')
+    assert cache.get(('a',)) is None
+    cache.delete(('a',))
+    cache.flush()
+    assert cache.stats() == {'hits': 0, 'misses': 1, 'evictions': 0}
@@ -0,0 +1,36 @@
+import nose
+import os
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.WMS import BaseWMSFactory
+from ogcserver.dispatch import ServiceHandlerCache
+from ogcserver.wms111 import ServiceHandler as ServiceHandler111
+from ogcserver.wms130 import ServiceHandler as ServiceHandler130
+
+def _servicehandlers(maxsize=32):
+    base_path, tail = os.path.split(__file__)
+    wms = BaseWMSFactory()
+    wms.loadXML(os.path.join(base_path, 'mapfile_encoding.xml'))
+    wms.finalize()
+
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(base_path, 'ogcserver.conf')))
+    return ServiceHandlerCache(conf, wms, maxsize)
+
+def test_handlers_are_reused():
+    servicehandlers = _servicehandlers()
+    first = servicehandlers('WMS', 'localhost', '1.3.0')
+    assert isinstance(first, ServiceHandler130)
+    assert servicehandlers('WMS', 'localhost', '1.3.0') is first
+    assert isinstance(servicehandlers('WMS', 'localhost', None), ServiceHandler111)
+    assert servicehandlers('WMS', 'otherhost', '1.3.0') is not first
+
+def test_cache_is_bounded():
+    servicehandlers = _servicehandlers(maxsize=2)
+    for host in ('a', 'b', 'c'):
+        servicehandlers('WMS', host, '1.1.1')
+    assert len(servicehandlers.handlers) <= 2
+
+def test_unsupported_service():
+    from ogcserver.exceptions import OGCException
+    servicehandlers = _servicehandlers()
+    nose.tools.assert_raises(OGCException, servicehandlers, 'WFS', 'localhost', '1.1.1')
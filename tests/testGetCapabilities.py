@@ -52,3 +52,86 @@ def test_latlonbbox():
         '{http://www.opengis.net/wms}EX_GeographicBoundingBox')
 
     return True
+
+def test_capabilities_cache():
+    base_path, tail = os.path.split(__file__)
+    file_path = os.path.join(base_path, 'mapfile_encoding.xml')
+    wms = BaseWMSFactory()
+    wms.loadXML(file_path)
+    wms.finalize()
+
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(base_path, 'ogcserver.conf')))
+
+    # every request gets a new handler, the document must survive them
+    first = ServiceHandler111(conf, wms, "localhost").GetCapabilities({})
+    second = ServiceHandler111(conf, wms, "localhost").GetCapabilities({})
+    assert first.content is second.content
+    assert ('1.1.1', 'localhost', wms.updatesequence) in wms.capabilities_cache
+
+    other = ServiceHandler111(conf, wms, "otherhost").GetCapabilities({})
+    assert other.content is not first.content
+
+    # the online resource may come from the Host header, so the store is
+    # bounded
+    for i in range(wms.capabilities_cache_size + 1):
+        ServiceHandler111(conf, wms, "host%d" % i).GetCapabilities({})
+    assert 0 < len(wms.capabilities_cache) <= wms.capabilities_cache_size
+
+    # reloading the factory invalidates the store
+    wms.finalize()
+    assert len(wms.capabilities_cache) == 0
+
+    return True
+
+def test_updatesequence():
+    from xml.etree import ElementTree
+    from ogcserver.exceptions import OGCException
+
+    base_path, tail = os.path.split(__file__)
+    file_path = os.path.join(base_path, 'mapfile_encoding.xml')
+    wms = BaseWMSFactory()
+    wms.loadXML(file_path)
+    wms.finalize()
+    assert len(wms.updatesequence) == 40
+
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(base_path, 'ogcserver.conf')))
+    wms111 = ServiceHandler111(conf, wms, "localhost")
+
+    caps = ElementTree.XML(wms111.GetCapabilities({}).content)
+    assert caps.get('updateSequence') == wms.updatesequence
+
+    # an older sequence gets the full document
+    wms111.GetCapabilities({'updatesequence': '0' * 40})
+
+    def assert_code(updatesequence, code):
+        try:
+            wms111.GetCapabilities({'updatesequence': updatesequence})
+        except OGCException, e:
+            assert e.args[1] == code
+        else:
+            raise Exception('Expected a %s exception' % code)
+
+    assert_code(wms.updatesequence, 'CurrentUpdateSequence')
+    assert_code('not-issued-here', 'InvalidUpdateSequence')
+
+    return True
+
+def test_updatesequence_registered():
+    from mapnik import Layer, Style, Rule
+
+    def updatesequence(rules):
+        wms = BaseWMSFactory()
+        style = Style()
+        for i in range(rules):
+            style.rules.append(Rule())
+        wms.register_style('style', style)
+        wms.register_layer(Layer('layer', '+init=epsg:4326'), 'style')
+        wms.finalize()
+        return wms.updatesequence
+
+    # factories built without loadXML follow their layers and styles too
+    assert len(updatesequence(1)) == 40
+    assert updatesequence(1) == updatesequence(1)
+    assert updatesequence(1) != updatesequence(2)
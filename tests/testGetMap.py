@@ -5,6 +5,7 @@ from ogcserver.WMS import BaseWMSFactory
 from ogcserver.wms111 import ServiceHandler as ServiceHandler111
 from ogcserver.wms130 import ServiceHandler as ServiceHandler130
 from ogcserver.common import ColorFactory
+from ogcserver.settings import load_settings
 
 def _wms_services(mapfile):
     base_path, tail = os.path.split(__file__)
@@ -139,3 +140,245 @@ def test_url_background_color_transparent():
     m = services['1.3.0']._buildMap(ogcparams)
     print 'wms 1.3.0 backgound color: %s' % m.background
     assert m.background == None
+
+def test_map_pool():
+    conf, services = _wms_services('mapfile_encoding.xml')
+
+    reqparams = {
+        'srs': 'EPSG:4326',
+        'bbox': '-180.0000,-90.0000,180.0000,90.0000',
+        'width': 800,
+        'height': 600,
+        'layers': '__all__',
+        'styles': '',
+        'format': 'image/png',
+    }
+
+    servicehandler = services['1.1.1']
+    ogcparams = servicehandler.processParameters('GetMap', dict(reqparams))
+    ogcparams['crs'] = ogcparams['srs']
+    ogcparams['HTTP_USER_AGENT'] = 'unit_tests'
+
+    m = servicehandler._buildMap(ogcparams)
+    servicehandler.mapfactory.map_pool.checkin(m)
+
+    # same layers and styles at another size reuse the assembled map
+    ogcparams['width'] = 256
+    ogcparams['height'] = 256
+    pooled = servicehandler._buildMap(ogcparams)
+    assert pooled is m
+    assert (pooled.width, pooled.height) == (256, 256)
+    assert len(pooled.layers) == 1
+
+    # while checked out it is not handed to anyone else
+    assert servicehandler._buildMap(ogcparams) is not m
+
+def test_response_cache():
+    import shutil, tempfile
+    from ogcserver.cache import DiskCache
+    conf, services = _wms_services('mapfile_encoding.xml')
+
+    reqparams = {
+        'srs': 'EPSG:4326',
+        'bbox': '-180.0000,-90.0000,180.0000,90.0000',
+        'width': 256,
+        'height': 256,
+        'layers': '__all__',
+        'styles': '',
+        'format': 'image/png',
+    }
+
+    servicehandler = services['1.1.1']
+    tmpdir = tempfile.mkdtemp()
+    try:
+        servicehandler.mapfactory.response_cache = DiskCache(tmpdir, 1024 * 1024)
+        ogcparams = servicehandler.processParameters('GetMap', dict(reqparams))
+        ogcparams['HTTP_USER_AGENT'] = 'unit_tests'
+        rendered = servicehandler.GetMap(ogcparams)
+
+        # a hit is served without assembling a map
+        def fail(params):
+            raise Exception('Cached map was rendered again')
+        servicehandler._buildMap = fail
+        cached = servicehandler.GetMap(dict(ogcparams))
+        assert cached.content_type == rendered.content_type
+        assert cached.content == rendered.content
+    finally:
+        servicehandler.mapfactory.response_cache = None
+        shutil.rmtree(tmpdir)
+
+    return True
+
+def _cached_service(mapfile, **cacheoptions):
+    """ Returns a WMS 1.1.1 service handler for mapfile, with settings
+        loaded from the test configuration and a [cache] section of a memory
+        cache and cacheoptions.
+    """
+    base_path, tail = os.path.split(__file__)
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(base_path, 'ogcserver.conf')))
+    conf.add_section('cache')
+    conf.set('cache', 'type', 'memory')
+    conf.set('cache', 'maxbytes', str(1024 * 1024))
+    for option, value in cacheoptions.items():
+        conf.set('cache', option, str(value))
+    settings = load_settings(conf)
+
+    wms = BaseWMSFactory(settings)
+    wms.loadXML(os.path.join(base_path, mapfile))
+    wms.finalize()
+    return ServiceHandler111(settings, wms, "localhost")
+
+def _map_request(servicehandler, **reqparams):
+    """ Returns the processed parameters of a 256 pixel GetMap request of
+        the whole world, updated with reqparams.
+    """
+    params = {
+        'srs': 'EPSG:4326',
+        'bbox': '-180.0000,-90.0000,180.0000,90.0000',
+        'width': 256,
+        'height': 256,
+        'layers': '__all__',
+        'styles': '',
+        'format': 'image/png',
+    }
+    params.update(reqparams)
+    ogcparams = servicehandler.processParameters('GetMap', params)
+    ogcparams['HTTP_USER_AGENT'] = 'unit_tests'
+    return ogcparams
+
+def test_metatile():
+    from ogcserver.tiles import GRIDS
+
+    grid = GRIDS['epsg:4326']
+    servicehandler = _cached_service('mapfile_encoding.xml', metatile=2)
+    ogcparams = _map_request(servicehandler, bbox=','.join(['%.6f' % value for value in grid.tile_bbox(2, 1, 1)]))
+    response = servicehandler.GetMap(ogcparams)
+    assert response.content_type == 'image/png'
+    # the whole two by two block was rendered and cached at once
+    assert servicehandler.mapfactory.response_cache.stats()['entries'] == 4
+
+    def fail(params):
+        raise Exception('Neighbouring tile was rendered again')
+    servicehandler._buildMap = fail
+    ogcparams = _map_request(servicehandler, bbox=','.join(['%.6f' % value for value in grid.tile_bbox(2, 0, 0)]))
+    servicehandler.GetMap(ogcparams)
+
+    return True
+
+def test_stale_response():
+    import time
+    from ogcserver.cache import MemoryCache
+
+    servicehandler = _cached_service('mapfile_encoding.xml', softttl=60, hardttl=3600)
+    buildmap = servicehandler._buildMap
+    ogcparams = _map_request(servicehandler)
+    rendered = servicehandler.GetMap(dict(ogcparams))
+    assert not rendered.stale
+    cachekey = servicehandler._responseCacheKey(ogcparams)
+    def age(seconds):
+        cache = servicehandler.mapfactory.response_cache
+        created, content = cache.get(cachekey).split('\n', 1)
+        cache.set(cachekey, '%r\n%s' % (time.time() - seconds, content))
+
+    # a stale map is served at once and refreshed in the background
+    age(120)
+    refreshed = []
+    def build(params):
+        refreshed.append(1)
+        return buildmap(params)
+    servicehandler._buildMap = build
+    stale = servicehandler.GetMap(dict(ogcparams))
+    assert stale.stale
+    assert stale.content == rendered.content
+    for i in range(100):
+        if not servicehandler.mapfactory.single_flight.calls:
+            break
+        time.sleep(0.05)
+    assert refreshed == [1]
+
+    # an expired map is served when rendering it again fails
+    age(7200)
+    def fail(params):
+        raise RuntimeError('datasource is down')
+    servicehandler._buildMap = fail
+    expired = servicehandler.GetMap(dict(ogcparams))
+    assert expired.stale
+    assert expired.content == rendered.content
+
+    # with nothing to fall back on the error goes through
+    servicehandler.mapfactory.response_cache = MemoryCache(1024 * 1024)
+    nose.tools.assert_raises(RuntimeError, servicehandler.GetMap, dict(ogcparams))
+
+    return True
+
+def test_layer_cache():
+    servicehandler = _cached_service('mapfile_styles.xml', layers='true')
+    buildmap = servicehandler._buildMap
+    built = []
+    def build(params):
+        built.append(tuple(params['layers']))
+        return buildmap(params)
+    servicehandler._buildMap = build
+
+    response = servicehandler.GetMap(_map_request(servicehandler, layers='single-style-layer,multi-style-layer'))
+    assert response.content_type == 'image/png'
+    # the background is filled in rather than drawn
+    assert built == [('single-style-layer',), ('multi-style-layer',)]
+
+    # another combination of the same layers draws nothing
+    del built[:]
+    servicehandler.GetMap(_map_request(servicehandler, layers='multi-style-layer,single-style-layer'))
+    assert built == []
+
+    # a layer that opted out has the map rendered as a whole
+    del built[:]
+    servicehandler.mapfactory.uncached_layers.add('single-style-layer')
+    servicehandler.GetMap(_map_request(servicehandler, layers='multi-style-layer,single-style-layer', transparent='true'))
+    assert built == [('multi-style-layer', 'single-style-layer')]
+
+    return True
+
+def test_map_pool_threads():
+    import threading
+    from ogcserver.common import MapPool
+    class FakeMap:
+        poolkey = ('epsg:4326',)
+    pool = MapPool()
+    m = FakeMap()
+    pool.checkin(m)
+    # maps stay with the thread that checked them in
+    others = []
+    thread = threading.Thread(target=lambda: others.append(pool.checkout(FakeMap.poolkey)))
+    thread.start()
+    thread.join()
+    assert others == [None]
+    assert pool.checkout(FakeMap.poolkey) is m
+    pool.checkin(m)
+    pool.clear()
+    assert pool.checkout(FakeMap.poolkey) is None
+
+    return True
+
+def test_response_cache_axes():
+    conf, services = _wms_services('mapfile_encoding.xml')
+
+    reqparams = {
+        'crs': 'EPSG:4326',
+        'bbox': '-90.0000,-180.0000,90.0000,180.0000',
+        'width': 256,
+        'height': 256,
+        'layers': '__all__',
+        'styles': '',
+        'format': 'image/png',
+    }
+
+    servicehandler = services['1.3.0']
+    ogcparams = servicehandler.processParameters('GetMap', dict(reqparams))
+    ogcparams['HTTP_USER_AGENT'] = 'unit_tests'
+    mapinfoparams = dict(ogcparams)
+    mapinfoparams['HTTP_USER_AGENT'] = 'MapInfo Pro 10'
+    # the same bbox is another map for clients ignoring the axis order
+    assert servicehandler._responseCacheKey(ogcparams) != servicehandler._responseCacheKey(mapinfoparams)
+
+    return True
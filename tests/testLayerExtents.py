@@ -0,0 +1,76 @@
+import nose
+import os, sys
+import shutil
+import tempfile
+import StringIO
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.WMS import BaseWMSFactory
+
+def _wms_factory(conf):
+    base_path, tail = os.path.split(__file__)
+    wms = BaseWMSFactory(conf)
+    # mapfile_styles.xml warns about its 'awkward-layer' on stderr
+    stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    try:
+        wms.loadXML(os.path.join(base_path, 'mapfile_styles.xml'))
+    finally:
+        sys.stderr = stderr
+    wms.finalize()
+    return wms
+
+def test_configured_extent():
+    conf = SafeConfigParser()
+    conf.add_section('layer_single-style-layer')
+    conf.set('layer_single-style-layer', 'extent', '-10,-20,10,20')
+    wms = _wms_factory(conf)
+
+    env = wms.envelope(wms.layers['single-style-layer'])
+    if (env.minx, env.miny, env.maxx, env.maxy) != (-10, -20, 10, 20):
+        raise Exception('Configured layer extent was not used')
+
+    return True
+
+def test_extent_cache():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        conf = SafeConfigParser()
+        conf.add_section('server')
+        conf.set('server', 'extentcache', os.path.join(tmpdir, 'extents.json'))
+
+        wms = _wms_factory(conf)
+        if wms.latlonbb is not None:
+            raise Exception('Layer extents were computed before they were needed')
+        wms.get_latlonbb()
+        if not os.path.exists(os.path.join(tmpdir, 'extents.json')):
+            raise Exception('Layer extent cache was not written')
+
+        wms = _wms_factory(conf)
+        for layer in wms.ordered_layers:
+            if wms.extent_cache.get(layer) is None:
+                raise Exception('Layer extent of "%s" was not cached' % layer.name)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return True
+
+def test_extent_cache_shapefile():
+    from ogcserver.WMS import ExtentCache
+    class FakeDatasource:
+        def params(self):
+            return {'type': 'shape', 'file': os.path.join(tmpdir, 'roads')}
+    class FakeLayer:
+        datasource = FakeDatasource()
+        srs = '+init=epsg:4326'
+    tmpdir = tempfile.mkdtemp()
+    try:
+        open(os.path.join(tmpdir, 'roads.shp'), 'w').close()
+        cache = ExtentCache(os.path.join(tmpdir, 'extents.json'))
+        key = cache.key(FakeLayer())
+        # rewriting the shapefile invalidates its extent
+        os.utime(os.path.join(tmpdir, 'roads.shp'), (0, 0))
+        assert cache.key(FakeLayer()) != key
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return True
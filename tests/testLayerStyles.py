@@ -218,6 +218,23 @@ def test_map():
     return True
 
 
+def test_compiled_layer_styles():
+    conf, services = _wms_services('mapfile_styles.xml')
+    layer_styles = services['1.1.1'].mapfactory.layer_styles
+
+    def names(layer, style):
+        return [stylename for stylename, style in layer_styles[(layer, style)]]
+
+    assert names('single-style-layer', '') == ['simple-style']
+    assert ('single-style-layer', 'default') not in layer_styles
+    assert names('multi-style-layer', 'default') == ['simple-style', 'another-style']
+    assert names('multi-style-layer', 'another-style') == ['another-style']
+    assert names('awkward-layer', 'default') == ['default', 'another-style']
+    assert names('single-default-layer', 'default') == ['default']
+
+    return True
+
+
 # Running the tests without nose
 #test_capabilities()
 #test_map()      
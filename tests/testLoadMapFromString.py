@@ -17,3 +17,15 @@ def test_wms_capabilities():
         raise Exception('Incorrect number of styles')
     
     return True
+
+def test_style_registry():
+    from ogcserver.exceptions import ServerConfigurationError
+    base_path, tail = os.path.split(__file__)
+    wms = BaseWMSFactory()
+    wms.loadXML(os.path.join(base_path, 'mapfile_styles.xml'))
+    wms.finalize()
+
+    assert wms.stylenames == set(wms.styles.keys()) | set(wms.aggregatestyles.keys())
+    for name in list(wms.stylenames):
+        nose.tools.assert_raises(ServerConfigurationError, wms.register_aggregate_style, name, ())
+        nose.tools.assert_raises(ServerConfigurationError, wms.register_style, name, wms.styles.values()[0])
@@ -0,0 +1,159 @@
+import os
+import time
+import nose
+import threading
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.renderpool import RenderPool, render_pool_from_config
+from ogcserver.exceptions import OGCException, RenderTimeout, ServerConfigurationError
+from StringIO import StringIO
+
+class FakeCache:
+
+    def __init__(self):
+        self.pending = 0
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += self.pending
+        self.pending = 0
+
+class FakeFactory:
+    conf = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.response_cache = FakeCache()
+
+class FakeHandler:
+
+    def __init__(self, conf, mapfactory, opsonlineresource):
+        self.mapfactory = mapfactory
+        self.opsonlineresource = opsonlineresource
+
+    def locked(self):
+        with self.mapfactory.lock:
+            return os.getpid()
+
+    def pid(self):
+        return os.getpid()
+
+    def cached(self):
+        self.mapfactory.response_cache.pending += 1
+        return self.mapfactory.response_cache.flushes
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return os.getpid()
+
+    def fail(self):
+        raise OGCException('Invalid style "x" requested.', 'StyleNotDefined')
+
+    def crash(self):
+        os._exit(1)
+
+    def payload(self, size):
+        return 'x' * size
+
+    def tiles(self, size):
+        return {(0, 0): 'a' * size, (0, 1): 'b' * size}
+
+    def grow(self):
+        self.ballast = 'x' * (64 * 1024 * 1024)
+        return os.getpid()
+
+def test_render_pool():
+    pool = RenderPool(FakeFactory(), 1, timeout=1)
+    handler = FakeHandler(None, None, 'localhost')
+    pool.start()
+    pid = pool.call(handler, 'pid')
+    assert pid != os.getpid()
+    # the worker is reused
+    assert pool.call(handler, 'pid') == pid
+
+    try:
+        pool.call(handler, 'fail')
+        assert False
+    except OGCException, e:
+        assert e.args == ('Invalid style "x" requested.', 'StyleNotDefined')
+    assert pool.call(handler, 'pid') == pid
+
+    # a render over the timeout has its worker killed and replaced
+    nose.tools.assert_raises(RenderTimeout, pool.call, handler, 'sleep', 5)
+    replaced = pool.call(handler, 'pid')
+    assert replaced != pid
+    nose.tools.assert_raises(RuntimeError, pool.call, handler, 'crash')
+    assert pool.call(handler, 'pid') != replaced
+
+def test_render_pool_recycling():
+    handler = FakeHandler(None, None, 'localhost')
+    pool = RenderPool(FakeFactory(), 1, maxrenders=2)
+    pool.start()
+    pids = [pool.call(handler, 'pid') for i in range(4)]
+    assert pids[0] == pids[1] != pids[2] == pids[3]
+
+    pool = RenderPool(FakeFactory(), 1, maxrss=32 * 1024 * 1024)
+    pool.start()
+    pid = pool.call(handler, 'grow')
+    assert pool.call(handler, 'pid') != pid
+
+def test_render_pool_shared_memory():
+    handler = FakeHandler(None, None, 'localhost')
+    pool = RenderPool(FakeFactory(), 2, shmbytes=1024)
+    pool.start()
+    assert pool.call(handler, 'payload', 1000) == 'x' * 1000
+    assert pool.call(handler, 'tiles', 500) == {(0, 0): 'a' * 500, (0, 1): 'b' * 500}
+    # results larger than a slot are pickled
+    assert pool.call(handler, 'payload', 2000) == 'x' * 2000
+    assert pool.call(handler, 'tiles', 1000) == {(0, 0): 'a' * 1000, (0, 1): 'b' * 1000}
+    assert pool.call(handler, 'pid') != os.getpid()
+    assert len(pool.shm) == 2048
+
+def test_render_pool_from_config():
+    def conf(text):
+        conf = SafeConfigParser()
+        conf.readfp(StringIO(text))
+        return conf
+    assert render_pool_from_config(None, None) is None
+    assert render_pool_from_config(conf('[server]\nrenderprocesses=\n'), None) is None
+    pool = render_pool_from_config(conf('[server]\nrenderprocesses=2\nrendertimeout=30\nrendermaxrss=512\nrendershm=16\n'), None)
+    assert (pool.processes, pool.timeout, pool.maxrenders, pool.maxrss) == (2, 30, 0, 512 * 1024 * 1024)
+    assert pool.shmbytes == 16 * 1024 * 1024
+    nose.tools.assert_raises(ServerConfigurationError, render_pool_from_config, conf('[server]\nrenderprocesses=many\n'), None)
+
+def test_render_pool_start():
+    factory = FakeFactory()
+    handler = FakeHandler(None, factory, 'localhost')
+    pool = RenderPool(factory, 2, timeout=5)
+    pool.start()
+    pids = set([worker.pid for slot, worker in pool.idle.queue])
+    assert len(pids) == 2
+    assert pool.call(handler, 'pid') in pids
+
+    # a replacement is not forked from this process, so it does not
+    # inherit the locks its threads hold
+    with factory.lock:
+        nose.tools.assert_raises(RuntimeError, pool.call, handler, 'crash')
+        for i in range(2):
+            assert pool.call(handler, 'locked') != os.getpid()
+
+def test_render_pool_threads():
+    pool = RenderPool(FakeFactory(), 1)
+    handler = FakeHandler(None, None, 'localhost')
+    release = threading.Event()
+    thread = threading.Thread(target=release.wait, args=(10,))
+    thread.start()
+    try:
+        # not forked lazily from a process running other threads
+        nose.tools.assert_raises(ServerConfigurationError, pool.call, handler, 'pid')
+    finally:
+        release.set()
+        thread.join()
+
+def test_render_pool_flush():
+    factory = FakeFactory()
+    handler = FakeHandler(None, factory, 'localhost')
+    pool = RenderPool(factory, 1)
+    pool.start()
+    # the cache writes of a render are flushed before its result is sent
+    assert pool.call(handler, 'cached') == 0
+    assert pool.call(handler, 'cached') == 1
@@ -0,0 +1,74 @@
+import nose
+import os
+import shutil
+import tempfile
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.seed import Seeder
+from ogcserver.tiles import GRIDS
+
+def _seeder(cachedir, cachetype='disk'):
+    base_path, tail = os.path.split(__file__)
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(base_path, 'ogcserver.conf')))
+    conf.add_section('cache')
+    conf.set('cache', 'type', cachetype)
+    conf.set('cache', 'path', cachedir)
+    conf.set('cache', 'maxbytes', str(1024 * 1024))
+    return Seeder(os.path.join(base_path, 'mapfile_encoding.xml'), conf, format='image/png')
+
+def test_units():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        seeder = _seeder(tmpdir)
+        grid = GRIDS['epsg:4326']
+        units, count = seeder.units(grid, grid.extent, [0, 1])
+        # at most the two tiles of level 0 and eight of level 1
+        assert 0 < count <= 10
+        assert len(units) == count
+        for z, x, y in units:
+            assert z in (0, 1)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_seed():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        seeder = _seeder(tmpdir)
+        grid = GRIDS['epsg:4326']
+        units, count = seeder.units(grid, grid.extent, [0])
+        seeder.seed(grid, *units[0])
+        assert seeder.mapfactory.response_cache.stats()['entries'] == 1
+        # seeding a cached tile does not render it again
+        seeder.seed(grid, *units[0])
+        assert seeder.mapfactory.response_cache.stats()['hits'] == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_seed_memory_cache():
+    from ogcserver.exceptions import ServerConfigurationError
+    # the seeding processes would render into caches of their own
+    nose.tools.assert_raises(ServerConfigurationError, _seeder, '', 'memory')
+
+def test_seed_progress():
+    from ogcserver.seed import main
+    from ogcserver.exceptions import ServerConfigurationError
+    base_path, tail = os.path.split(__file__)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        conf = SafeConfigParser()
+        conf.readfp(open(os.path.join(base_path, 'ogcserver.conf')))
+        conf.add_section('cache')
+        conf.set('cache', 'type', 'disk')
+        conf.set('cache', 'path', os.path.join(tmpdir, 'cache'))
+        conf.set('cache', 'maxbytes', str(1024 * 1024))
+        configfile = os.path.join(tmpdir, 'ogcserver.conf')
+        conf.write(open(configfile, 'w'))
+        progress = os.path.join(tmpdir, 'progress')
+        args = [os.path.join(base_path, 'mapfile_encoding.xml'), '-c', configfile, '-g', 'epsg:4326', '-j', '1', '-p', progress]
+        assert main(args + ['-z', '0']) == 0
+        assert open(progress).readline().startswith('#')
+        assert main(args + ['-z', '0']) == 0
+        # the units recorded for other parameters are not skipped
+        nose.tools.assert_raises(ServerConfigurationError, main, args + ['-z', '0-1'])
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,207 @@
+import os
+import time
+import signal
+import urllib2
+import threading
+from ogcserver.server import PreforkServer
+
+def _pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+def _wait(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+def test_prefork_server():
+    server = PreforkServer(_pid_app, '127.0.0.1', 0, 2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        _wait(lambda: len(server.children) == 2)
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        pid = int(urllib2.urlopen(url).read())
+        assert pid in server.children
+
+        # a worker that dies is replaced
+        os.kill(pid, signal.SIGKILL)
+        _wait(lambda: pid not in server.children and len(server.children) == 2)
+        assert int(urllib2.urlopen(url).read()) in server.children
+    finally:
+        server.shutdown()
+        thread.join(10)
+    assert not thread.is_alive()
+    assert not server.children
+
+def test_threaded_server():
+    from ogcserver.server import make_threaded_server
+    inside = []
+    release = threading.Event()
+    def app(environ, start_response):
+        inside.append(1)
+        release.wait(10)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [threading.current_thread().name]
+    httpd = make_threaded_server('127.0.0.1', 0, app, threads=2)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+        names = []
+        clients = [threading.Thread(target=lambda: names.append(urllib2.urlopen(url).read())) for i in range(2)]
+        for client in clients:
+            client.start()
+        # both requests are inside the application at the same time
+        _wait(lambda: len(inside) == 2)
+        release.set()
+        for client in clients:
+            client.join()
+        assert len(set(names)) == 2
+    finally:
+        httpd.shutdown()
+
+def test_event_loop_server():
+    from ogcserver.common import check_render
+    from ogcserver.eventloop import EventLoopServer
+    inside = []
+    release = threading.Event()
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/render':
+            check_render()
+            inside.append(1)
+            release.wait(10)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'] + '?' + environ['QUERY_STRING']]
+    server = EventLoopServer(app, '127.0.0.1', 0, threads=1, queuesize=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        results = []
+        def get(path):
+            try:
+                results.append(urllib2.urlopen(url + path).read())
+            except urllib2.HTTPError, e:
+                results.append(e.code)
+        clients = [threading.Thread(target=get, args=('/render?a=1',))]
+        clients[0].start()
+        _wait(lambda: len(inside) == 1)
+        # answered on the loop while the render thread is busy
+        assert urllib2.urlopen(url + '/cheap?b=2').read() == '/cheap?b=2'
+        # one render waits for the thread, the next finds the queue full
+        clients.append(threading.Thread(target=get, args=('/render?c=3',)))
+        clients[1].start()
+        _wait(lambda: server.requests.full())
+        get('/render?d=4')
+        assert results == [503]
+        release.set()
+        for client in clients:
+            client.join()
+        assert sorted(results[1:]) == ['/render?a=1', '/render?c=3']
+    finally:
+        server.shutdown()
+        thread.join(10)
+        server.server_close()
+    assert not thread.is_alive()
+
+def test_event_loop_path():
+    from ogcserver.eventloop import EventLoopServer
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'] + '?' + environ['QUERY_STRING']]
+    server = EventLoopServer(app, '127.0.0.1', 0, threads=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        # the path is unquoted like by the other servers, the query is not
+        result = urllib2.urlopen(url + '/my%20layer/default/WorldCRS84Quad/0/0/0.png?a=b%20c').read()
+        assert result == '/my layer/default/WorldCRS84Quad/0/0/0.png?a=b%20c'
+    finally:
+        server.shutdown()
+        thread.join(10)
+        server.server_close()
+
+def test_event_loop_limits():
+    import socket
+    from ogcserver.eventloop import EventLoopServer
+    environs = []
+    def app(environ, start_response):
+        environs.append(environ)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+    server = EventLoopServer(app, '127.0.0.1', 0, threads=1, timeout=1, maxconnections=2, multiprocess=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        idle = [socket.create_connection(server.server_address) for i in range(2)]
+        _wait(lambda: len(server.connections) == 2)
+        # past the limit connections are closed at once
+        extra = socket.create_connection(server.server_address)
+        extra.settimeout(5)
+        assert extra.recv(1) == ''
+        # and clients that never send their request are disconnected
+        for sock in idle:
+            sock.settimeout(5)
+            assert sock.recv(1) == ''
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        assert urllib2.urlopen(url).read() == 'ok'
+        assert environs[0]['wsgi.multiprocess']
+    finally:
+        server.shutdown()
+        thread.join(10)
+        server.server_close()
+
+def test_event_loop_lookups():
+    import shutil
+    import tempfile
+    from ogcserver.common import check_lookup
+    from ogcserver.cache import DiskCache, MemoryCache
+    from ogcserver.eventloop import EventLoopServer
+    tmp = tempfile.mkdtemp()
+    caches = {'/memory': MemoryCache(1024), '/disk': DiskCache(tmp, 1024)}
+    def app(environ, start_response):
+        cache = caches[environ['PATH_INFO']]
+        check_lookup(cache)
+        cache.get(('key',))
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [threading.current_thread().name]
+    server = EventLoopServer(app, '127.0.0.1', 0, threads=1)
+    thread = threading.Thread(target=server.serve_forever, name='loop')
+    thread.daemon = True
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        # memory lookups are done on the loop, file ones by the threads
+        assert urllib2.urlopen(url + '/memory').read() == 'loop'
+        assert urllib2.urlopen(url + '/disk').read() != 'loop'
+    finally:
+        server.shutdown()
+        thread.join(10)
+        server.server_close()
+        shutil.rmtree(tmp)
+
+def test_prefork_gc():
+    import gc
+    from ogcserver.server import WORKER_GC_THRESHOLD2
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [str(gc.get_threshold()[2])]
+    server = PreforkServer(app, '127.0.0.1', 0, 1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        threshold = int(urllib2.urlopen(url).read())
+        if not hasattr(gc, 'freeze'):
+            # full collections of the worker are rare
+            assert threshold >= WORKER_GC_THRESHOLD2
+    finally:
+        server.shutdown()
+        thread.join(10)
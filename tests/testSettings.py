@@ -0,0 +1,47 @@
+import nose
+import os
+from StringIO import StringIO
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.settings import ServerSettings, load_settings
+from ogcserver.exceptions import ServerConfigurationError
+
+def _conf(text):
+    conf = SafeConfigParser()
+    conf.readfp(StringIO(text))
+    return conf
+
+def test_load_settings():
+    base_path, tail = os.path.split(__file__)
+    settings = load_settings(os.path.join(base_path, 'ogcserver.conf'))
+    assert settings.module == 'map_factory'
+    assert settings.debug == 1
+    assert settings.maxwidth == 2048
+    assert settings.allowedepsgcodes == ('epsg:23031', 'epsg:4326')
+    assert settings.baseurl is None
+    assert settings.maxage is None
+    assert load_settings(settings) is settings
+
+def test_settings_are_read_only():
+    settings = ServerSettings(_conf('[service]\nallowedepsgcodes=4326\n'))
+    nose.tools.assert_raises(AttributeError, setattr, settings, 'maxwidth', 1)
+    nose.tools.assert_raises(AttributeError, setattr, settings, 'other', 1)
+
+def test_invalid_settings_fail_early():
+    for text in ('[service]\nallowedepsgcodes=4326\nmaxwidth=wide\n',
+                 '[service]\nallowedepsgcodes=4326,web\n',
+                 '[service]\nallowedepsgcodes=\n',
+                 '[server]\ndebug=yes please\n[service]\nallowedepsgcodes=4326\n'):
+        nose.tools.assert_raises(ServerConfigurationError, ServerSettings, _conf(text))
+
+def test_maxage():
+    settings = ServerSettings(_conf('[service]\nallowedepsgcodes=4326\nmaxage=60\n'))
+    assert settings.maxage == 60
+    settings = ServerSettings(_conf('[server]\nmaxage=10\n[service]\nallowedepsgcodes=4326\nmaxage=60\n'))
+    assert settings.maxage == 10
+
+def test_cache_settings():
+    settings = ServerSettings(_conf('[service]\nallowedepsgcodes=4326\n'))
+    assert (settings.cachesoftttl, settings.cachehardttl, settings.layercache) == (0, 0, False)
+    settings = ServerSettings(_conf('[cache]\nsoftttl=60\nhardttl=3600\nlayers=true\n[service]\nallowedepsgcodes=4326\n'))
+    assert (settings.cachesoftttl, settings.cachehardttl, settings.layercache) == (60, 3600, True)
+    nose.tools.assert_raises(ServerConfigurationError, ServerSettings, _conf('[cache]\nsoftttl=60\nhardttl=30\n[service]\nallowedepsgcodes=4326\n'))
@@ -0,0 +1,36 @@
+import nose
+from ogcserver.tiles import GRIDS
+
+def test_find_tile():
+    grid = GRIDS['epsg:3857']
+    assert grid.find_tile(grid.tile_bbox(0, 0, 0), 256, 256) == (0, 0, 0)
+    assert grid.find_tile(grid.tile_bbox(5, 3, 17), 256, 256) == (5, 3, 17)
+    # coordinates printed with limited precision still match
+    bbox = [round(value, 2) for value in grid.tile_bbox(12, 2047, 1361)]
+    assert grid.find_tile(bbox, 256, 256) == (12, 2047, 1361)
+    assert grid.find_tile(grid.tile_bbox(5, 3, 17), 512, 512) is None
+    # off by half a tile
+    minx, miny, maxx, maxy = grid.tile_bbox(5, 3, 17)
+    shift = (maxx - minx) / 2
+    assert grid.find_tile([minx + shift, miny, maxx + shift, maxy], 256, 256) is None
+
+def test_geographic_grid():
+    grid = GRIDS['epsg:4326']
+    assert grid.tile_bbox(0, 0, 0) == [-180.0, -90.0, 0.0, 90.0]
+    assert grid.tile_bbox(0, 1, 0) == [0.0, -90.0, 180.0, 90.0]
+    assert grid.find_tile([-180, -90, 0, 90], 256, 256) == (0, 0, 0)
+
+def test_metatile():
+    grid = GRIDS['epsg:3857']
+    assert grid.metatile(5, 6, 9, 4) == (4, 8, 4, 4)
+    # clipped to the two by two tiles of level 1
+    assert grid.metatile(1, 1, 1, 4) == (0, 0, 2, 2)
+    assert grid.metatile_bbox(1, 0, 0, 2, 2) == list(grid.extent)
+
+def test_tile_range():
+    grid = GRIDS['epsg:4326']
+    assert grid.tile_range([-180, -90, 180, 90], 0) == (0, 0, 1, 0)
+    assert grid.tile_range([-10, -10, 10, 10], 1) == (1, 0, 2, 1)
+    # a bbox on the edge of a tile does not spill into its neighbour
+    assert grid.tile_range([0, 0, 90, 90], 1) == (2, 0, 2, 0)
+    assert grid.tile_range([-360, -90, -180, 90], 2) is None
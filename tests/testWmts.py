@@ -0,0 +1,71 @@
+import nose
+import os
+from xml.etree import ElementTree
+from ogcserver.configparser import SafeConfigParser
+from ogcserver.WMS import BaseWMSFactory
+from ogcserver.wmts import ServiceHandler
+from ogcserver.exceptions import OGCException
+
+def _wmts_service():
+    base_path, tail = os.path.split(__file__)
+    wms = BaseWMSFactory()
+    wms.loadXML(os.path.join(base_path, 'mapfile_encoding.xml'))
+    wms.finalize()
+
+    conf = SafeConfigParser()
+    conf.readfp(open(os.path.join(base_path, 'ogcserver.conf')))
+
+    return ServiceHandler(conf, wms, 'http://localhost/wmts?')
+
+def test_capabilities():
+    service = _wmts_service()
+    caps = ElementTree.XML(service.GetCapabilities({}).content)
+    wmts = '{http://www.opengis.net/wmts/1.0}'
+    ows = '{http://www.opengis.net/ows/1.1}'
+    # only EPSG:4326 of the configured CRSs has a tile grid
+    matrixsets = caps.findall('%sContents/%sTileMatrixSet' % (wmts, wmts))
+    assert [matrixset.find(ows + 'Identifier').text for matrixset in matrixsets] == ['WorldCRS84Quad']
+    layers = caps.findall('%sContents/%sLayer' % (wmts, wmts))
+    assert len(layers) == 1
+    template = layers[0].find(wmts + 'ResourceURL').get('template')
+    assert template.startswith('http://localhost/wmts/')
+
+def test_get_tile():
+    service = _wmts_service()
+    params = service.processParameters('GetTile', {
+        'layer': service.mapfactory.ordered_layers[0].name,
+        'style': 'default',
+        'tilematrixset': 'WorldCRS84Quad',
+        'tilematrix': '1',
+        'tilerow': '1',
+        'tilecol': '2',
+        'format': 'image/png',
+    })
+    response = service.GetTile(params)
+    assert response.content_type == 'image/png'
+
+    params['tilerow'] = 2
+    nose.tools.assert_raises(OGCException, service.GetTile, params)
+    params['tilerow'] = 1
+    params['tilematrixset'] = 'GoogleMapsCompatible'
+    nose.tools.assert_raises(OGCException, service.GetTile, params)
+
+def test_get_tile_matrix_range():
+    service = _wmts_service()
+    params = service.processParameters('GetTile', {
+        'layer': service.mapfactory.ordered_layers[0].name,
+        'style': 'default',
+        'tilematrixset': 'WorldCRS84Quad',
+        'tilematrix': '100000000',
+        'tilerow': '0',
+        'tilecol': '0',
+        'format': 'image/png',
+    })
+    try:
+        service.GetTile(params)
+    except OGCException, e:
+        assert e.args[1] == 'TileOutOfRange'
+    else:
+        raise AssertionError('TileMatrix past the grid levels was accepted')
+    params['tilematrix'] = -1
+    nose.tools.assert_raises(OGCException, service.GetTile, params)
@@ -48,3 +48,57 @@ def test_bad_query():
     response = wsgi_app.__call__(environ, start_response_check_404)
     environ['QUERY_STRING'] = "EXCEPTION=application/vnd.ogc.se_xml&VERSION=1.3.0&SERVICE=WMS&REQUEST=GetMap&"
     response = wsgi_app.__call__(environ, start_response_check_404)
+
+def test_get_capabilities_gzip():
+    import gzip
+    from StringIO import StringIO
+    headers = {}
+    def start_response(status, response_headers):
+        headers.update(dict(response_headers))
+        assert status == '200 OK'
+    wsgi_app = get_wsgiapp()
+    environ = get_environment()
+    environ['QUERY_STRING'] = "VERSION=1.1.1&SERVICE=WMS&REQUEST=GetCapabilities&"
+    identity = ''.join(wsgi_app.__call__(environ, start_response))
+    assert 'Content-Encoding' not in headers
+
+    environ['HTTP_ACCEPT_ENCODING'] = 'gzip, deflate'
+    content = ''.join(wsgi_app.__call__(environ, start_response))
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Content-Length'] == str(len(content))
+    assert gzip.GzipFile(fileobj=StringIO(content)).read() == identity
+
+def test_memory_cache():
+    from ogcserver.cache import MemoryCache
+    statuses = []
+    def start_response(status, response_headers):
+        statuses.append(status)
+    wsgi_app = get_wsgiapp()
+    wsgi_app.responsecache = MemoryCache(1024 * 1024)
+    environ = get_environment()
+    environ['QUERY_STRING'] = "SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&LAYERS=__all__&STYLES=&SRS=EPSG:4326&BBOX=-180,-90,180,90&WIDTH=256&HEIGHT=256&FORMAT=image/png"
+    rendered = ''.join(wsgi_app.__call__(environ, start_response))
+    # parameter order and case do not matter
+    environ['QUERY_STRING'] = "format=image/png&height=256&width=256&bbox=-180,-90,180,90&srs=EPSG:4326&styles=&layers=__all__&request=GetMap&version=1.1.1&service=WMS"
+    cached = ''.join(wsgi_app.__call__(environ, start_response))
+    assert statuses == ['200 OK', '200 OK']
+    assert cached == rendered
+    stats = wsgi_app.responsecache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+def test_get_tile_rest():
+    from ogcserver.wsgi import TILE_PATH
+    assert TILE_PATH.match('/world/default/GoogleMapsCompatible/3/4/2.gif') is None
+    headers = {}
+    def start_response(status, response_headers):
+        headers.update(dict(response_headers))
+        assert status == '200 OK'
+    wsgi_app = get_wsgiapp()
+    environ = get_environment()
+    environ['QUERY_STRING'] = ''
+    layername = wsgi_app.mapfactory.ordered_layers[0].name
+    if isinstance(layername, unicode):
+        layername = layername.encode('utf-8')
+    environ['PATH_INFO'] = '/%s/default/WorldCRS84Quad/1/2/1.png' % layername
+    ''.join(wsgi_app.__call__(environ, start_response))
+    assert headers['Content-Type'] == 'image/png'